@@ -12,7 +12,11 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.routing import APIRoute
 
-from config import ALLOWED_ORIGINS, DOCS, XRAY_SUBSCRIPTION_PATH
+from config import (ALLOWED_ORIGINS, BALANCER_CHECK_CONCURRENCY,
+                    BALANCER_PIPELINE_HANDSHAKE, BALANCER_RELAY_BACKEND,
+                    BALANCER_RELAY_BUFFER_SIZE, BALANCER_STRATEGY,
+                    BALANCER_UDP_IDLE_TIMEOUT, BALANCER_WARM_IDLE_TIMEOUT,
+                    BALANCER_WARM_POOL_MAX, DOCS, XRAY_SUBSCRIPTION_PATH)
 
 __version__ = "0.8.4"
 
@@ -47,12 +51,18 @@ def run_balancer_async():
         logger.info("Initializing balancer database...")
         db = BalancerDatabase()
         logger.info("Initializing proxy manager...")
-        manager = ProxyManager(db)
+        manager = ProxyManager(db, strategy=BALANCER_STRATEGY, check_concurrency=BALANCER_CHECK_CONCURRENCY)
         
         # Create and start balancer
         global balancer_server
         logger.info("Creating SOCKS balancer...")
-        balancer_server = SocksBalancer(manager, tcp_port=7777, udp_port=7778)
+        balancer_server = SocksBalancer(manager, tcp_port=7777, udp_port=7778,
+                                        relay_backend=BALANCER_RELAY_BACKEND,
+                                        relay_buffer_size=BALANCER_RELAY_BUFFER_SIZE,
+                                        udp_idle_timeout=BALANCER_UDP_IDLE_TIMEOUT,
+                                        warm_pool_max=BALANCER_WARM_POOL_MAX,
+                                        warm_idle_timeout=BALANCER_WARM_IDLE_TIMEOUT,
+                                        pipeline_handshake=BALANCER_PIPELINE_HANDSHAKE)
         
         logger.info("Starting Python Proxy Balancer...")
         loop.run_until_complete(balancer_server.start())
@@ -0,0 +1,67 @@
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Iterable, Tuple
+
+from sqlalchemy import bindparam, update
+
+from app.db.models import User
+from app.db.tx import execute_in_transaction
+
+
+class SubscriptionAccessBuffer:
+    """
+    Keeps the latest subscription access of every user until it is flushed.
+
+    Subscription fetches only record the time and user agent here, a job
+    writes them all in one batched UPDATE every few seconds and once more on
+    shutdown, instead of a commit on each fetch.
+    """
+
+    def __init__(self):
+        self._pending: Dict[int, Tuple[datetime, str]] = {}
+        self._lock = Lock()
+
+    def record(self, user_id: int, updated_at: datetime, user_agent: str):
+        with self._lock:
+            self._pending[user_id] = (updated_at, user_agent)
+
+    def discard_users(self, user_ids: Iterable[int]):
+        with self._lock:
+            for user_id in user_ids:
+                self._pending.pop(user_id, None)
+
+    def flush(self) -> int:
+        """Writes the pending accesses and returns how many users were updated."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        from app.db import GetDB
+
+        try:
+            with GetDB() as db:
+                def write():
+                    db.connection().execute(
+                        update(User)
+                        .where(User.id == bindparam('uid'))
+                        .values(sub_updated_at=bindparam('updated_at'),
+                                sub_last_user_agent=bindparam('user_agent')),
+                        [
+                            {"uid": uid, "updated_at": updated_at, "user_agent": user_agent}
+                            for uid, (updated_at, user_agent) in pending.items()
+                        ]
+                    )
+
+                execute_in_transaction(db, write)
+        except Exception:
+            # keep them for the next flush, unless the user fetched again meanwhile
+            with self._lock:
+                for user_id, access in pending.items():
+                    self._pending.setdefault(user_id, access)
+            raise
+
+        return len(pending)
+
+
+sub_access_buffer = SubscriptionAccessBuffer()
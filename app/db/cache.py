@@ -0,0 +1,42 @@
+import time
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class QueryCache:
+    """
+    Short-lived cache of query results keyed by the query's parameters.
+
+    Meant for expensive reads that dashboards repeat every few seconds,
+    where a result up to `ttl` seconds old is fine. A ttl of 0 disables it.
+    Cached values are shared, callers must not mutate them.
+    """
+
+    def __init__(self, ttl: int = 60, maxsize: int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: Dict[Hashable, Tuple[float, Any]] = {}
+        self._lock = Lock()
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        if self.ttl <= 0:
+            return load()
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        result = load()
+        with self._lock:
+            if len(self._data) >= self.maxsize:
+                self._data = {k: v for k, v in self._data.items() if v[0] > now}
+                if len(self._data) >= self.maxsize:
+                    self._data.clear()
+            self._data[key] = (now + self.ttl, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
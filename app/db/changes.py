@@ -0,0 +1,45 @@
+from threading import Lock
+from typing import Dict, Optional, Set, Tuple
+
+
+class UserChangeLog:
+    """
+    Tells consumers which users changed since they last looked.
+
+    crud stamps every user it writes with a new generation, bulk updates bump
+    the reset generation instead. A consumer keeps the generation it has seen
+    and asks for the users changed after it; `None` means it has to reload
+    everything. Used by `XRayConfig` to keep its inbound clients up to date.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self._reset_at = 0
+        self._changed: Dict[int, int] = {}
+        self._lock = Lock()
+
+    def touch(self, *user_ids: int):
+        with self._lock:
+            self.generation += 1
+            for user_id in user_ids:
+                self._changed[user_id] = self.generation
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._reset_at = self.generation
+            self._changed.clear()
+
+    def changed_since(self, generation: Optional[int]) -> Tuple[int, Optional[Set[int]]]:
+        """Returns the current generation and the ids of users changed after `generation`."""
+        with self._lock:
+            if generation is None or generation < self._reset_at:
+                return self.generation, None
+            if generation == self.generation:
+                return self.generation, set()
+            return self.generation, {
+                user_id for user_id, changed_at in self._changed.items() if changed_at > generation
+            }
+
+
+user_changes = UserChangeLog()
@@ -2,12 +2,14 @@
 Functions for managing proxy hosts, users, user templates, nodes, and administrative tasks.
 """
 
+from collections import defaultdict
 from datetime import datetime, timedelta
 from enum import Enum
 from typing import Dict, List, Optional, Tuple, Union
 
 from sqlalchemy import and_, delete, func, or_
-from sqlalchemy.orm import Query, Session, joinedload
+from sqlalchemy.orm import Query, Session, joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql.functions import coalesce
 
 from app.db.models import (
@@ -19,6 +21,7 @@ from app.db.models import (
     Node,
     NodeUsage,
     NodeUserUsage,
+    NodeUserUsageRollup,
     NotificationReminder,
     Proxy,
     ProxyHost,
@@ -29,6 +32,11 @@ from app.db.models import (
     UserTemplate,
     UserUsageResetLogs,
 )
+from app.db.access import sub_access_buffer
+from app.db.changes import user_changes
+from app.db.review import review_index
+from app.db.cache import QueryCache
+from app.db.usage import usage_aggregator, usage_query_cache
 from app.models.admin import AdminCreate, AdminModify, AdminPartialModify
 from app.models.node import NodeCreate, NodeModify, NodeStatus, NodeUsageResponse
 from app.models.proxy import ProxyHost as ProxyHostModify
@@ -42,8 +50,15 @@ from app.models.user import (
     UserUsageResponse,
 )
 from app.models.user_template import UserTemplateCreate, UserTemplateModify
+from app.subscription.cache import subscription_cache
 from app.utils.helpers import calculate_expiration_days, calculate_usage_percent
-from config import NOTIFY_DAYS_LEFT, NOTIFY_REACHED_USAGE_PERCENT, USERS_AUTODELETE_DAYS
+from config import (
+    JOB_FLUSH_SUB_ACCESS_INTERVAL,
+    NOTIFY_DAYS_LEFT,
+    NOTIFY_REACHED_USAGE_PERCENT,
+    USERS_AUTODELETE_DAYS,
+    USERS_COUNT_CACHE_TTL,
+)
 
 
 def add_default_host(db: Session, inbound: ProxyInbound):
@@ -221,6 +236,8 @@ def get_user_by_id(db: Session, user_id: int) -> Optional[User]:
     return get_user_queryset(db).filter(User.id == user_id).first()
 
 
+users_count_cache = QueryCache(ttl=USERS_COUNT_CACHE_TTL)
+
 UsersSortingOptions = Enum('UsersSortingOptions', {
     'username': User.username.asc(),
     'used_traffic': User.used_traffic.asc(),
@@ -235,17 +252,54 @@ UsersSortingOptions = Enum('UsersSortingOptions', {
 })
 
 
+def _cache_key(value):
+    if isinstance(value, (list, tuple, set)):
+        return tuple(sorted(map(str, value)))
+    return value
+
+
+def _users_keyset_column(sort: Optional[List[UsersSortingOptions]]):
+    """
+    Returns the column and direction of the keyset order, None for plain id order.
+
+    Nullable columns are compared through COALESCE so NULLs sort like 0 on every database.
+    """
+    if not sort:
+        return None, False
+    if len(sort) > 1:
+        raise ValueError("Keyset pagination supports a single sorting option")
+    name = sort[0].name.lstrip('-')
+    column = getattr(User, name)
+    if name in ('used_traffic', 'data_limit', 'expire'):
+        column = coalesce(column, 0)
+    return column, sort[0].name.startswith('-')
+
+
+def users_keyset_position(dbuser: User, sort: Optional[List[UsersSortingOptions]] = None) -> Tuple:
+    """Returns the `after` position of a user for `get_users(keyset=True)` with the same sorting."""
+    if not sort:
+        return None, dbuser.id
+    name = sort[0].name.lstrip('-')
+    value = getattr(dbuser, name)
+    if value is None and name in ('used_traffic', 'data_limit', 'expire'):
+        value = 0
+    return value, dbuser.id
+
+
 def get_users(db: Session,
               offset: Optional[int] = None,
               limit: Optional[int] = None,
               usernames: Optional[List[str]] = None,
+              user_ids: Optional[List[int]] = None,
               search: Optional[str] = None,
               status: Optional[Union[UserStatus, list]] = None,
               sort: Optional[List[UsersSortingOptions]] = None,
               admin: Optional[Admin] = None,
               admins: Optional[List[str]] = None,
               reset_strategy: Optional[Union[UserDataLimitResetStrategy, list]] = None,
-              return_with_count: bool = False) -> Union[List[User], Tuple[List[User], int]]:
+              return_with_count: bool = False,
+              keyset: bool = False,
+              after: Optional[Tuple] = None) -> Union[List[User], Tuple[List[User], int]]:
     """
     Retrieves users based on various filters and options.
 
@@ -254,13 +308,19 @@ def get_users(db: Session,
         offset (Optional[int]): Number of records to skip.
         limit (Optional[int]): Number of records to retrieve.
         usernames (Optional[List[str]]): List of usernames to filter by.
+        user_ids (Optional[List[int]]): List of user IDs to filter by.
         search (Optional[str]): Search term to filter by username or note.
         status (Optional[Union[UserStatus, list]]): User status or list of statuses to filter by.
         sort (Optional[List[UsersSortingOptions]]): Sorting options.
         admin (Optional[Admin]): Admin to filter users by.
         admins (Optional[List[str]]): List of admin usernames to filter users by.
         reset_strategy (Optional[Union[UserDataLimitResetStrategy, list]]): Data limit reset strategy to filter by.
-        return_with_count (bool): Whether to return the total count of users.
+        return_with_count (bool): Whether to return the total count of users. The count is
+            cached for USERS_COUNT_CACHE_TTL seconds or until users change.
+        keyset (bool): Order by at most one sorting option and the user id, so pages can be
+            fetched with `after` instead of `offset`.
+        after (Optional[Tuple]): Position from `users_keyset_position` of the last user of the
+            previous page, only users after it are returned.
 
     Returns:
         Union[List[User], Tuple[List[User], int]]: List of users or tuple of users and total count.
@@ -273,6 +333,9 @@ def get_users(db: Session,
     if usernames:
         query = query.filter(User.username.in_(usernames))
 
+    if user_ids:
+        query = query.filter(User.id.in_(user_ids))
+
     if status:
         if isinstance(status, list):
             query = query.filter(User.status.in_(status))
@@ -292,15 +355,37 @@ def get_users(db: Session,
         query = query.filter(User.admin.has(Admin.username.in_(admins)))
 
     if return_with_count:
-        count = query.count()
-
-    if sort:
+        key = (search, _cache_key(usernames), _cache_key(user_ids), _cache_key(status), admin.id if admin else None,
+               _cache_key(admins), _cache_key(reset_strategy), user_changes.generation)
+        count = users_count_cache.get_or_load(key, query.count)
+
+    if keyset:
+        column, descending = _users_keyset_column(sort)
+        if after is not None:
+            value, user_id = after
+            if column is None:
+                query = query.filter(User.id > user_id)
+            elif descending:
+                query = query.filter(or_(column < value, and_(column == value, User.id < user_id)))
+            else:
+                query = query.filter(or_(column > value, and_(column == value, User.id > user_id)))
+        if column is None:
+            query = query.order_by(User.id.asc())
+        elif descending:
+            query = query.order_by(column.desc(), User.id.desc())
+        else:
+            query = query.order_by(column.asc(), User.id.asc())
+    elif sort:
         query = query.order_by(*(opt.value for opt in sort))
 
     if offset:
         query = query.offset(offset)
     if limit:
-        query = query.limit(limit)
+        # a page is usually turned into responses, load what they read in a few queries
+        query = query.limit(limit).options(
+            selectinload(User.proxies).selectinload(Proxy.excluded_inbounds),
+            selectinload(User.usage_logs),
+        )
 
     if return_with_count:
         return query.all(), count
@@ -308,6 +393,33 @@ def get_users(db: Session,
     return query.all()
 
 
+def _get_node_user_usages(db: Session, start: datetime, end: datetime, user_id: Optional[int] = None,
+                          admins: Optional[List[str]] = None) -> Dict[Optional[int], int]:
+    """
+    Sums node user usages per node over the hourly rows and their rollups.
+
+    Usage is moved from hourly rows into daily and monthly rollups as it ages,
+    so every tier is queried; a rollup counts when its period starts in range.
+    Usages are limited to a single user or to the users of `admins`.
+    """
+    totals = defaultdict(int)
+    for model in (NodeUserUsage, NodeUserUsageRollup):
+        query = db.query(model.node_id, func.sum(model.used_traffic)).filter(
+            model.created_at >= start,
+            model.created_at <= end
+        )
+        if user_id is not None:
+            query = query.filter(model.user_id == user_id)
+        if admins:
+            query = query.join(User, User.id == model.user_id) \
+                .join(Admin, Admin.id == User.admin_id) \
+                .filter(Admin.username.in_(admins))
+
+        for node_id, used_traffic in query.group_by(model.node_id):
+            totals[node_id] += used_traffic or 0
+    return totals
+
+
 def get_user_usages(db: Session, dbuser: User, start: datetime, end: datetime) -> List[UserUsageResponse]:
     """
     Retrieves user usages within a specified date range.
@@ -335,13 +447,9 @@ def get_user_usages(db: Session, dbuser: User, start: datetime, end: datetime) -
             used_traffic=0
         )
 
-    cond = and_(NodeUserUsage.user_id == dbuser.id,
-                NodeUserUsage.created_at >= start,
-                NodeUserUsage.created_at <= end)
-
-    for v in db.query(NodeUserUsage).filter(cond):
+    for node_id, used_traffic in _get_node_user_usages(db, start, end, user_id=dbuser.id).items():
         try:
-            usages[v.node_id or 0].used_traffic += v.used_traffic
+            usages[node_id or 0].used_traffic += used_traffic
         except KeyError:
             pass
 
@@ -437,6 +545,9 @@ def create_user(db: Session, user: UserCreate, admin: Admin = None) -> User:
     db.add(dbuser)
     db.commit()
     db.refresh(dbuser)
+    usage_aggregator.set_user_admin(dbuser.id, dbuser.admin_id)
+    review_index.touch(dbuser.id)
+    user_changes.touch(dbuser.id)
     return dbuser
 
 
@@ -451,8 +562,13 @@ def remove_user(db: Session, dbuser: User) -> User:
     Returns:
         User: The removed user object.
     """
+    user_id, username = dbuser.id, dbuser.username
     db.delete(dbuser)
     db.commit()
+    usage_aggregator.discard_users([user_id])
+    sub_access_buffer.discard_users([user_id])
+    user_changes.touch(user_id)
+    subscription_cache.invalidate_user(username)
     return dbuser
 
 
@@ -464,9 +580,13 @@ def remove_users(db: Session, dbusers: List[User]):
         db (Session): Database session.
         dbusers (List[User]): List of user objects to be removed.
     """
+    user_ids = [dbuser.id for dbuser in dbusers]
     for dbuser in dbusers:
         db.delete(dbuser)
     db.commit()
+    usage_aggregator.discard_users(user_ids)
+    sub_access_buffer.discard_users(user_ids)
+    user_changes.touch(*user_ids)
     return
 
 
@@ -601,6 +721,9 @@ def update_user(db: Session, dbuser: User, modify: UserModify) -> User:
 
     db.commit()
     db.refresh(dbuser)
+    subscription_cache.invalidate_user(dbuser.username)
+    review_index.touch(dbuser.id)
+    user_changes.touch(dbuser.id)
     return dbuser
 
 
@@ -623,6 +746,7 @@ def reset_user_data_usage(db: Session, dbuser: User) -> User:
 
     dbuser.used_traffic = 0
     dbuser.node_usages.clear()
+    dbuser.node_usage_rollups.clear()
     if dbuser.status not in (UserStatus.expired or UserStatus.disabled):
         dbuser.status = UserStatus.active.value
 
@@ -633,6 +757,9 @@ def reset_user_data_usage(db: Session, dbuser: User) -> User:
 
     db.commit()
     db.refresh(dbuser)
+    review_index.touch(dbuser.id)
+    user_changes.touch(dbuser.id)
+    usage_query_cache.clear()
     return dbuser
 
 
@@ -658,6 +785,7 @@ def reset_user_by_next(db: Session, dbuser: User) -> User:
     db.add(usage_log)
 
     dbuser.node_usages.clear()
+    dbuser.node_usage_rollups.clear()
     dbuser.status = UserStatus.active.value
 
     dbuser.data_limit = dbuser.next_plan.data_limit + \
@@ -671,6 +799,9 @@ def reset_user_by_next(db: Session, dbuser: User) -> User:
 
     db.commit()
     db.refresh(dbuser)
+    review_index.touch(dbuser.id)
+    user_changes.touch(dbuser.id)
+    usage_query_cache.clear()
     return dbuser
 
 
@@ -702,6 +833,9 @@ def update_user_sub(db: Session, dbuser: User, user_agent: str) -> User:
     """
     Updates the user's subscription details.
 
+    Unless JOB_FLUSH_SUB_ACCESS_INTERVAL is 0, the access is only buffered
+    and written by the flush job a few seconds later.
+
     Args:
         db (Session): Database session.
         dbuser (User): The user object whose subscription is to be updated.
@@ -710,7 +844,15 @@ def update_user_sub(db: Session, dbuser: User, user_agent: str) -> User:
     Returns:
         User: The updated user object.
     """
-    dbuser.sub_updated_at = datetime.utcnow()
+    updated_at = datetime.utcnow()
+    if JOB_FLUSH_SUB_ACCESS_INTERVAL > 0:
+        sub_access_buffer.record(dbuser.id, updated_at, user_agent)
+        # not marked as changed, the session must not write it on its own
+        set_committed_value(dbuser, 'sub_updated_at', updated_at)
+        set_committed_value(dbuser, 'sub_last_user_agent', user_agent)
+        return dbuser
+
+    dbuser.sub_updated_at = updated_at
     dbuser.sub_last_user_agent = user_agent
 
     db.commit()
@@ -737,12 +879,16 @@ def reset_all_users_data_usage(db: Session, admin: Optional[Admin] = None):
             dbuser.status = UserStatus.active
         dbuser.usage_logs.clear()
         dbuser.node_usages.clear()
+        dbuser.node_usage_rollups.clear()
         if dbuser.next_plan:
             db.delete(dbuser.next_plan)
             dbuser.next_plan = None
         db.add(dbuser)
 
     db.commit()
+    review_index.invalidate()
+    user_changes.invalidate()
+    usage_query_cache.clear()
 
 
 def disable_all_active_users(db: Session, admin: Optional[Admin] = None):
@@ -760,6 +906,8 @@ def disable_all_active_users(db: Session, admin: Optional[Admin] = None):
     query.update({User.status: UserStatus.disabled, User.last_status_change: datetime.utcnow()}, synchronize_session=False)
 
     db.commit()
+    review_index.invalidate()
+    user_changes.invalidate()
 
 
 def activate_all_disabled_users(db: Session, admin: Optional[Admin] = None):
@@ -786,6 +934,8 @@ def activate_all_disabled_users(db: Session, admin: Optional[Admin] = None):
         {User.status: UserStatus.active, User.last_status_change: datetime.utcnow()}, synchronize_session=False)
 
     db.commit()
+    review_index.invalidate()
+    user_changes.invalidate()
 
 
 def autodelete_expired_users(db: Session,
@@ -829,7 +979,7 @@ def autodelete_expired_users(db: Session,
 
 
 def get_all_users_usages(
-        db: Session, admin: Admin, start: datetime, end: datetime
+        db: Session, admin: Optional[List[str]], start: datetime, end: datetime
 ) -> List[UserUsageResponse]:
     """
     Retrieves usage data for all users associated with an admin within a specified time range.
@@ -839,7 +989,7 @@ def get_all_users_usages(
 
     Args:
         db (Session): Database session for querying.
-        admin (Admin): The admin user for which to retrieve user usage data.
+        admin (Optional[List[str]]): Usernames of the admins whose users are counted, all users if empty.
         start (datetime): The start date and time of the period to consider.
         end (datetime): The end date and time of the period to consider.
 
@@ -847,30 +997,29 @@ def get_all_users_usages(
         List[UserUsageResponse]: A list of UserUsageResponse objects, each representing
         the usage data for a specific node or the main core.
     """
+    start, end = usage_query_cache.hour_range(start, end)
+    key = ("users", tuple(sorted(admin)) if admin else None, start, end)
+    return list(usage_query_cache.get_or_load(key, lambda: _get_all_users_usages(db, admin, start, end)))
+
+
+def _get_all_users_usages(db: Session, admins: Optional[List[str]], start: datetime,
+                          end: datetime) -> List[UserUsageResponse]:
     usages = {0: UserUsageResponse(  # Main Core
         node_id=None,
         node_name="Master",
         used_traffic=0
     )}
 
-    for node in db.query(Node).all():
-        usages[node.id] = UserUsageResponse(
-            node_id=node.id,
-            node_name=node.name,
+    for node_id, node_name in db.query(Node.id, Node.name):
+        usages[node_id] = UserUsageResponse(
+            node_id=node_id,
+            node_name=node_name,
             used_traffic=0
         )
 
-    admin_users = set(user.id for user in get_users(db=db, admins=admin))
-
-    cond = and_(
-        NodeUserUsage.created_at >= start,
-        NodeUserUsage.created_at <= end,
-        NodeUserUsage.user_id.in_(admin_users)
-    )
-
-    for v in db.query(NodeUserUsage).filter(cond):
+    for node_id, used_traffic in _get_node_user_usages(db, start, end, admins=admins).items():
         try:
-            usages[v.node_id or 0].used_traffic += v.used_traffic
+            usages[node_id or 0].used_traffic += used_traffic
         except KeyError:
             pass
 
@@ -893,6 +1042,8 @@ def update_user_status(db: Session, dbuser: User, status: UserStatus) -> User:
     dbuser.last_status_change = datetime.utcnow()
     db.commit()
     db.refresh(dbuser)
+    review_index.touch(dbuser.id)
+    user_changes.touch(dbuser.id)
     return dbuser
 
 
@@ -911,6 +1062,7 @@ def set_owner(db: Session, dbuser: User, admin: Admin) -> User:
     dbuser.admin = admin
     db.commit()
     db.refresh(dbuser)
+    usage_aggregator.set_user_admin(dbuser.id, dbuser.admin_id)
     return dbuser
 
 
@@ -931,6 +1083,8 @@ def start_user_expire(db: Session, dbuser: User) -> User:
     dbuser.on_hold_timeout = None
     db.commit()
     db.refresh(dbuser)
+    review_index.touch(dbuser.id)
+    user_changes.touch(dbuser.id)
     return dbuser
 
 
@@ -1076,8 +1230,10 @@ def remove_admin(db: Session, dbadmin: Admin) -> Admin:
     Returns:
         Admin: The removed admin object.
     """
+    admin_id = dbadmin.id
     db.delete(dbadmin)
     db.commit()
+    usage_aggregator.discard_admin(admin_id)
     return dbadmin
 
 
@@ -1338,6 +1494,12 @@ def get_nodes_usage(db: Session, start: datetime, end: datetime) -> List[NodeUsa
     Returns:
         List[NodeUsageResponse]: A list of NodeUsageResponse objects containing usage data.
     """
+    start, end = usage_query_cache.hour_range(start, end)
+    key = ("nodes", start, end)
+    return list(usage_query_cache.get_or_load(key, lambda: _get_nodes_usage(db, start, end)))
+
+
+def _get_nodes_usage(db: Session, start: datetime, end: datetime) -> List[NodeUsageResponse]:
     usages = {0: NodeUsageResponse(  # Main Core
         node_id=None,
         node_name="Master",
@@ -1345,20 +1507,22 @@ def get_nodes_usage(db: Session, start: datetime, end: datetime) -> List[NodeUsa
         downlink=0
     )}
 
-    for node in db.query(Node).all():
-        usages[node.id] = NodeUsageResponse(
-            node_id=node.id,
-            node_name=node.name,
+    for node_id, node_name in db.query(Node.id, Node.name):
+        usages[node_id] = NodeUsageResponse(
+            node_id=node_id,
+            node_name=node_name,
             uplink=0,
             downlink=0
         )
 
     cond = and_(NodeUsage.created_at >= start, NodeUsage.created_at <= end)
 
-    for v in db.query(NodeUsage).filter(cond):
+    for node_id, uplink, downlink in db.query(
+            NodeUsage.node_id, func.sum(NodeUsage.uplink), func.sum(NodeUsage.downlink)
+    ).filter(cond).group_by(NodeUsage.node_id):
         try:
-            usages[v.node_id or 0].uplink += v.uplink
-            usages[v.node_id or 0].downlink += v.downlink
+            usages[node_id or 0].uplink += uplink or 0
+            usages[node_id or 0].downlink += downlink or 0
         except KeyError:
             pass
 
@@ -1384,6 +1548,7 @@ def create_node(db: Session, node: NodeCreate) -> Node:
     db.add(dbnode)
     db.commit()
     db.refresh(dbnode)
+    usage_query_cache.clear()
     return dbnode
 
 
@@ -1400,6 +1565,7 @@ def remove_node(db: Session, dbnode: Node) -> Node:
     """
     db.delete(dbnode)
     db.commit()
+    usage_query_cache.clear()
     return dbnode
 
 
@@ -1439,6 +1605,8 @@ def update_node(db: Session, dbnode: Node, modify: NodeModify) -> Node:
 
     db.commit()
     db.refresh(dbnode)
+    if modify.name is not None:
+        usage_query_cache.clear()
     return dbnode
 
 
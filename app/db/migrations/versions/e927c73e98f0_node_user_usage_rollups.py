@@ -0,0 +1,43 @@
+"""node user usage rollups
+
+Revision ID: e927c73e98f0
+Revises: 2b231de97dc3
+Create Date: 2026-10-18 10:12:41.503118
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e927c73e98f0'
+down_revision = '2b231de97dc3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('node_user_usage_rollups',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('period', sa.String(length=8), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('node_id', sa.Integer(), nullable=True),
+    sa.Column('used_traffic', sa.BigInteger(), nullable=True),
+    sa.ForeignKeyConstraint(['node_id'], ['nodes.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('period', 'created_at', 'user_id', 'node_id')
+    )
+    op.create_index('ix_node_user_usage_rollups_created_at', 'node_user_usage_rollups',
+                    ['created_at'], unique=False)
+    op.create_index('ix_node_user_usage_rollups_user_id_created_at', 'node_user_usage_rollups',
+                    ['user_id', 'created_at'], unique=False)
+    op.create_index('ix_node_user_usages_user_id_created_at', 'node_user_usages',
+                    ['user_id', 'created_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_node_user_usages_user_id_created_at', table_name='node_user_usages')
+    op.drop_index('ix_node_user_usage_rollups_user_id_created_at', table_name='node_user_usage_rollups')
+    op.drop_index('ix_node_user_usage_rollups_created_at', table_name='node_user_usage_rollups')
+    op.drop_table('node_user_usage_rollups')
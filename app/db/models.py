@@ -10,6 +10,7 @@ from sqlalchemy import (
     Enum,
     Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     Table,
@@ -67,6 +68,7 @@ class User(Base):
     status = Column(Enum(UserStatus), nullable=False, default=UserStatus.active)
     used_traffic = Column(BigInteger, default=0)
     node_usages = relationship("NodeUserUsage", back_populates="user", cascade="all, delete-orphan")
+    node_usage_rollups = relationship("NodeUserUsageRollup", back_populates="user", cascade="all, delete-orphan")
     notification_reminders = relationship("NotificationReminder", back_populates="user", cascade="all, delete-orphan")
     data_limit = Column(BigInteger, nullable=True)
     data_limit_reset_strategy = Column(
@@ -309,6 +311,7 @@ class Node(Base):
     uplink = Column(BigInteger, default=0)
     downlink = Column(BigInteger, default=0)
     user_usages = relationship("NodeUserUsage", back_populates="node", cascade="all, delete-orphan")
+    user_usage_rollups = relationship("NodeUserUsageRollup", back_populates="node", cascade="all, delete-orphan")
     usages = relationship("NodeUsage", back_populates="node", cascade="all, delete-orphan")
     usage_coefficient = Column(Float, nullable=False, server_default=text("1.0"), default=1)
 
@@ -317,6 +320,7 @@ class NodeUserUsage(Base):
     __tablename__ = "node_user_usages"
     __table_args__ = (
         UniqueConstraint('created_at', 'user_id', 'node_id'),
+        Index('ix_node_user_usages_user_id_created_at', 'user_id', 'created_at'),
     )
 
     id = Column(Integer, primary_key=True)
@@ -328,6 +332,25 @@ class NodeUserUsage(Base):
     used_traffic = Column(BigInteger, default=0)
 
 
+class NodeUserUsageRollup(Base):
+    """Daily and monthly sums of node_user_usages rows older than the hourly retention"""
+    __tablename__ = "node_user_usage_rollups"
+    __table_args__ = (
+        UniqueConstraint('period', 'created_at', 'user_id', 'node_id'),
+        Index('ix_node_user_usage_rollups_created_at', 'created_at'),
+        Index('ix_node_user_usage_rollups_user_id_created_at', 'user_id', 'created_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    period = Column(String(8), nullable=False)  # "day" or "month"
+    created_at = Column(DateTime, nullable=False)  # start of the period
+    user_id = Column(Integer, ForeignKey("users.id"))
+    user = relationship("User", back_populates="node_usage_rollups")
+    node_id = Column(Integer, ForeignKey("nodes.id"))
+    node = relationship("Node", back_populates="user_usage_rollups")
+    used_traffic = Column(BigInteger, default=0)
+
+
 class NodeUsage(Base):
     __tablename__ = "node_usages"
     __table_args__ = (
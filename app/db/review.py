@@ -0,0 +1,182 @@
+import heapq
+import itertools
+import time
+from datetime import datetime
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import Session
+
+from app.db.models import User
+from app.models.user import UserStatus
+from config import (
+    JOB_REVIEW_USERS_RESYNC_INTERVAL,
+    NOTIFY_DAYS_LEFT,
+    NOTIFY_REACHED_USAGE_PERCENT,
+    WEBHOOK_ADDRESS,
+)
+
+if TYPE_CHECKING:
+    from app.db.models import User as DBUser
+
+
+class ReviewIndex:
+    """
+    Tells the review job which users may need a status change or a reminder.
+
+    Upcoming `expire`, expiration reminder and `on_hold_timeout` instants are kept
+    in a min-heap, users edited through crud are marked as touched, and users whose
+    traffic changed in the last usage flush are checked against their data limit
+    in SQL. A full resync from a lightweight projection runs on startup, after bulk
+    updates and every JOB_REVIEW_USERS_RESYNC_INTERVAL seconds. Users changed by
+    other processes (CLI, other workers) are only seen by that resync, so the
+    interval bounds how late their expiry or limit can be applied.
+
+    Rescheduling a user leaves its old heap items behind, they are skipped when
+    popped and dropped once they outnumber the live ones.
+    """
+
+    def __init__(self, resync_interval: int = 300):
+        self.resync_interval = resync_interval
+        # (instant, user id, version), an item is live while its version is the user's current one
+        self._heap: List[Tuple[float, int, int]] = []
+        # user id -> (deadline, version, live heap items)
+        self._deadlines: Dict[int, Tuple[Tuple, int, int]] = {}
+        self._versions = itertools.count()
+        self._live = 0
+        self._touched: Set[int] = set()
+        self._usage_changed: Set[int] = set()
+        self._synced_at: Optional[float] = None
+        self._lock = Lock()
+
+    @property
+    def usage_threshold(self) -> int:
+        """Lowest usage percent that can trigger a status change or a reminder."""
+        if WEBHOOK_ADDRESS and NOTIFY_REACHED_USAGE_PERCENT:
+            return min(100, *NOTIFY_REACHED_USAGE_PERCENT)
+        return 100
+
+    def touch(self, user_id: int):
+        with self._lock:
+            self._touched.add(user_id)
+
+    def usage_changed(self, user_ids: Iterable[int]):
+        with self._lock:
+            self._usage_changed.update(user_ids)
+
+    def invalidate(self):
+        with self._lock:
+            self._synced_at = None
+
+    def schedule(self, user: "DBUser"):
+        self._schedule(user.id, user.status, user.expire, user.on_hold_timeout)
+
+    def _schedule(self, user_id: int, status: UserStatus, expire: Optional[int],
+                  on_hold_timeout: Optional[datetime]):
+        deadline = (status, expire, on_hold_timeout)
+        with self._lock:
+            current = self._deadlines.get(user_id)
+            if current is not None and current[0] == deadline:
+                return
+            if current is not None:
+                self._live -= current[2]
+
+            instants = []
+            if status == UserStatus.active and expire:
+                instants.append(expire)
+                if WEBHOOK_ADDRESS:
+                    # passed reminder instants would fire on every tick, resync picks those users up instead
+                    now_ts = datetime.utcnow().timestamp()
+                    for days_left in NOTIFY_DAYS_LEFT:
+                        reminder_at = expire - (days_left + 1) * 86400
+                        if reminder_at > now_ts:
+                            instants.append(reminder_at)
+
+            elif status == UserStatus.on_hold and on_hold_timeout:
+                instants.append(on_hold_timeout.timestamp())
+
+            version = next(self._versions)
+            self._deadlines[user_id] = (deadline, version, len(instants))
+            self._live += len(instants)
+            for instant in instants:
+                heapq.heappush(self._heap, (instant, user_id, version))
+
+            if len(self._heap) > 2 * self._live + 64:
+                self._compact()
+
+    def _is_live(self, item: Tuple[float, int, int]) -> bool:
+        current = self._deadlines.get(item[1])
+        return current is not None and current[1] == item[2]
+
+    def _compact(self):
+        self._heap = [item for item in self._heap if self._is_live(item)]
+        heapq.heapify(self._heap)
+
+    def _resync(self, db: Session):
+        with self._lock:
+            self._heap.clear()
+            self._deadlines.clear()
+            self._live = 0
+            self._synced_at = time.monotonic()
+
+        rows = db.query(User.id, User.status, User.expire, User.on_hold_timeout) \
+            .filter(User.status.in_((UserStatus.active, UserStatus.on_hold)))
+        for row in rows:
+            self._schedule(*row)
+
+        condition = self._usage_condition()
+        if WEBHOOK_ADDRESS and NOTIFY_DAYS_LEFT:
+            reminders_from = int(datetime.utcnow().timestamp()) + (max(NOTIFY_DAYS_LEFT) + 1) * 86400
+            condition = or_(condition, and_(User.status == UserStatus.active, User.expire <= reminders_from))
+
+        with self._lock:
+            self._touched.update(r[0] for r in db.query(User.id).filter(condition))
+
+    def _usage_condition(self):
+        return or_(
+            and_(
+                User.status == UserStatus.active,
+                User.data_limit > 0,
+                User.used_traffic * 100 >= User.data_limit * self.usage_threshold,
+            ),
+            and_(
+                User.status == UserStatus.on_hold,
+                User.online_at >= func.coalesce(User.edit_at, User.created_at),
+            ),
+        )
+
+    def collect_due(self, db: Session, now: datetime, chunk_size: int = 500) -> List[int]:
+        """Returns the ids of users whose state has to be reviewed at `now`."""
+        with self._lock:
+            needs_resync = self._synced_at is None \
+                or time.monotonic() - self._synced_at >= self.resync_interval
+        if needs_resync:
+            self._resync(db)
+
+        now_ts = now.timestamp()
+        with self._lock:
+            due = self._touched
+            self._touched = set()
+            usage_changed = list(self._usage_changed)
+            self._usage_changed = set()
+
+            while self._heap and self._heap[0][0] <= now_ts:
+                item = heapq.heappop(self._heap)
+                if not self._is_live(item):
+                    continue
+                user_id = item[1]
+                due.add(user_id)
+                # the user is re-scheduled with its current state once reviewed
+                self._live -= self._deadlines.pop(user_id)[2]
+
+        for i in range(0, len(usage_changed), chunk_size):
+            chunk = usage_changed[i:i + chunk_size]
+            due.update(
+                r[0] for r in db.query(User.id).filter(User.id.in_(chunk), self._usage_condition())
+            )
+
+        return sorted(due)
+
+
+review_index = ReviewIndex(resync_interval=JOB_REVIEW_USERS_RESYNC_INTERVAL)
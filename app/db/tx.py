@@ -0,0 +1,26 @@
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+DEADLOCK_RETRIES = 3
+
+
+def execute_in_transaction(db: Session, func):
+    """
+    Runs `func` and commits, running it again in a new transaction when
+    MySQL picks it as a deadlock victim (up to DEADLOCK_RETRIES times).
+
+    `func` must only write through `db`, so a retry starts from scratch.
+    """
+    tries = 0
+    while True:
+        try:
+            func()
+            db.commit()
+            return
+        except OperationalError as err:
+            if db.bind.name == 'mysql' and getattr(err.orig, 'args', (None,))[0] == 1213 \
+                    and tries < DEADLOCK_RETRIES:  # Deadlock
+                db.rollback()
+                tries += 1
+                continue
+            raise err
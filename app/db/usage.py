@@ -0,0 +1,359 @@
+import time
+from array import array
+from collections import defaultdict
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from sqlalchemy import and_, bindparam, delete, func, insert, select, true, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from app.db.cache import QueryCache
+from app.db.models import Admin, NodeUserUsage, NodeUserUsageRollup, User
+from app.db.review import review_index
+from app.db.tx import execute_in_transaction
+from config import USAGE_QUERY_CACHE_TTL
+
+try:
+    import numpy
+except ImportError:  # optional, only speeds up summing the usages of many cores
+    numpy = None
+
+USER_ADMIN_RELOAD_INTERVAL = 600  # seconds, picks up owners changed by other processes
+EXISTING_USERS_CHUNK = 500  # ids per IN (...) query, stays below the bind limits of every backend
+
+
+class UsageAggregator:
+    """
+    Accumulates per-user and per-node traffic deltas and writes them in batched transactions.
+
+    The user -> admin mapping needed for admin usage is kept up to date by the
+    crud functions that create, remove or re-own users. Changes made by other
+    processes (CLI, other workers) are picked up by re-reading it every
+    USER_ADMIN_RELOAD_INTERVAL seconds, and users it doesn't know yet are
+    loaded when their usage is flushed.
+    """
+
+    def __init__(self):
+        self._user_admin: Optional[Dict[int, Optional[int]]] = None
+        self._loaded_at = 0.0
+        self._lock = Lock()
+
+    def _load_user_admin(self, db: Session, user_ids: Iterable[int]) -> Dict[int, Optional[int]]:
+        with self._lock:
+            if self._user_admin is None or time.monotonic() - self._loaded_at > USER_ADMIN_RELOAD_INTERVAL:
+                self._user_admin = dict(db.query(User.id, User.admin_id).all())
+                self._loaded_at = time.monotonic()
+                return self._user_admin
+            missing = [uid for uid in user_ids if uid not in self._user_admin]
+
+        if missing:
+            # created by another process, users that still aren't found were removed
+            found = db.query(User.id, User.admin_id).filter(User.id.in_(missing)).all()
+            with self._lock:
+                self._user_admin.update(found)
+        return self._user_admin
+
+    def set_user_admin(self, user_id: int, admin_id: Optional[int]):
+        with self._lock:
+            if self._user_admin is not None:
+                self._user_admin[user_id] = admin_id
+
+    def discard_users(self, user_ids: Iterable[int]):
+        with self._lock:
+            if self._user_admin is not None:
+                for user_id in user_ids:
+                    self._user_admin.pop(user_id, None)
+
+    def discard_admin(self, admin_id: int):
+        with self._lock:
+            if self._user_admin is not None:
+                for user_id, owner_id in self._user_admin.items():
+                    if owner_id == admin_id:
+                        self._user_admin[user_id] = None
+
+    @staticmethod
+    def collect(stats: Iterable[Tuple[int, int]]) -> Tuple[array, array]:
+        """Sums (uid, value) pairs of a single core into parallel uid/value arrays."""
+        totals = defaultdict(int)
+        for uid, value in stats:
+            totals[uid] += value
+        return array('q', totals.keys()), array('q', totals.values())
+
+    def flush(self, node_usages: Dict[Optional[int], Tuple[array, array]],
+              coefficients: Dict[Optional[int], float], record_node_usage: bool = True):
+        """
+        Writes the collected deltas of every core.
+
+        `node_usages` maps a node id (None for the main core) to uid/value
+        arrays with unique uids, as returned by `collect` or
+        `get_users_usage`. Values are multiplied by the node's usage
+        coefficient before they are added to users, admins and node usages.
+        """
+        scaled: Dict[Optional[int], Tuple[array, array]] = {
+            node_id: (uids, _scale(values, coefficients.get(node_id, 1)))
+            for node_id, (uids, values) in node_usages.items() if uids
+        }
+        users_usage = _sum_by_uid(scaled.values())
+
+        if not users_usage:
+            return
+
+        from app.db import GetDB
+
+        with GetDB() as db:
+            user_admin = self._load_user_admin(db, users_usage.keys())
+            admin_usage = defaultdict(int)
+            for uid, value in users_usage.items():
+                admin_id = user_admin.get(uid)
+                if admin_id:
+                    admin_usage[admin_id] += value
+
+            created_at = datetime.fromisoformat(datetime.utcnow().strftime('%Y-%m-%dT%H:00:00'))
+            online_at = datetime.utcnow()
+
+            def write():
+                conn = db.connection()
+                conn.execute(
+                    update(User)
+                    .where(User.id == bindparam('uid'))
+                    .values(used_traffic=User.used_traffic + bindparam('value'), online_at=online_at),
+                    [{"uid": uid, "value": value} for uid, value in users_usage.items()]
+                )
+
+                if admin_usage:
+                    conn.execute(
+                        update(Admin)
+                        .where(Admin.id == bindparam('admin_id'))
+                        .values(users_usage=Admin.users_usage + bindparam('value')),
+                        [{"admin_id": admin_id, "value": value} for admin_id, value in admin_usage.items()]
+                    )
+
+            execute_in_transaction(db, write)
+            review_index.usage_changed(users_usage.keys())
+
+            if not record_node_usage:
+                return
+
+            # in a transaction of their own, so a user removed by another process since
+            # the stats were collected can't roll back the usage of everyone else
+            def write_node_usages():
+                existing_users = _existing_user_ids(db, users_usage.keys())
+                for node_id, (uids, values) in scaled.items():
+                    self._write_node_user_usages(db, node_id, created_at, uids, values, existing_users)
+
+            execute_in_transaction(db, write_node_usages)
+
+    @staticmethod
+    def _write_node_user_usages(db: Session, node_id: Optional[int], created_at: datetime,
+                                uids: array, values: array, existing_users: Set[int]):
+        # skip users removed since their stats were collected, they would break the foreign key
+        rows = [
+            {"user_id": uid, "node_id": node_id, "created_at": created_at, "used_traffic": value}
+            for uid, value in zip(uids, values) if value and uid in existing_users
+        ]
+        if not rows:
+            return
+
+        conn = db.connection()
+        dialect = db.bind.name
+
+        # NULL never conflicts in a unique index, so the main core's rows can't be upserted
+        if node_id is not None and dialect in ('mysql', 'sqlite', 'postgresql'):
+            if dialect == 'mysql':
+                stmt = mysql.insert(NodeUserUsage)
+                stmt = stmt.on_duplicate_key_update(
+                    used_traffic=NodeUserUsage.used_traffic + stmt.inserted.used_traffic
+                )
+            else:
+                stmt = (sqlite if dialect == 'sqlite' else postgresql).insert(NodeUserUsage)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[NodeUserUsage.created_at, NodeUserUsage.user_id, NodeUserUsage.node_id],
+                    set_={"used_traffic": NodeUserUsage.used_traffic + stmt.excluded.used_traffic}
+                )
+            conn.execute(stmt, rows)
+            return
+
+        existings = set(
+            r[0] for r in conn.execute(
+                select(NodeUserUsage.user_id)
+                .where(and_(NodeUserUsage.node_id == node_id, NodeUserUsage.created_at == created_at))
+            )
+        )
+        new_rows = [r for r in rows if r["user_id"] not in existings]
+        if new_rows:
+            conn.execute(insert(NodeUserUsage), new_rows)
+
+        update_rows = [{"uid": r["user_id"], "value": r["used_traffic"]} for r in rows if r["user_id"] in existings]
+        if update_rows:
+            conn.execute(
+                update(NodeUserUsage)
+                .values(used_traffic=NodeUserUsage.used_traffic + bindparam('value'))
+                .where(and_(NodeUserUsage.user_id == bindparam('uid'),
+                            NodeUserUsage.node_id == node_id,
+                            NodeUserUsage.created_at == created_at)),
+                update_rows
+            )
+
+
+class UsageQueryCache(QueryCache):
+    """
+    Short-lived cache of aggregated usage query results.
+
+    Usage rows start on an hour, so rounding a range inwards to whole hours
+    doesn't change its result and lets dashboard refreshes within the same
+    hour share an entry. Entries expire after `ttl` seconds as the current
+    hour keeps growing.
+    """
+
+    @staticmethod
+    def hour_range(start: datetime, end: datetime) -> Tuple[datetime, datetime]:
+        start_hour = start.replace(minute=0, second=0, microsecond=0)
+        if start_hour != start:
+            start_hour += timedelta(hours=1)
+        return start_hour, end.replace(minute=0, second=0, microsecond=0)
+
+
+def _scale(values: array, coefficient: float) -> array:
+    if coefficient == 1:
+        return values
+    if numpy is not None:
+        scaled = numpy.frombuffer(values, dtype=numpy.int64) * coefficient
+        return array('q', scaled.astype(numpy.int64).tobytes())
+    return array('q', (int(v * coefficient) for v in values))
+
+
+def _existing_user_ids(db: Session, user_ids: Iterable[int]) -> Set[int]:
+    user_ids = list(user_ids)
+    existing = set()
+    for i in range(0, len(user_ids), EXISTING_USERS_CHUNK):
+        chunk = user_ids[i:i + EXISTING_USERS_CHUNK]
+        existing.update(db.connection().execute(select(User.id).where(User.id.in_(chunk))).scalars())
+    return existing
+
+
+def _sum_by_uid(usages) -> Dict[int, int]:
+    usages = list(usages)
+    if len(usages) == 1:
+        uids, values = usages[0]
+        return dict(zip(uids, values))
+
+    if numpy is not None and usages:
+        uids = numpy.concatenate([numpy.frombuffer(u, dtype=numpy.int64) for u, _ in usages])
+        values = numpy.concatenate([numpy.frombuffer(v, dtype=numpy.int64) for _, v in usages])
+        unique, inverse = numpy.unique(uids, return_inverse=True)
+        totals = numpy.zeros(len(unique), dtype=numpy.int64)
+        numpy.add.at(totals, inverse, values)
+        return dict(zip(unique.tolist(), totals.tolist()))
+
+    totals = defaultdict(int)
+    for uids, values in usages:
+        for uid, value in zip(uids, values):
+            totals[uid] += value
+    return totals
+
+
+def _period_start(dt: datetime, period: str) -> datetime:
+    if period == 'month':
+        return datetime(dt.year, dt.month, 1)
+    return datetime(dt.year, dt.month, dt.day)
+
+
+def _next_period(dt: datetime, period: str) -> datetime:
+    if period == 'month':
+        return datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+    return dt + timedelta(days=1)
+
+
+def _compact(db: Session, source, source_filter, period: str, cutoff: datetime) -> int:
+    """
+    Moves the rows of `source` that start before `cutoff` into `period` rollups,
+    one period per transaction. Returns the number of periods compacted.
+    """
+    compacted = 0
+    start = None
+    while True:
+        query = select(func.min(source.created_at)).where(source_filter, source.created_at < cutoff)
+        if start is not None:
+            query = query.where(source.created_at >= start)
+        first = db.execute(query).scalar()
+        if first is None:
+            return compacted
+
+        start = _period_start(first, period)
+        end = _next_period(start, period)
+        in_period = and_(source_filter, source.created_at >= start, source.created_at < end)
+
+        def write():
+            conn = db.connection()
+            totals = conn.execute(
+                select(source.user_id, source.node_id, func.sum(source.used_traffic))
+                .where(in_period)
+                .group_by(source.user_id, source.node_id)
+            ).all()
+            # a period is normally compacted once, rows written late are added to it
+            existing = {
+                (user_id, node_id): rollup_id for rollup_id, user_id, node_id in conn.execute(
+                    select(NodeUserUsageRollup.id, NodeUserUsageRollup.user_id, NodeUserUsageRollup.node_id)
+                    .where(NodeUserUsageRollup.period == period, NodeUserUsageRollup.created_at == start)
+                )
+            }
+
+            new_rows = [
+                {"period": period, "created_at": start, "user_id": user_id, "node_id": node_id,
+                 "used_traffic": value}
+                for user_id, node_id, value in totals if (user_id, node_id) not in existing
+            ]
+            if new_rows:
+                conn.execute(insert(NodeUserUsageRollup), new_rows)
+
+            update_rows = [
+                {"rollup_id": existing[(user_id, node_id)], "value": value}
+                for user_id, node_id, value in totals if (user_id, node_id) in existing
+            ]
+            if update_rows:
+                conn.execute(
+                    update(NodeUserUsageRollup)
+                    .where(NodeUserUsageRollup.id == bindparam('rollup_id'))
+                    .values(used_traffic=NodeUserUsageRollup.used_traffic + bindparam('value')),
+                    update_rows
+                )
+
+            conn.execute(delete(source).where(in_period))
+
+        execute_in_transaction(db, write)
+        compacted += 1
+        start = end
+
+
+def rollup_node_user_usages(db: Session, hourly_retention_days: int, daily_retention_days: int,
+                            now: Optional[datetime] = None) -> Tuple[int, int]:
+    """
+    Compacts node user usages into coarser tiers.
+
+    Hourly rows of days that ended more than `hourly_retention_days` ago are
+    summed into daily rollups, daily rollups of months that ended more than
+    `daily_retention_days` ago into monthly ones. A retention of 0 or less
+    keeps that tier forever. Each row lives in exactly one tier, so usage
+    queries add up all tiers for a range.
+
+    Returns:
+        Tuple[int, int]: Number of days and months compacted.
+    """
+    now = now or datetime.utcnow()
+    days = months = 0
+
+    if hourly_retention_days > 0:
+        cutoff = _period_start(now - timedelta(days=hourly_retention_days), 'day')
+        days = _compact(db, NodeUserUsage, true(), 'day', cutoff)
+
+        if daily_retention_days > 0:
+            cutoff = _period_start(now - timedelta(days=daily_retention_days), 'month')
+            months = _compact(db, NodeUserUsageRollup, NodeUserUsageRollup.period == 'day', 'month', cutoff)
+
+    return days, months
+
+
+usage_aggregator = UsageAggregator()
+usage_query_cache = UsageQueryCache(ttl=USAGE_QUERY_CACHE_TTL)
@@ -1,11 +1,26 @@
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from app import app, logger, scheduler, xray
 from app.db import GetDB, crud
 from app.models.node import NodeStatus
-from config import JOB_CORE_HEALTH_CHECK_INTERVAL
-from xray_api import exc as xray_exc
+from config import JOB_CORE_HEALTH_CHECK_INTERVAL, NODE_CONNECT_WORKERS, NODE_HEARTBEAT_INTERVAL
+from xray_api.aio import XRay as AsyncXRayAPI
+
+
+def nodes_heartbeat():
+    nodes = list(xray.nodes.values())
+    if not nodes:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(NODE_CONNECT_WORKERS, len(nodes))) as executor:
+        for node in nodes:
+            executor.submit(node.heartbeat)
+
+
+async def get_sys_stats(api: AsyncXRayAPI, node_id: int):
+    return await api.get_sys_stats(timeout=2)
 
 
 def core_health_check():
@@ -17,17 +32,26 @@ def core_health_check():
             config = xray.config.include_db_users()
         xray.core.restart(config)
 
-    # nodes' core
-    for node_id, node in list(xray.nodes.items()):
+    # nodes' core, probed concurrently on the shared event loop
+    nodes = list(xray.nodes.items())
+    apis, unhealthy = {}, []
+    for node_id, node in nodes:
         if node.connected:
             try:
                 assert node.started
-                node.api.get_sys_stats(timeout=2)
-            except (ConnectionError, xray_exc.XrayError, AssertionError):
-                if not config:
-                    config = xray.config.include_db_users()
-                xray.operations.restart_node(node_id, config)
+                apis[node_id] = node.api
+            except (ConnectionError, AssertionError):
+                unhealthy.append(node_id)
 
+    results = xray.async_api.run(xray.async_api.gather(apis, get_sys_stats))
+    unhealthy += [node_id for node_id, result in results.items() if isinstance(result, Exception)]
+
+    for node_id in unhealthy:
+        if not config:
+            config = xray.config.include_db_users()
+        xray.operations.restart_node(node_id, config)
+
+    for node_id, node in nodes:
         if not node.connected:
             if not config:
                 config = xray.config.include_db_users()
@@ -63,6 +87,9 @@ def start_core():
     scheduler.add_job(core_health_check, 'interval',
                       seconds=JOB_CORE_HEALTH_CHECK_INTERVAL,
                       coalesce=True, max_instances=1)
+    scheduler.add_job(nodes_heartbeat, 'interval',
+                      seconds=NODE_HEARTBEAT_INTERVAL,
+                      coalesce=True, max_instances=1)
 
 
 @app.on_event("shutdown")
@@ -0,0 +1,19 @@
+from app import app, logger, scheduler
+from app.db.access import sub_access_buffer
+from config import JOB_FLUSH_SUB_ACCESS_INTERVAL
+
+
+def flush_sub_access():
+    try:
+        sub_access_buffer.flush()
+    except Exception as err:
+        logger.warning(f"Failed to write subscription accesses: {err}")
+
+
+if JOB_FLUSH_SUB_ACCESS_INTERVAL > 0:
+    @app.on_event("shutdown")
+    def app_shutdown():
+        flush_sub_access()
+
+    scheduler.add_job(flush_sub_access, 'interval', seconds=JOB_FLUSH_SUB_ACCESS_INTERVAL,
+                      coalesce=True, max_instances=1)
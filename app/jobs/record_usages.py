@@ -1,8 +1,7 @@
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
+from array import array
 from datetime import datetime
 from operator import attrgetter
-from typing import Union
+from typing import Dict, Union
 
 from pymysql.err import OperationalError
 from sqlalchemy import and_, bindparam, insert, select, update
@@ -11,7 +10,8 @@ from sqlalchemy.sql.dml import Insert
 
 from app import scheduler, xray
 from app.db import GetDB
-from app.db.models import Admin, NodeUsage, NodeUserUsage, System, User
+from app.db.models import NodeUsage, System
+from app.db.usage import usage_aggregator
 from config import (
     DISABLE_RECORDING_NODE_USAGE,
     JOB_RECORD_NODE_USAGES_INTERVAL,
@@ -19,6 +19,7 @@ from config import (
 )
 from xray_api import XRay as XRayAPI
 from xray_api import exc as xray_exc
+from xray_api.aio import XRay as AsyncXRayAPI
 
 
 def safe_execute(db: Session, stmt, params=None):
@@ -45,44 +46,6 @@ def safe_execute(db: Session, stmt, params=None):
         db.commit()
 
 
-def record_user_stats(params: list, node_id: Union[int, None],
-                      consumption_factor: int = 1):
-    if not params:
-        return
-
-    created_at = datetime.fromisoformat(datetime.utcnow().strftime('%Y-%m-%dT%H:00:00'))
-
-    with GetDB() as db:
-        # make user usage row if doesn't exist
-        select_stmt = select(NodeUserUsage.user_id) \
-            .where(and_(NodeUserUsage.node_id == node_id, NodeUserUsage.created_at == created_at))
-        existings = [r[0] for r in db.execute(select_stmt).fetchall()]
-        uids_to_insert = set()
-
-        for p in params:
-            uid = int(p['uid'])
-            if uid in existings:
-                continue
-            uids_to_insert.add(uid)
-
-        if uids_to_insert:
-            stmt = insert(NodeUserUsage).values(
-                user_id=bindparam('uid'),
-                created_at=created_at,
-                node_id=node_id,
-                used_traffic=0
-            )
-            safe_execute(db, stmt, [{'uid': uid} for uid in uids_to_insert])
-
-        # record
-        stmt = update(NodeUserUsage) \
-            .values(used_traffic=NodeUserUsage.used_traffic + bindparam('value') * consumption_factor) \
-            .where(and_(NodeUserUsage.user_id == bindparam('uid'),
-                        NodeUserUsage.node_id == node_id,
-                        NodeUserUsage.created_at == created_at))
-        safe_execute(db, stmt, params)
-
-
 def record_node_stats(params: dict, node_id: Union[int, None]):
     if not params:
         return
@@ -107,24 +70,38 @@ def record_node_stats(params: dict, node_id: Union[int, None]):
         safe_execute(db, stmt, params)
 
 
-def get_users_stats(api: XRayAPI):
+def invalidate_node(node_id: Union[int, None]):
+    node = xray.nodes.get(node_id) if node_id is not None else None
+    if node is not None:
+        node.invalidate()
+
+
+async def get_users_stats(api: AsyncXRayAPI, node_id: Union[int, None] = None):
     try:
-        params = defaultdict(int)
-        for stat in filter(attrgetter('value'), api.get_users_stats(reset=True, timeout=30)):
-            params[stat.name.split('.', 1)[0]] += stat.value
-        params = list({"uid": uid, "value": value} for uid, value in params.items())
-        return params
+        usage = await api.get_users_usage(reset=True, timeout=30)
     except xray_exc.XrayError:
-        return []
+        invalidate_node(node_id)
+        return array('q'), array('q')
+    return usage.uids, usage.totals()
 
 
-def get_outbounds_stats(api: XRayAPI):
+async def get_outbounds_stats(api: AsyncXRayAPI, node_id: Union[int, None] = None):
     try:
-        params = [{"up": stat.value, "down": 0} if stat.link == "uplink" else {"up": 0, "down": stat.value}
-                  for stat in filter(attrgetter('value'), api.get_outbounds_stats(reset=True, timeout=10))]
-        return params
+        stats = await api.get_outbounds_stats(reset=True, timeout=10)
     except xray_exc.XrayError:
+        invalidate_node(node_id)
         return []
+    return [{"up": stat.value, "down": 0} if stat.link == "uplink" else {"up": 0, "down": stat.value}
+            for stat in filter(attrgetter('value'), stats)]
+
+
+def query_cores(api_instances: Dict[Union[int, None], XRayAPI], call) -> dict:
+    # all cores are queried concurrently on the shared event loop
+    results = xray.async_api.run(xray.async_api.gather(api_instances, call))
+    for result in results.values():
+        if isinstance(result, BaseException):
+            raise result
+    return results
 
 
 def record_user_usages():
@@ -136,51 +113,9 @@ def record_user_usages():
             api_instances[node_id] = node.api
             usage_coefficient[node_id] = node.usage_coefficient  # fetch the usage coefficient
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {node_id: executor.submit(get_users_stats, api) for node_id, api in api_instances.items()}
-    api_params = {node_id: future.result() for node_id, future in futures.items()}
+    api_params = query_cores(api_instances, get_users_stats)
 
-    users_usage = defaultdict(int)
-    for node_id, params in api_params.items():
-        coefficient = usage_coefficient.get(node_id, 1)  # get the usage coefficient for the node
-        for param in params:
-            users_usage[param['uid']] += int(param['value'] * coefficient)  # apply the usage coefficient
-    users_usage = list({"uid": uid, "value": value} for uid, value in users_usage.items())
-    if not users_usage:
-        return
-
-    with GetDB() as db:
-        user_admin_map = dict(db.query(User.id, User.admin_id).all())
-
-    admin_usage = defaultdict(int)
-    for user_usage in users_usage:
-        admin_id = user_admin_map.get(int(user_usage["uid"]))
-        if admin_id:
-            admin_usage[admin_id] += user_usage["value"]
-
-    # record users usage
-    with GetDB() as db:
-        stmt = update(User). \
-            where(User.id == bindparam('uid')). \
-            values(
-                used_traffic=User.used_traffic + bindparam('value'),
-                online_at=datetime.utcnow()
-        )
-
-        safe_execute(db, stmt, users_usage)
-
-        admin_data = [{"admin_id": admin_id, "value": value} for admin_id, value in admin_usage.items()]
-        if admin_data:
-            admin_update_stmt = update(Admin). \
-                where(Admin.id == bindparam('admin_id')). \
-                values(users_usage=Admin.users_usage + bindparam('value'))
-            safe_execute(db, admin_update_stmt, admin_data)
-
-    if DISABLE_RECORDING_NODE_USAGE:
-        return
-
-    for node_id, params in api_params.items():
-        record_user_stats(params, node_id, usage_coefficient[node_id])
+    usage_aggregator.flush(api_params, usage_coefficient, record_node_usage=not DISABLE_RECORDING_NODE_USAGE)
 
 
 def record_node_usages():
@@ -189,9 +124,7 @@ def record_node_usages():
         if node.connected and node.started:
             api_instances[node_id] = node.api
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {node_id: executor.submit(get_outbounds_stats, api) for node_id, api in api_instances.items()}
-    api_params = {node_id: future.result() for node_id, future in futures.items()}
+    api_params = query_cores(api_instances, get_outbounds_stats)
 
     total_up = 0
     total_down = 0
@@ -6,6 +6,7 @@ from sqlalchemy.orm import Session
 from app import logger, scheduler, xray
 from app.db import (GetDB, get_notification_reminder, get_users,
                     start_user_expire, update_user_status, reset_user_by_next)
+from app.db.review import review_index
 from app.models.user import ReminderType, UserResponse, UserStatus
 from app.utils import report
 from app.utils.helpers import (calculate_expiration_days,
@@ -16,6 +17,8 @@ from config import (JOB_REVIEW_USERS_INTERVAL, NOTIFY_DAYS_LEFT,
 if TYPE_CHECKING:
     from app.db.models import User
 
+REVIEW_CHUNK_SIZE = 500
+
 
 def add_notification_reminders(db: Session, user: "User", now: datetime = datetime.utcnow()) -> None:
     if user.data_limit:
@@ -51,68 +54,80 @@ def reset_user_by_next_report(db: Session, user: "User"):
     report.user_data_reset_by_next(user=UserResponse.model_validate(user), user_admin=user.admin)
 
 
-def review():
-    now = datetime.utcnow()
+def review_active_user(db: Session, user: "User", now: datetime):
     now_ts = now.timestamp()
-    with GetDB() as db:
-        for user in get_users(db, status=UserStatus.active):
+    limited = user.data_limit and user.used_traffic >= user.data_limit
+    expired = user.expire and user.expire <= now_ts
+
+    if (limited or expired) and user.next_plan is not None:
+        if user.next_plan is not None:
 
-            limited = user.data_limit and user.used_traffic >= user.data_limit
-            expired = user.expire and user.expire <= now_ts
+            if user.next_plan.fire_on_either:
+                reset_user_by_next_report(db, user)
+                return
 
-            if (limited or expired) and user.next_plan is not None:
-                if user.next_plan is not None:
+            elif limited and expired:
+                reset_user_by_next_report(db, user)
+                return
 
-                    if user.next_plan.fire_on_either:
-                        reset_user_by_next_report(db, user)
-                        continue
+    if limited:
+        status = UserStatus.limited
+    elif expired:
+        status = UserStatus.expired
+    else:
+        if WEBHOOK_ADDRESS:
+            add_notification_reminders(db, user, now)
+        return
 
-                    elif limited and expired:
-                        reset_user_by_next_report(db, user)
-                        continue
+    xray.operations.remove_user(user)
+    update_user_status(db, user, status)
 
-            if limited:
-                status = UserStatus.limited
-            elif expired:
-                status = UserStatus.expired
-            else:
-                if WEBHOOK_ADDRESS:
-                    add_notification_reminders(db, user, now)
-                continue
+    report.status_change(username=user.username, status=status,
+                         user=UserResponse.model_validate(user), user_admin=user.admin)
 
-            xray.operations.remove_user(user)
-            update_user_status(db, user, status)
+    logger.info(f"User \"{user.username}\" status changed to {status}")
 
-            report.status_change(username=user.username, status=status,
-                                 user=UserResponse.model_validate(user), user_admin=user.admin)
 
-            logger.info(f"User \"{user.username}\" status changed to {status}")
+def review_on_hold_user(db: Session, user: "User", now: datetime):
+    if user.edit_at:
+        base_time = datetime.timestamp(user.edit_at)
+    else:
+        base_time = datetime.timestamp(user.created_at)
 
-        for user in get_users(db, status=UserStatus.on_hold):
+    # Check if the user is online After or at 'base_time'
+    if user.online_at and base_time <= datetime.timestamp(user.online_at):
+        status = UserStatus.active
 
-            if user.edit_at:
-                base_time = datetime.timestamp(user.edit_at)
-            else:
-                base_time = datetime.timestamp(user.created_at)
+    elif user.on_hold_timeout and (datetime.timestamp(user.on_hold_timeout) <= (now.timestamp())):
+        # If the user didn't connect within the timeout period, change status to "Active"
+        status = UserStatus.active
 
-            # Check if the user is online After or at 'base_time'
-            if user.online_at and base_time <= datetime.timestamp(user.online_at):
-                status = UserStatus.active
+    else:
+        return
 
-            elif user.on_hold_timeout and (datetime.timestamp(user.on_hold_timeout) <= (now_ts)):
-                # If the user didn't connect within the timeout period, change status to "Active"
-                status = UserStatus.active
+    update_user_status(db, user, status)
+    start_user_expire(db, user)
 
-            else:
-                continue
+    report.status_change(username=user.username, status=status,
+                         user=UserResponse.model_validate(user), user_admin=user.admin)
 
-            update_user_status(db, user, status)
-            start_user_expire(db, user)
+    logger.info(f"User \"{user.username}\" status changed to {status}")
+
+
+def review():
+    now = datetime.utcnow()
+    with GetDB() as db:
+        user_ids = review_index.collect_due(db, now)
 
-            report.status_change(username=user.username, status=status,
-                                 user=UserResponse.model_validate(user), user_admin=user.admin)
+        for i in range(0, len(user_ids), REVIEW_CHUNK_SIZE):
+            for user in get_users(db, user_ids=user_ids[i:i + REVIEW_CHUNK_SIZE]):
+                if user.status == UserStatus.active:
+                    review_active_user(db, user, now)
+                elif user.status == UserStatus.on_hold:
+                    review_on_hold_user(db, user, now)
 
-            logger.info(f"User \"{user.username}\" status changed to {status}")
+                # reviewing may have changed the status or the expire date
+                review_index.schedule(user)
 
 
 scheduler.add_job(review, 'interval',
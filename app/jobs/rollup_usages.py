@@ -0,0 +1,22 @@
+from app import logger, scheduler
+from app.db import GetDB
+from app.db.usage import rollup_node_user_usages
+from config import (
+    JOB_ROLLUP_USAGES_INTERVAL,
+    NODE_USER_USAGE_DAILY_RETENTION_DAYS,
+    NODE_USER_USAGE_HOURLY_RETENTION_DAYS
+)
+
+
+def rollup_usages():
+    with GetDB() as db:
+        days, months = rollup_node_user_usages(
+            db, NODE_USER_USAGE_HOURLY_RETENTION_DAYS, NODE_USER_USAGE_DAILY_RETENTION_DAYS
+        )
+    if days or months:
+        logger.info(f"Node user usages rolled up: {days} day(s), {months} month(s)")
+
+
+if NODE_USER_USAGE_HOURLY_RETENTION_DAYS > 0:
+    scheduler.add_job(rollup_usages, 'interval', seconds=JOB_ROLLUP_USAGES_INTERVAL,
+                      coalesce=True, max_instances=1)
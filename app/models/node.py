@@ -11,6 +11,15 @@ class NodeStatus(str, Enum):
     disabled = "disabled"
 
 
+class NodeConnectionState(str, Enum):
+    queued = "queued"
+    connecting = "connecting"
+    restarting = "restarting"
+    started = "started"
+    skipped = "skipped"
+    failed = "failed"
+
+
 class NodeSettings(BaseModel):
     min_node_version: str = "v0.2.0"
     certificate: str
@@ -74,3 +83,25 @@ class NodeUsageResponse(BaseModel):
 
 class NodesUsageResponse(BaseModel):
     usages: List[NodeUsageResponse]
+
+
+class NodeOperationsStats(BaseModel):
+    node_id: Optional[int] = None
+    depth: int
+    processed: int
+    failed: int
+    coalesced: int
+    avg_latency: float
+    max_latency: float
+
+
+class NodeConnectionStats(BaseModel):
+    node_id: int
+    state: NodeConnectionState
+    attempts: int
+    last_error: Optional[str] = None
+    queued_at: Optional[float] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    duration: Optional[float] = None
+    next_attempt_at: Optional[float] = None
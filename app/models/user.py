@@ -4,7 +4,7 @@ from datetime import datetime
 from enum import Enum
 from typing import Dict, List, Optional, Union
 
-from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, computed_field, field_validator
 
 from app import xray
 from app.models.admin import Admin
@@ -286,30 +286,36 @@ class UserResponse(User):
     used_traffic: int
     lifetime_used_traffic: int = 0
     created_at: datetime
-    links: List[str] = []
-    subscription_url: str = ""
     proxies: dict
     excluded_inbounds: Dict[ProxyTypes, List[str]] = {}
 
     admin: Optional[Admin] = None
     model_config = ConfigDict(from_attributes=True)
 
-    @model_validator(mode="after")
-    def validate_links(self):
-        if not self.links:
-            self.links = generate_v2ray_links(
-                self.proxies, self.inbounds, extra_data=self.model_dump(), reverse=False,
+    _links: Optional[List[str]] = PrivateAttr(None)
+    _subscription_url: Optional[str] = PrivateAttr(None)
+
+    # share links and the signed subscription url are only built when read or serialized,
+    # most internal uses of a user never look at them
+    @computed_field
+    @property
+    def links(self) -> List[str]:
+        if self._links is None:
+            self._links = generate_v2ray_links(
+                self.proxies, self.inbounds, extra_data=self.model_dump(exclude={"links", "subscription_url"}),
+                reverse=False,
             )
-        return self
+        return self._links
 
-    @model_validator(mode="after")
-    def validate_subscription_url(self):
-        if not self.subscription_url:
+    @computed_field
+    @property
+    def subscription_url(self) -> str:
+        if self._subscription_url is None:
             salt = secrets.token_hex(8)
             url_prefix = (XRAY_SUBSCRIPTION_URL_PREFIX).replace('*', salt)
             token = create_subscription_token(self.username)
-            self.subscription_url = f"{url_prefix}/{XRAY_SUBSCRIPTION_PATH}/{token}"
-        return self
+            self._subscription_url = f"{url_prefix}/{XRAY_SUBSCRIPTION_PATH}/{token}"
+        return self._subscription_url
 
     @field_validator("proxies", mode="before")
     def validate_proxies(cls, v, values, **kwargs):
@@ -337,9 +343,26 @@ class SubscriptionUserResponse(UserResponse):
     model_config = ConfigDict(from_attributes=True)
 
 
+class UserProxies(BaseModel):
+    """Proxies and active inbounds of a user, all that xray operations need"""
+    proxies: Dict[ProxyTypes, ProxySettings]
+    inbounds: Dict[ProxyTypes, List[str]] = {}
+    model_config = ConfigDict(from_attributes=True)
+
+    @field_validator("proxies", mode="before")
+    def validate_proxies(cls, v):
+        if isinstance(v, list):
+            v = {p.type: p.settings for p in v}
+        return {
+            proxy_type: ProxySettings.from_dict(proxy_type, v.get(proxy_type, {}))
+            for proxy_type in v
+        }
+
+
 class UsersResponse(BaseModel):
     users: List[UserResponse]
     total: int
+    next_cursor: Optional[str] = None
 
 
 class UserUsageResponse(BaseModel):
@@ -6,6 +6,8 @@ from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import Optional, List
 
+from config import BALANCER_STRATEGY
+
 router = APIRouter(prefix="/api/balancer", tags=["Balancer"])
 
 # Lazy initialization
@@ -27,12 +29,17 @@ def get_proxy_manager():
     """Get or create proxy manager instance"""
     global _db, _proxy_manager
     
+    # share the running balancer's manager so that its pool sees changes right away
+    from app import balancer_server
+    if balancer_server is not None:
+        return balancer_server.manager
+    
     if _proxy_manager is None:
         from app.services.balancer import ProxyManager
         from app.services.balancer.database import BalancerDatabase
         
         _db = BalancerDatabase()
-        _proxy_manager = ProxyManager(_db)
+        _proxy_manager = ProxyManager(_db, strategy=BALANCER_STRATEGY)
     
     return _proxy_manager
 
@@ -46,6 +53,7 @@ class ProxyCreate(BaseModel):
     password: Optional[str] = None
     priority: int = 0
     maxConnections: int = 100
+    supportsUdp: bool = False
 
 
 class ProxyUpdate(BaseModel):
@@ -57,6 +65,7 @@ class ProxyUpdate(BaseModel):
     password: Optional[str] = None
     priority: Optional[int] = None
     maxConnections: Optional[int] = None
+    supportsUdp: Optional[bool] = None
 
 
 class ProxyToggle(BaseModel):
@@ -69,8 +78,9 @@ async def get_proxies():
     try:
         proxy_manager = get_proxy_manager()
         proxies = proxy_manager.get_all_proxies()
+        latencies = proxy_manager.get_latency_stats()
         # Convert to camelCase
-        return [snake_to_camel(proxy) for proxy in proxies]
+        return [snake_to_camel({**proxy, **latencies.get(proxy['id'], {})}) for proxy in proxies]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching proxies: {str(e)}")
 
@@ -88,7 +98,8 @@ async def add_proxy(proxy: ProxyCreate):
             username=proxy.username,
             password=proxy.password,
             priority=proxy.priority,
-            max_connections=proxy.maxConnections
+            max_connections=proxy.maxConnections,
+            supports_udp=proxy.supportsUdp
         )
         return {"id": proxy_id, "message": "Proxy added successfully"}
     except Exception as e:
@@ -105,6 +116,8 @@ async def update_proxy(proxy_id: int, proxy: ProxyUpdate):
         # Convert camelCase to snake_case
         if 'maxConnections' in updates:
             updates['max_connections'] = updates.pop('maxConnections')
+        if 'supportsUdp' in updates:
+            updates['supports_udp'] = 1 if updates.pop('supportsUdp') else 0
         
         success = proxy_manager.update_proxy(proxy_id, **updates)
         
@@ -184,3 +197,32 @@ async def get_stats():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching stats: {str(e)}")
 
+
+
+@router.get("/pool")
+async def get_pool():
+    """Получить состояние пула выбора прокси"""
+    try:
+        from app import balancer_server
+        
+        proxy_manager = get_proxy_manager()
+        upstreams = await balancer_server.snapshot(balancer_server.upstream.stats) if balancer_server else {}
+        return {
+            "strategy": proxy_manager.pool.strategy,
+            "proxies": [
+                snake_to_camel({**entry, "warm": upstreams.get(entry["id"])})
+                for entry in proxy_manager.pool.stats()
+            ]
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching pool: {str(e)}")
+
+
+@router.get("/udp/flows")
+async def get_udp_flows():
+    """Получить активные UDP потоки"""
+    from app import balancer_server
+    
+    if balancer_server is None:
+        return []
+    return [snake_to_camel(flow) for flow in await balancer_server.snapshot(balancer_server.udp_flow_stats)]
@@ -11,8 +11,10 @@ from app.db import Session, crud, get_db
 from app.dependencies import get_dbnode, validate_dates
 from app.models.admin import Admin
 from app.models.node import (
+    NodeConnectionStats,
     NodeCreate,
     NodeModify,
+    NodeOperationsStats,
     NodeResponse,
     NodeSettings,
     NodeStatus,
@@ -63,7 +65,7 @@ def add_node(
             status_code=409, detail=f'Node "{new_node.name}" already exists'
         )
 
-    bg.add_task(xray.operations.connect_node, node_id=dbnode.id)
+    bg.add_task(xray.operations.connect_node, node_id=dbnode.id, force=True)
     bg.add_task(add_host_if_needed, new_node, db)
 
     logger.info(f'New node "{dbnode.name}" added')
@@ -155,6 +157,18 @@ def get_nodes(
     return crud.get_nodes(db)
 
 
+@router.get("/nodes/operations", response_model=List[NodeOperationsStats])
+def get_nodes_operations(_: Admin = Depends(Admin.check_sudo_admin)):
+    """Retrieve queue depth, latency and failure counters of user operations per node."""
+    return xray.operations.user_operations.stats()
+
+
+@router.get("/nodes/connections", response_model=List[NodeConnectionStats])
+def get_nodes_connections(_: Admin = Depends(Admin.check_sudo_admin)):
+    """Retrieve the connect/restart state of each node, with attempt timings and backoff."""
+    return xray.operations.node_orchestrator.stats()
+
+
 @router.put("/node/{node_id}", response_model=NodeResponse)
 def modify_node(
     modified_node: NodeModify,
@@ -167,7 +181,7 @@ def modify_node(
     updated_node = crud.update_node(db, dbnode, modified_node)
     xray.operations.remove_node(updated_node.id)
     if updated_node.status != NodeStatus.disabled:
-        bg.add_task(xray.operations.connect_node, node_id=updated_node.id)
+        bg.add_task(xray.operations.connect_node, node_id=updated_node.id, force=True)
 
     logger.info(f'Node "{dbnode.name}" modified')
     return dbnode
@@ -180,7 +194,7 @@ def reconnect_node(
     _: Admin = Depends(Admin.check_sudo_admin),
 ):
     """Trigger a reconnection for the specified node. Only accessible to sudo admins."""
-    bg.add_task(xray.operations.connect_node, node_id=dbnode.id)
+    bg.add_task(xray.operations.connect_node, node_id=dbnode.id, force=True)
     return {"detail": "Reconnection task scheduled"}
 
 
@@ -193,6 +207,7 @@ def remove_node(
     """Delete a node and remove it from xray in the background."""
     crud.remove_node(db, dbnode)
     xray.operations.remove_node(dbnode.id)
+    xray.operations.node_orchestrator.forget(dbnode.id)
 
     logger.info(f'Node "{dbnode.name}" deleted')
     return {}
@@ -1,5 +1,6 @@
 import re
 from distutils.version import LooseVersion
+from typing import Optional, Tuple
 
 from fastapi import APIRouter, Depends, Header, Path, Request, Response
 from fastapi.responses import HTMLResponse
@@ -7,6 +8,8 @@ from fastapi.responses import HTMLResponse
 from app.db import Session, crud, get_db
 from app.dependencies import get_validated_sub, validate_dates
 from app.models.user import SubscriptionUserResponse, UserResponse
+from app.subscription.cache import RenderedSubscription, subscription_cache
+from app.subscription.compression import negotiate_encoding, worth_compressing
 from app.subscription.share import encode_title, generate_subscription
 from app.templates import render_template
 from config import (
@@ -45,98 +48,149 @@ def get_subscription_user_info(user: UserResponse) -> dict:
     }
 
 
-@router.get("/{token}/")
-@router.get("/{token}", include_in_schema=False)
-def user_subscription(
-    request: Request,
-    db: Session = Depends(get_db),
-    dbuser: UserResponse = Depends(get_validated_sub),
-    user_agent: str = Header(default="")
-):
-    """Provides a subscription link based on the user agent (Clash, V2Ray, etc.)."""
-    user: UserResponse = UserResponse.model_validate(dbuser)
-
-    accept_header = request.headers.get("Accept", "")
-    if "text/html" in accept_header:
-        return HTMLResponse(
-            render_template(
-                SUBSCRIPTION_PAGE_TEMPLATE,
-                {"user": user}
-            )
-        )
-
-    crud.update_user_sub(db, dbuser, user_agent)
-    response_headers = {
-        "content-disposition": f'attachment; filename="{user.username}"',
-        "profile-web-page-url": str(request.url),
-        "support-url": SUB_SUPPORT_URL,
-        "profile-title": encode_title(SUB_PROFILE_TITLE),
-        "profile-update-interval": SUB_UPDATE_INTERVAL,
-        "subscription-userinfo": "; ".join(
-            f"{key}={val}"
-            for key, val in get_subscription_user_info(user).items()
-        )
-    }
-
+def get_client_config(user_agent: str) -> dict:
+    """Pick the subscription format for a client based on its user agent."""
     if re.match(r'^([Cc]lash-verge|[Cc]lash[-\.]?[Mm]eta|[Ff][Ll][Cc]lash|[Mm]ihomo)', user_agent):
-        conf = generate_subscription(user=user, config_format="clash-meta", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="text/yaml", headers=response_headers)
+        return client_config["clash-meta"]
 
     elif re.match(r'^([Cc]lash|[Ss]tash)', user_agent):
-        conf = generate_subscription(user=user, config_format="clash", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="text/yaml", headers=response_headers)
+        return client_config["clash"]
 
     elif re.match(r'^(SFA|SFI|SFM|SFT|[Kk]aring|[Hh]iddify[Nn]ext)', user_agent):
-        conf = generate_subscription(user=user, config_format="sing-box", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="application/json", headers=response_headers)
+        return client_config["sing-box"]
 
     elif re.match(r'^(SS|SSR|SSD|SSS|Outline|Shadowsocks|SSconf)', user_agent):
-        conf = generate_subscription(user=user, config_format="outline", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="application/json", headers=response_headers)
+        return client_config["outline"]
 
     elif (USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_V2RAYN) and re.match(r'^v2rayN/(\d+\.\d+)', user_agent):
         version_str = re.match(r'^v2rayN/(\d+\.\d+)', user_agent).group(1)
         if LooseVersion(version_str) >= LooseVersion("6.40"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            return client_config["v2ray-json"]
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
+            return client_config["v2ray"]
 
     elif (USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_V2RAYNG) and re.match(r'^v2rayNG/(\d+\.\d+\.\d+)', user_agent):
         version_str = re.match(r'^v2rayNG/(\d+\.\d+\.\d+)', user_agent).group(1)
         if LooseVersion(version_str) >= LooseVersion("1.8.29"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            return client_config["v2ray-json"]
         elif LooseVersion(version_str) >= LooseVersion("1.8.18"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=True)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            return {**client_config["v2ray-json"], "reverse": True}
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
+            return client_config["v2ray"]
 
     elif re.match(r'^[Ss]treisand', user_agent):
         if USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_STREISAND:
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            return client_config["v2ray-json"]
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
+            return client_config["v2ray"]
 
     elif (USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_HAPP) and re.match(r'^Happ/(\d+\.\d+\.\d+)', user_agent):
         version_str = re.match(r'^Happ/(\d+\.\d+\.\d+)', user_agent).group(1)
         if LooseVersion(version_str) >= LooseVersion("1.63.1"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            return client_config["v2ray-json"]
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
+            return client_config["v2ray"]
 
+    else:
+        return client_config["v2ray"]
+
+
+def subscription_key(dbuser: UserResponse, config: dict) -> Tuple:
+    return subscription_cache.make_key(
+        dbuser,
+        config_format=config["config_format"],
+        as_base64=config["as_base64"],
+        reverse=config["reverse"],
+    )
+
+
+def render_subscription(dbuser: UserResponse, config: dict, key: Tuple) -> RenderedSubscription:
+    """Render the subscription body for the given client config, serving it from the cache when possible."""
+    return subscription_cache.get_or_render(
+        key,
+        render=lambda: generate_subscription(user=UserResponse.model_validate(dbuser),
+                                             config_format=config["config_format"],
+                                             as_base64=config["as_base64"],
+                                             reverse=config["reverse"]),
+    )
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """Whether the client already holds the body tagged `etag`, according to If-None-Match."""
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    # If-None-Match uses the weak comparison, W/ prefixes don't matter
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in tags or "*" in tags
+
+
+def subscription_headers(request: Request, user: UserResponse, key: Tuple) -> Tuple[dict, Optional[str]]:
+    """
+    Headers shared by the full and the 304 response of a subscription, and
+    the content coding the body is sent in.
+    """
+    headers = get_response_headers(request, user)
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+    etag = subscription_cache.etag(user, key)
+    # the tag is the same for every coding of the body, which only a weak tag allows
+    headers["etag"] = f'W/{etag}' if encoding is not None else etag
+    return headers, encoding
+
+
+def subscription_response(conf: RenderedSubscription, config: dict, headers: dict,
+                          encoding: Optional[str]) -> Response:
+    """Sends the subscription body in the negotiated content coding, small bodies go as is."""
+    if encoding is not None and worth_compressing(len(conf.body)):
+        headers["content-encoding"] = encoding
+    else:
+        encoding = None
+    return Response(content=conf.encode(encoding), media_type=config["media_type"], headers=headers)
 
 
-    else:
-        conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-        return Response(content=conf, media_type="text/plain", headers=response_headers)
+def get_response_headers(request: Request, user: UserResponse) -> dict:
+    return {
+        "vary": "accept-encoding",
+        "content-disposition": f'attachment; filename="{user.username}"',
+        "profile-web-page-url": str(request.url),
+        "support-url": SUB_SUPPORT_URL,
+        "profile-title": encode_title(SUB_PROFILE_TITLE),
+        "profile-update-interval": SUB_UPDATE_INTERVAL,
+        "subscription-userinfo": "; ".join(
+            f"{key}={val}"
+            for key, val in get_subscription_user_info(user).items()
+        )
+    }
+
+
+@router.get("/{token}/")
+@router.get("/{token}", include_in_schema=False)
+def user_subscription(
+    request: Request,
+    db: Session = Depends(get_db),
+    dbuser: UserResponse = Depends(get_validated_sub),
+    user_agent: str = Header(default="")
+):
+    """Provides a subscription link based on the user agent (Clash, V2Ray, etc.)."""
+    accept_header = request.headers.get("Accept", "")
+    if "text/html" in accept_header:
+        user: UserResponse = UserResponse.model_validate(dbuser)
+        return HTMLResponse(
+            render_template(
+                SUBSCRIPTION_PAGE_TEMPLATE,
+                {"user": user}
+            )
+        )
+
+    config = get_client_config(user_agent)
+    key = subscription_key(dbuser, config)
+    response_headers, encoding = subscription_headers(request, dbuser, key)
+    if is_not_modified(request, response_headers["etag"]):
+        return Response(status_code=304, headers=response_headers)
+
+    crud.update_user_sub(db, dbuser, user_agent)
+    conf = render_subscription(dbuser, config, key)
+    return subscription_response(conf, config, response_headers, encoding)
 
 
 @router.get("/{token}/info", response_model=SubscriptionUserResponse)
@@ -171,24 +225,12 @@ def user_subscription_with_client_type(
     user_agent: str = Header(default="")
 ):
     """Provides a subscription link based on the specified client type (e.g., Clash, V2Ray)."""
-    user: UserResponse = UserResponse.model_validate(dbuser)
-
-    response_headers = {
-        "content-disposition": f'attachment; filename="{user.username}"',
-        "profile-web-page-url": str(request.url),
-        "support-url": SUB_SUPPORT_URL,
-        "profile-title": encode_title(SUB_PROFILE_TITLE),
-        "profile-update-interval": SUB_UPDATE_INTERVAL,
-        "subscription-userinfo": "; ".join(
-            f"{key}={val}"
-            for key, val in get_subscription_user_info(user).items()
-        )
-    }
-
     config = client_config.get(client_type)
-    conf = generate_subscription(user=user,
-                                 config_format=config["config_format"],
-                                 as_base64=config["as_base64"],
-                                 reverse=config["reverse"])
+    key = subscription_key(dbuser, config)
+    response_headers, encoding = subscription_headers(request, dbuser, key)
+    if is_not_modified(request, response_headers["etag"]):
+        return Response(status_code=304, headers=response_headers)
+
+    conf = render_subscription(dbuser, config, key)
 
-    return Response(content=conf, media_type=config["media_type"], headers=response_headers)
+    return subscription_response(conf, config, response_headers, encoding)
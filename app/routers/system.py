@@ -6,8 +6,9 @@ from app import __version__, xray
 from app.db import Session, crud, get_db
 from app.models.admin import Admin
 from app.models.proxy import ProxyHost, ProxyInbound, ProxyTypes
-from app.models.system import SystemStats
+from app.models.system import SubscriptionCacheStats, SystemStats
 from app.models.user import UserStatus
+from app.subscription.cache import subscription_cache
 from app.utils import responses
 from app.utils.system import cpu_usage, memory_usage, realtime_bandwidth
 
@@ -63,6 +64,14 @@ def get_system_stats(
     )
 
 
+@router.get(
+    "/system/subscription-cache", response_model=SubscriptionCacheStats, responses={403: responses._403}
+)
+def get_subscription_cache_stats(admin: Admin = Depends(Admin.check_sudo_admin)):
+    """Retrieve hit/miss counters of the rendered subscription cache."""
+    return subscription_cache.stats()
+
+
 @router.get("/inbounds", response_model=Dict[ProxyTypes, List[ProxyInbound]])
 def get_inbounds(admin: Admin = Depends(Admin.get_current)):
     """Retrieve inbound configurations grouped by protocol."""
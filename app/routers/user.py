@@ -1,7 +1,9 @@
+import base64
+import json
 from datetime import datetime, timedelta, timezone
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Response
 from sqlalchemy.exc import IntegrityError
 
 from app import logger, xray
@@ -199,10 +201,32 @@ def revoke_user_subscription(
     return user
 
 
+def _encode_users_cursor(position: Tuple, sort: Optional[List[crud.UsersSortingOptions]]) -> str:
+    value, user_id = position
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    data = json.dumps([",".join(opt.name for opt in sort or []), value, user_id])
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def _decode_users_cursor(cursor: str, sort: Optional[List[crud.UsersSortingOptions]]) -> Tuple:
+    try:
+        sort_names, value, user_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if sort_names != ",".join(opt.name for opt in sort or []) or not isinstance(user_id, int):
+            raise ValueError
+        if sort and sort[0].name.lstrip("-") == "created_at" and value is not None:
+            value = datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, user_id
+
+
 @router.get("/users", response_model=UsersResponse, responses={400: responses._400, 403: responses._403, 404: responses._404})
 def get_users(
     offset: int = None,
     limit: int = None,
+    cursor: str = None,
+    fields: str = None,
     username: List[str] = Query(None),
     search: Union[str, None] = None,
     owner: Union[List[str], None] = Query(None, alias="admin"),
@@ -211,7 +235,16 @@ def get_users(
     db: Session = Depends(get_db),
     admin: Admin = Depends(Admin.get_current),
 ):
-    """Get all users"""
+    """
+    Get all users
+
+    - **cursor**: Keyset pagination, pass an empty value for the first page and then
+      `next_cursor` of the previous response. Can't be combined with `offset` and
+      supports a single sort option.
+    - **fields**: Comma separated user fields to return, `links` and `subscription_url`
+      are only generated when listed.
+    - **total** may lag behind by a few seconds.
+    """
     if sort is not None:
         opts = sort.strip(",").split(",")
         sort = []
@@ -223,19 +256,49 @@ def get_users(
                     status_code=400, detail=f'"{opt}" is not a valid sort option'
                 )
 
-    users, count = crud.get_users(
-        db=db,
-        offset=offset,
-        limit=limit,
-        search=search,
-        usernames=username,
-        status=status,
-        sort=sort,
-        admins=owner if admin.is_sudo else [admin.username],
-        return_with_count=True,
-    )
+    if fields is not None:
+        fields = set(filter(None, fields.split(",")))
+        unknown = fields - UserResponse.model_fields.keys() - UserResponse.model_computed_fields.keys()
+        if unknown:
+            raise HTTPException(status_code=400, detail=f'"{", ".join(sorted(unknown))}" not valid user fields')
 
-    return {"users": users, "total": count}
+    keyset = cursor is not None
+    if keyset and offset:
+        raise HTTPException(status_code=400, detail="cursor can't be combined with offset")
+
+    try:
+        users, count = crud.get_users(
+            db=db,
+            offset=offset,
+            limit=limit,
+            search=search,
+            usernames=username,
+            status=status,
+            sort=sort,
+            admins=owner if admin.is_sudo else [admin.username],
+            return_with_count=True,
+            keyset=keyset,
+            after=_decode_users_cursor(cursor, sort) if cursor else None,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    next_cursor = None
+    if keyset and limit and len(users) == limit:
+        next_cursor = _encode_users_cursor(crud.users_keyset_position(users[-1], sort), sort)
+
+    if fields is None:
+        return {"users": users, "total": count, "next_cursor": next_cursor}
+
+    response = UsersResponse(
+        users=[UserResponse.model_validate(dbuser) for dbuser in users],
+        total=count,
+        next_cursor=next_cursor,
+    )
+    return Response(
+        content=response.model_dump_json(include={"users": {"__all__": fields}, "total": True, "next_cursor": True}),
+        media_type="application/json",
+    )
 
 
 @router.post("/users/reset", responses={403: responses._403, 404: responses._404})
@@ -78,15 +78,16 @@ class BalancerDatabase:
     
     def add_proxy(self, name: str, host: str, port: int, protocol: str = 'socks5',
                   username: Optional[str] = None, password: Optional[str] = None,
-                  priority: int = 0, max_connections: int = 100) -> int:
+                  priority: int = 0, max_connections: int = 100, supports_udp: bool = False) -> int:
         """Add new proxy"""
         conn = self.get_conn()
         cursor = conn.cursor()
         
         cursor.execute('''
-            INSERT INTO proxies (name, host, port, protocol, username, password, priority, max_connections)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (name, host, port, protocol, username, password, priority, max_connections))
+            INSERT INTO proxies (name, host, port, protocol, username, password, priority, max_connections,
+                                 supports_udp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (name, host, port, protocol, username, password, priority, max_connections, 1 if supports_udp else 0))
         
         proxy_id = cursor.lastrowid
         
@@ -153,7 +154,7 @@ class BalancerDatabase:
         cursor = conn.cursor()
         
         allowed_fields = ['name', 'host', 'port', 'protocol', 'username', 'password', 
-                         'enabled', 'priority', 'max_connections']
+                         'enabled', 'priority', 'max_connections', 'supports_udp']
         
         updates = []
         values = []
@@ -222,6 +223,61 @@ class BalancerDatabase:
         conn.commit()
         return cursor.rowcount > 0
     
+    def get_proxies(self, proxy_ids: List[int]) -> List[Dict]:
+        """Get proxies by IDs"""
+        if not proxy_ids:
+            return []
+        
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            SELECT p.*, s.total_connections, s.active_connections, s.successful_connections,
+                   s.failed_connections, s.avg_response_time, s.is_healthy,
+                   s.consecutive_failures, s.in_slow_check_mode, s.last_check
+            FROM proxies p
+            LEFT JOIN proxy_stats s ON p.id = s.proxy_id
+            WHERE p.id IN ({', '.join('?' * len(proxy_ids))})
+        ''', list(proxy_ids))
+        
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def update_health_batch(self, rows: List[tuple]) -> None:
+        """Store health check results in one transaction
+        
+        Rows are (is_healthy, avg_response_time, last_check, consecutive_failures, in_slow_check_mode, proxy_id)
+        """
+        conn = self.get_conn()
+        
+        with conn:
+            conn.executemany('''
+                UPDATE proxy_stats
+                SET is_healthy = ?,
+                    avg_response_time = ?,
+                    last_check = ?,
+                    consecutive_failures = ?,
+                    in_slow_check_mode = ?
+                WHERE proxy_id = ?
+            ''', rows)
+    
+    def add_counters_batch(self, rows: List[tuple]) -> None:
+        """Add connection and traffic counters of many proxies in one transaction
+        
+        Rows are (successful_connections, failed_connections, bytes_sent, bytes_received, proxy_id)
+        """
+        conn = self.get_conn()
+        
+        with conn:
+            conn.executemany('''
+                UPDATE proxy_stats
+                SET total_connections = total_connections + ?1 + ?2,
+                    successful_connections = successful_connections + ?1,
+                    failed_connections = failed_connections + ?2,
+                    total_bytes_sent = total_bytes_sent + ?3,
+                    total_bytes_received = total_bytes_received + ?4
+                WHERE proxy_id = ?5
+            ''', rows)
+    
     def get_statistics(self) -> Dict:
         """Get overall statistics"""
         conn = self.get_conn()
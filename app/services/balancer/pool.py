@@ -0,0 +1,423 @@
+"""
+Proxy Pool
+In-memory snapshot of upstream proxies and selection strategies
+"""
+import bisect
+import hashlib
+import heapq
+import itertools
+import random
+import threading
+from collections import deque
+from math import ceil, gcd
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+STRATEGIES = ('weighted', 'least_connections', 'ewma', 'hash')
+
+DEFAULT_LATENCY = 1000.0  # ms, used until a proxy has been measured
+EWMA_ALPHA = 0.3
+HASH_REPLICAS = 100
+LATENCY_WINDOW = 100  # last results kept per proxy for percentiles and loss rate
+EWMA_SAMPLE_DRAWS = 8  # random picks spent finding two proxies with free slots before scanning
+
+
+class LatencyWindow:
+    """Rolling window of probe and connect results of a proxy"""
+
+    __slots__ = ('_samples', '_results', '_successes', '_sorted')
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=size)
+        self._results = deque(maxlen=size)
+        self._successes = 0  # running count of True in _results
+        self._sorted: Optional[List[float]] = None
+
+    def add(self, latency: Optional[float]):
+        """Add a latency in ms, None for a failed attempt"""
+        if len(self._results) == self._results.maxlen:
+            self._successes -= self._results[0]
+        self._results.append(latency is not None)
+        self._successes += latency is not None
+        if latency is not None:
+            self._samples.append(latency)
+            self._sorted = None
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+        return self._sorted[max(ceil(q / 100 * len(self._sorted)) - 1, 0)]
+
+    @property
+    def loss_rate(self) -> float:
+        if not self._results:
+            return 0.0
+        return 1 - self._successes / len(self._results)
+
+    def summary(self) -> Dict:
+        return {
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'loss_rate': round(self.loss_rate, 3),
+        }
+
+
+class ConnectionCounters:
+    """Connection results and relayed bytes of a proxy not written to the database yet"""
+
+    __slots__ = ('successes', 'failures', 'sent', 'received')
+
+    def __init__(self):
+        self.successes = self.failures = self.sent = self.received = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.successes or self.failures or self.sent or self.received)
+
+    def take(self) -> Tuple[int, int, int, int]:
+        counts = (self.successes, self.failures, self.sent, self.received)
+        self.successes = self.failures = self.sent = self.received = 0
+        return counts
+
+
+class PoolEntry:
+    """Selection state of a single proxy"""
+
+    __slots__ = ('proxy', 'id', 'weight', 'max_connections', 'supports_udp', 'healthy', 'latency', 'active',
+                 'window', 'counters')
+
+    def __init__(self, proxy: Dict, active: int = 0, latency: Optional[float] = None,
+                 window: Optional[LatencyWindow] = None, counters: Optional[ConnectionCounters] = None):
+        self.proxy = proxy
+        self.id = proxy['id']
+        self.weight = max(proxy.get('priority') or 0, 0) + 1
+        self.max_connections = proxy.get('max_connections') or 0
+        self.supports_udp = bool(proxy.get('supports_udp'))
+        self.healthy = proxy.get('is_healthy') is None or bool(proxy.get('is_healthy'))
+        if latency is None:
+            latency = proxy.get('avg_response_time') or DEFAULT_LATENCY
+        self.latency = float(latency)
+        self.active = active
+        self.window = window or LatencyWindow()
+        self.counters = counters or ConnectionCounters()
+
+    @property
+    def full(self) -> bool:
+        return bool(self.max_connections) and self.active >= self.max_connections
+
+
+class ProxyPool:
+    """
+    Snapshot of enabled proxies used to pick an upstream without touching the database.
+
+    The snapshot is rebuilt from `get_all_proxies` rows when proxies change,
+    health checks only flip flags and latencies in place. The round-robin
+    schedule and the hash ring cover every enabled proxy and skip unhealthy
+    ones while they are walked, so a health flip doesn't regenerate them.
+    Active connection counts, latency averages and unwritten connection
+    counters survive rebuilds.
+    """
+
+    def __init__(self, strategy: str = 'weighted'):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown balancing strategy: {strategy}")
+        self.strategy = strategy
+        self._lock = threading.Lock()
+        self._entries: Dict[int, PoolEntry] = {}
+        self._enabled: List[PoolEntry] = []
+        # unordered, an entry leaving it is swapped with the last one
+        self._healthy: List[PoolEntry] = []
+        self._healthy_index: Dict[int, int] = {}
+        self._udp_entries: List[PoolEntry] = []
+        self._udp_healthy = 0
+        self._schedule: List[PoolEntry] = []
+        self._cursor = itertools.count()
+        self._heap: List = []
+        self._seq = itertools.count()
+        self._ring: List[int] = []
+        self._ring_entries: List[PoolEntry] = []
+        self._remove_listeners: List[Callable[[Set[int]], None]] = []
+        # counters of proxies no longer in the pool, kept until they are taken
+        self._detached: Dict[int, ConnectionCounters] = {}
+        self.loaded = False
+
+    def on_remove(self, listener: Callable[[Set[int]], None]):
+        """Call `listener` with the ids of proxies a refresh removed or disabled, outside the lock"""
+        self._remove_listeners.append(listener)
+
+    def refresh(self, proxies: List[Dict]):
+        """Rebuild the snapshot from database rows"""
+        with self._lock:
+            entries = {}
+            for proxy in proxies:
+                if not proxy.get('enabled'):
+                    continue
+                old = self._entries.get(proxy['id'])
+                entries[proxy['id']] = PoolEntry(
+                    proxy,
+                    active=old.active if old else 0,
+                    latency=old.latency if old else None,
+                    window=old.window if old else None,
+                    counters=old.counters if old else self._detached.pop(proxy['id'], None)
+                )
+            removed = set(self._entries) - set(entries)
+            for proxy_id in removed:
+                if self._entries[proxy_id].counters:
+                    self._detached[proxy_id] = self._entries[proxy_id].counters
+            self._entries = entries
+            self._rebuild()
+            self.loaded = True
+
+        if removed:
+            for listener in self._remove_listeners:
+                listener(removed)
+
+    def update_health(self, proxy_id: int, healthy: bool, latency: Optional[float] = None):
+        """Apply a health check result"""
+        with self._lock:
+            entry = self._entries.get(proxy_id)
+            if not entry:
+                return
+            self._observe(entry, latency if healthy else None)
+            if entry.healthy != healthy:
+                self._set_healthy(entry, healthy)
+
+    def observe(self, proxy_id: int, latency: Optional[float]):
+        """Record a connect latency in ms, or None for a failed connect"""
+        with self._lock:
+            entry = self._entries.get(proxy_id)
+            if entry:
+                self._observe(entry, latency)
+
+    def record_connection(self, proxy_id: int, success: bool):
+        """Count a connection attempt, a failed one is also observed as a loss"""
+        with self._lock:
+            entry = self._entries.get(proxy_id)
+            if entry and not success:
+                self._observe(entry, None)
+            counters = self._counters(proxy_id)
+            if success:
+                counters.successes += 1
+            else:
+                counters.failures += 1
+
+    def record_traffic(self, proxy_id: int, sent: int, received: int):
+        """Count bytes relayed through a proxy"""
+        with self._lock:
+            counters = self._counters(proxy_id)
+            counters.sent += sent
+            counters.received += received
+
+    def take_counters(self) -> List[Tuple[int, int, int, int, int]]:
+        """Pending counters as (successes, failures, sent, received, proxy_id) rows, resets them"""
+        with self._lock:
+            rows = [(*entry.counters.take(), proxy_id)
+                    for proxy_id, entry in self._entries.items() if entry.counters]
+            rows.extend((*counters.take(), proxy_id) for proxy_id, counters in self._detached.items() if counters)
+            self._detached.clear()
+        return rows
+
+    def restore_counters(self, rows: List[Tuple[int, int, int, int, int]]):
+        """Add back rows of `take_counters` that could not be written"""
+        with self._lock:
+            for successes, failures, sent, received, proxy_id in rows:
+                counters = self._counters(proxy_id)
+                counters.successes += successes
+                counters.failures += failures
+                counters.sent += sent
+                counters.received += received
+
+    def _counters(self, proxy_id: int) -> ConnectionCounters:
+        entry = self._entries.get(proxy_id)
+        if entry:
+            return entry.counters
+        # a connection that outlived its proxy in the pool
+        return self._detached.setdefault(proxy_id, ConnectionCounters())
+
+    @staticmethod
+    def _observe(entry: PoolEntry, latency: Optional[float]):
+        entry.window.add(latency)
+        if latency is not None:
+            entry.latency += EWMA_ALPHA * (latency - entry.latency)
+
+    @property
+    def _candidates(self) -> List[PoolEntry]:
+        # same fallback as before: any enabled proxy when none is healthy
+        return self._healthy or self._enabled
+
+    def _is_candidate(self, entry: PoolEntry) -> bool:
+        return entry.healthy or not self._healthy
+
+    def _set_healthy(self, entry: PoolEntry, healthy: bool):
+        fallback = not self._healthy
+        entry.healthy = healthy
+        if healthy:
+            self._healthy_index[entry.id] = len(self._healthy)
+            self._healthy.append(entry)
+        else:
+            index = self._healthy_index.pop(entry.id)
+            last = self._healthy.pop()
+            if last is not entry:
+                self._healthy[index] = last
+                self._healthy_index[last.id] = index
+        if entry.supports_udp:
+            self._udp_healthy += 1 if healthy else -1
+
+        if self.strategy == 'least_connections':
+            if fallback != (not self._healthy):
+                # candidates switched between the healthy proxies and all of them
+                self._rebuild_heap()
+            elif healthy:
+                heapq.heappush(self._heap, (entry.active, next(self._seq), entry))
+
+    def _rebuild(self):
+        entries = sorted(self._entries.values(), key=lambda e: e.id)
+        self._enabled = entries
+        self._healthy = [e for e in entries if e.healthy]
+        self._healthy_index = {e.id: i for i, e in enumerate(self._healthy)}
+        self._udp_entries = [e for e in entries if e.supports_udp]
+        self._udp_healthy = sum(e.healthy for e in self._udp_entries)
+
+        # smooth weighted round-robin, flattened into a schedule once per rebuild
+        self._schedule = []
+        if entries:
+            divisor = 0
+            for e in entries:
+                divisor = gcd(divisor, e.weight)
+            weights = [e.weight // divisor for e in entries]
+            total = sum(weights)
+            current = [0] * len(weights)
+            for _ in range(total):
+                for i, w in enumerate(weights):
+                    current[i] += w
+                best = max(range(len(current)), key=current.__getitem__)
+                current[best] -= total
+                self._schedule.append(entries[best])
+
+        self._rebuild_heap()
+
+        ring = []
+        for e in entries:
+            for i in range(HASH_REPLICAS):
+                digest = hashlib.md5(f"{e.id}-{i}".encode()).digest()
+                ring.append((int.from_bytes(digest[:8], 'big'), e))
+        ring.sort(key=lambda point: point[0])
+        self._ring = [point for point, _ in ring]
+        self._ring_entries = [e for _, e in ring]
+
+    def _rebuild_heap(self):
+        self._heap = [(e.active, next(self._seq), e) for e in self._candidates]
+        heapq.heapify(self._heap)
+
+    def select(self, client_ip: Optional[str] = None, udp: bool = False) -> Optional[Dict]:
+        """Pick a proxy and count a connection on it, the caller must `release` it"""
+        with self._lock:
+            if not self._enabled:
+                return None
+
+            if udp:
+                # few upstreams relay UDP, the least loaded one of them is used
+                available = [e for e in self._udp_entries
+                             if not e.full and (e.healthy or not self._udp_healthy)]
+                entry = min(available, key=lambda e: e.active) if available else None
+            elif self.strategy == 'least_connections':
+                entry = self._select_least_connections()
+            elif self.strategy == 'ewma':
+                entry = self._select_ewma()
+            elif self.strategy == 'hash' and client_ip:
+                entry = self._select_hash(client_ip)
+            else:
+                entry = self._select_weighted()
+
+            if entry is None:
+                return None
+
+            self._set_active(entry, entry.active + 1)
+            return entry.proxy
+
+    def release(self, proxy_id: int):
+        with self._lock:
+            entry = self._entries.get(proxy_id)
+            if entry and entry.active > 0:
+                self._set_active(entry, entry.active - 1)
+
+    def _set_active(self, entry: PoolEntry, active: int):
+        entry.active = active
+        if self.strategy == 'least_connections' and self._is_candidate(entry):
+            if len(self._heap) > 4 * len(self._candidates) + 64:
+                self._rebuild_heap()
+            else:
+                heapq.heappush(self._heap, (active, next(self._seq), entry))
+
+    def _select_weighted(self) -> Optional[PoolEntry]:
+        size = len(self._schedule)
+        start = next(self._cursor)
+        for i in range(size):
+            entry = self._schedule[(start + i) % size]
+            if not entry.full and self._is_candidate(entry):
+                return entry
+        return None
+
+    def _select_least_connections(self) -> Optional[PoolEntry]:
+        # stale heap items are dropped lazily, each entry has one current item
+        while self._heap:
+            active, _, entry = self._heap[0]
+            if active != entry.active or not self._is_candidate(entry) \
+                    or self._entries.get(entry.id) is not entry:
+                heapq.heappop(self._heap)
+                continue
+            if not entry.full:
+                return entry
+            break
+
+        # the least loaded one is at its limit, others may still have room
+        available = [e for e in self._candidates if not e.full]
+        return min(available, key=lambda e: e.active) if available else None
+
+    def _select_ewma(self) -> Optional[PoolEntry]:
+        # power of two choices among proxies with free slots, a full pick is drawn again
+        candidates = self._candidates
+        size = len(candidates)
+        first = second = None
+        for _ in range(EWMA_SAMPLE_DRAWS):
+            entry = candidates[random.randrange(size)]
+            if entry.full or entry is first:
+                continue
+            if first is None:
+                first = entry
+            else:
+                second = entry
+                break
+
+        if first is None:
+            # nearly every proxy is at its limit, the ones left are found by a scan
+            available = [e for e in candidates if not e.full]
+            return min(available, key=self._ewma_cost) if available else None
+        if second is None:
+            return first
+        return first if self._ewma_cost(first) <= self._ewma_cost(second) else second
+
+    @staticmethod
+    def _ewma_cost(entry: PoolEntry) -> float:
+        # rank by tail latency rather than the average, losses make a proxy look slower
+        latency = max(entry.latency, entry.window.percentile(95) or 0)
+        return latency * (entry.active + 1) / max(1 - entry.window.loss_rate, 0.01)
+
+    def _select_hash(self, client_ip: str) -> Optional[PoolEntry]:
+        point = int.from_bytes(hashlib.md5(client_ip.encode()).digest()[:8], 'big')
+        size = len(self._ring)
+        start = bisect.bisect(self._ring, point)
+        for i in range(size):
+            entry = self._ring_entries[(start + i) % size]
+            if not entry.full and self._is_candidate(entry):
+                return entry
+        return None
+
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {'id': e.id, 'healthy': e.healthy, 'active': e.active, 'latency': round(e.latency, 1),
+                 **e.window.summary()}
+                for e in self._entries.values()
+            ]
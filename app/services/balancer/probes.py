@@ -0,0 +1,156 @@
+"""
+Protocol probes
+Проверка upstream прокси на уровне протокола (Shadowsocks AEAD, VLESS)
+
+Both probes ask the upstream to open PROBE_TARGET and send a DNS query over
+TCP through it, so a success means the credentials were accepted and the
+upstream could reach the target. Credentials come from the proxy row:
+
+- shadowsocks: cipher in `username` (aes-128-gcm, aes-256-gcm or
+  chacha20-ietf-poly1305), password in `password`
+- vless: client UUID in `username` (or `password`), plain TCP transport
+"""
+import asyncio
+import hashlib
+import ipaddress
+import os
+import struct
+import uuid
+from typing import Dict, Tuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from .socks5 import encode_address
+
+PROBE_TARGET = ('8.8.8.8', 53)
+
+# A query for example.com prefixed with its length, as DNS over TCP expects
+DNS_QUERY = bytes.fromhex('0000' '0100' '0001' '0000' '0000' '0000') \
+    + b'\x07example\x03com\x00' + b'\x00\x01\x00\x01'
+DNS_QUERY = struct.pack('!H', len(DNS_QUERY)) + DNS_QUERY
+
+SS_CIPHERS = {
+    'aes-128-gcm': (16, AESGCM),
+    'aes-256-gcm': (32, AESGCM),
+    'chacha20-ietf-poly1305': (32, ChaCha20Poly1305),
+}
+SS_TAG_SIZE = 16
+
+
+class ProbeError(Exception):
+    pass
+
+
+def _ss_master_key(password: str, key_size: int) -> bytes:
+    """EVP_BytesToKey with MD5, as every shadowsocks implementation does it"""
+    key = b''
+    block = b''
+    while len(key) < key_size:
+        block = hashlib.md5(block + password.encode()).digest()
+        key += block
+    return key[:key_size]
+
+
+class _SSCipher:
+    """One direction of a shadowsocks AEAD stream"""
+
+    def __init__(self, cipher: str, password: str, salt: bytes):
+        key_size, aead = SS_CIPHERS[cipher]
+        subkey = HKDF(algorithm=hashes.SHA1(), length=key_size, salt=salt, info=b'ss-subkey') \
+            .derive(_ss_master_key(password, key_size))
+        self._aead = aead(subkey)
+        self._nonce = 0
+
+    def _next_nonce(self) -> bytes:
+        nonce = self._nonce.to_bytes(12, 'little')
+        self._nonce += 1
+        return nonce
+
+    def encrypt_chunk(self, payload: bytes) -> bytes:
+        length = self._aead.encrypt(self._next_nonce(), struct.pack('!H', len(payload)), None)
+        return length + self._aead.encrypt(self._next_nonce(), payload, None)
+
+    def decrypt(self, data: bytes) -> bytes:
+        return self._aead.decrypt(self._next_nonce(), data, None)
+
+
+def _ss_credentials(proxy: Dict) -> Tuple[str, str]:
+    cipher = (proxy.get('username') or 'chacha20-ietf-poly1305').lower()
+    if cipher not in SS_CIPHERS:
+        raise ProbeError(f"Unsupported shadowsocks cipher: {cipher}")
+    if not proxy.get('password'):
+        raise ProbeError("Shadowsocks password not provided")
+    return cipher, proxy['password']
+
+
+async def probe_shadowsocks(proxy: Dict, target: Tuple[str, int] = PROBE_TARGET):
+    cipher, password = _ss_credentials(proxy)
+    key_size = SS_CIPHERS[cipher][0]
+
+    reader, writer = await asyncio.open_connection(proxy['host'], proxy['port'])
+    try:
+        salt = os.urandom(key_size)
+        request = _SSCipher(cipher, password, salt).encrypt_chunk(encode_address(*target) + DNS_QUERY)
+        writer.write(salt + request)
+        await writer.drain()
+
+        try:
+            response_salt = await reader.readexactly(key_size)
+            decryptor = _SSCipher(cipher, password, response_salt)
+            length = struct.unpack('!H', decryptor.decrypt(await reader.readexactly(2 + SS_TAG_SIZE)))[0]
+            decryptor.decrypt(await reader.readexactly(length + SS_TAG_SIZE))
+        except asyncio.IncompleteReadError:
+            raise ProbeError("Shadowsocks upstream closed the connection (wrong cipher/password or target unreachable)")
+        except InvalidTag:
+            raise ProbeError("Shadowsocks response could not be decrypted")
+    finally:
+        writer.close()
+
+
+def _vless_id(proxy: Dict) -> bytes:
+    value = proxy.get('username') or proxy.get('password')
+    try:
+        return uuid.UUID(value).bytes
+    except (TypeError, ValueError):
+        raise ProbeError("VLESS UUID not provided")
+
+
+def _vless_address(host: str, port: int) -> bytes:
+    """PORT ATYP ADDR, VLESS numbers address types 1=IPv4, 2=domain, 3=IPv6"""
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        return struct.pack('!H', port) + bytes([2, len(host)]) + host.encode()
+    return struct.pack('!H', port) + bytes([1 if ip.version == 4 else 3]) + ip.packed
+
+
+async def probe_vless(proxy: Dict, target: Tuple[str, int] = PROBE_TARGET):
+    client_id = _vless_id(proxy)
+    host, port = target
+
+    reader, writer = await asyncio.open_connection(proxy['host'], proxy['port'])
+    try:
+        # VER UUID ADDONS_LEN CMD(1=tcp) PORT ATYP ADDR, followed by the payload
+        request = b'\x00' + client_id + b'\x00' + b'\x01' + _vless_address(host, port)
+        writer.write(request + DNS_QUERY)
+        await writer.drain()
+
+        try:
+            version, addons_length = await reader.readexactly(2)
+            if version != 0:
+                raise ProbeError(f"Unexpected VLESS response version: {version}")
+            await reader.readexactly(addons_length)
+            await reader.readexactly(2)  # length of the DNS answer
+        except asyncio.IncompleteReadError:
+            raise ProbeError("VLESS upstream closed the connection (wrong UUID or target unreachable)")
+    finally:
+        writer.close()
+
+
+PROBES = {
+    'shadowsocks': probe_shadowsocks,
+    'vless': probe_vless,
+}
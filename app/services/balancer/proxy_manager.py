@@ -3,18 +3,34 @@ Proxy Manager
 Управление прокси серверами
 """
 import asyncio
+import heapq
+import random
 import time
 import httpx
-from typing import Dict, List, Optional
-from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
 from .database import BalancerDatabase
+from .pool import ProxyPool
+from .probes import PROBES
+
+FAST_CHECK_INTERVAL = 10  # seconds
+SLOW_CHECK_INTERVAL = 600  # seconds, after 5 failed checks in a row
+CHECK_JITTER = 0.1
+CHECK_BATCH_WINDOW = 1.0  # seconds, checks due this close together run in the same round
+POOL_REFRESH_INTERVAL = 5
+COUNTERS_FLUSH_INTERVAL = 5  # seconds, connection and traffic counters are written this often
 
 
 class ProxyManager:
-    def __init__(self, db: BalancerDatabase):
+    def __init__(self, db: BalancerDatabase, strategy: str = 'weighted', check_concurrency: int = 50):
         self.db = db
+        self.pool = ProxyPool(strategy)
         self.auto_check_task = None
         self._stop_event = None
+        self.check_concurrency = check_concurrency
+        self._health: Dict[int, Tuple[int, int]] = {}
+        self._heap: List[Tuple[float, int]] = []
+        self._deadlines: Dict[int, float] = {}
     
     async def start_auto_check(self):
         """Запуск фоновой проверки прокси"""
@@ -30,51 +46,90 @@ class ProxyManager:
                 await self.auto_check_task
             except asyncio.CancelledError:
                 pass
+        await asyncio.get_running_loop().run_in_executor(None, self.flush_counters)
+    
+    def _check_interval(self, proxy_id: int) -> float:
+        _, in_slow_mode = self._health.get(proxy_id, (0, 0))
+        return SLOW_CHECK_INTERVAL if in_slow_mode else FAST_CHECK_INTERVAL
+    
+    def _jittered(self, interval: float) -> float:
+        return interval * random.uniform(1 - CHECK_JITTER, 1 + CHECK_JITTER)
+    
+    def _sync_schedule(self, proxies: List[Dict]):
+        """Schedule new proxies, forget removed and disabled ones"""
+        now = time.monotonic()
+        enabled = {p['id']: p for p in proxies if p['enabled']}
+        
+        for proxy_id in list(self._deadlines):
+            if proxy_id not in enabled:
+                del self._deadlines[proxy_id]
+        
+        for proxy_id, proxy in enabled.items():
+            if proxy_id in self._deadlines:
+                continue
+            
+            self._health[proxy_id] = (proxy.get('consecutive_failures') or 0, proxy.get('in_slow_check_mode') or 0)
+            interval = self._check_interval(proxy_id)
+            # continue from the last check, spread never checked and overdue ones over one fast interval
+            due = now + random.uniform(0, FAST_CHECK_INTERVAL)
+            if proxy.get('last_check'):
+                elapsed = (datetime.now() - datetime.fromisoformat(proxy['last_check'])).total_seconds()
+                if elapsed < interval:
+                    due = now + interval - elapsed
+            self._deadlines[proxy_id] = due
+            heapq.heappush(self._heap, (due, proxy_id))
+    
+    def _pop_due(self) -> List[int]:
+        until = time.monotonic() + CHECK_BATCH_WINDOW
+        due = []
+        while self._heap and self._heap[0][0] <= until:
+            deadline, proxy_id = heapq.heappop(self._heap)
+            # stale entries of removed or re-scheduled proxies
+            if self._deadlines.get(proxy_id) == deadline:
+                due.append(proxy_id)
+        return due
     
     async def _auto_check_loop(self):
         """Цикл автоматической проверки прокси"""
+        self._heap = []
+        self._deadlines = {}
+        refreshed_at = 0.0
+        flushed_at = time.monotonic()
+        
         while not self._stop_event.is_set():
             try:
-                proxies = self.db.get_all_proxies()
-                now = datetime.now()
+                if time.monotonic() - refreshed_at >= POOL_REFRESH_INTERVAL:
+                    proxies = self.db.get_all_proxies()
+                    self.pool.refresh(proxies)
+                    self._sync_schedule(proxies)
+                    refreshed_at = time.monotonic()
                 
-                for proxy in proxies:
-                    if not proxy['enabled']:
-                        continue
-                    
-                    # Получаем статистику
-                    conn = self.db.get_conn()
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        SELECT last_check, in_slow_check_mode
-                        FROM proxy_stats
-                        WHERE proxy_id = ?
-                    ''', (proxy['id'],))
-                    stats = cursor.fetchone()
-                    
-                    if not stats:
-                        continue
-                    
-                    last_check_str = stats['last_check']
-                    in_slow_mode = stats['in_slow_check_mode']
-                    
-                    # Определяем интервал проверки
-                    check_interval = timedelta(minutes=10) if in_slow_mode else timedelta(seconds=10)
-                    
-                    # Если last_check == None или прошло достаточно времени
-                    should_check = False
-                    if not last_check_str:
-                        should_check = True
-                    else:
-                        last_check = datetime.fromisoformat(last_check_str)
-                        if now - last_check >= check_interval:
-                            should_check = True
+                if time.monotonic() - flushed_at >= COUNTERS_FLUSH_INTERVAL:
+                    flushed_at = time.monotonic()
+                    # one executemany off the event loop instead of a commit per connection on it
+                    await asyncio.get_running_loop().run_in_executor(None, self.flush_counters)
+                
+                due = self._pop_due()
+                if due:
+                    proxies = {p['id']: p for p in self.db.get_proxies(due)}
+                    results = await self._probe_many([proxies[i] for i in due if i in proxies])
+                    self._save_results(results)
                     
-                    if should_check:
-                        await self.test_proxy(proxy['id'])
+                    now = time.monotonic()
+                    for proxy_id in due:
+                        if proxy_id in self._deadlines:
+                            deadline = now + self._jittered(self._check_interval(proxy_id))
+                            self._deadlines[proxy_id] = deadline
+                            heapq.heappush(self._heap, (deadline, proxy_id))
                 
-                # Ждем 5 секунд перед следующей итерацией
-                await asyncio.sleep(5)
+                # Ждем ближайшего срока проверки, но не дольше интервала обновления пула
+                wait = POOL_REFRESH_INTERVAL
+                if self._heap:
+                    wait = min(wait, max(self._heap[0][0] - time.monotonic(), CHECK_BATCH_WINDOW / 2))
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
                 
             except asyncio.CancelledError:
                 break
@@ -82,12 +137,31 @@ class ProxyManager:
                 print(f"Auto-check error: {e}")
                 await asyncio.sleep(5)
     
+    async def _probe_many(self, proxies: List[Dict]) -> List[Tuple[int, Dict]]:
+        """Probe proxies concurrently, at most check_concurrency at a time"""
+        semaphore = asyncio.Semaphore(self.check_concurrency)
+        
+        async def probe(proxy):
+            async with semaphore:
+                return proxy['id'], await self._probe(proxy)
+        
+        return await asyncio.gather(*(probe(proxy) for proxy in proxies))
+    
     async def test_proxy(self, proxy_id: int) -> Dict:
-        """Test proxy with protocol-specific checks for accurate measurement"""
+        """Test proxy and store the result"""
         proxy = self.db.get_proxy(proxy_id)
         if not proxy:
             return {"success": False, "error": "Proxy not found"}
         
+        if proxy_id not in self._health:
+            self._health[proxy_id] = (proxy.get('consecutive_failures') or 0, proxy.get('in_slow_check_mode') or 0)
+        
+        result = await self._probe(proxy)
+        self._save_results([(proxy_id, result)])
+        return result
+    
+    async def _probe(self, proxy: Dict) -> Dict:
+        """Test proxy with protocol-specific checks for accurate measurement"""
         protocol = proxy.get('protocol', 'socks5')
         success = False
         error = None
@@ -189,9 +263,17 @@ class ProxyManager:
                 writer.close()
                 await writer.wait_closed()
                 
+            elif protocol in PROBES:
+                # Shadowsocks/VLESS - protocol handshake and a request through the upstream
+                start_time = time.time()
+                
+                await asyncio.wait_for(PROBES[protocol](proxy), timeout=5.0)
+                
+                response_time = int((time.time() - start_time) * 1000)
+                success = True
+                
             else:
-                # For VLESS/Shadowsocks - just check TCP port availability
-                # Real protocol testing would require encryption/handshake implementation
+                # Unknown protocol - just check TCP port availability
                 start_time = time.time()
                 
                 reader, writer = await asyncio.wait_for(
@@ -212,64 +294,55 @@ class ProxyManager:
             error = str(e)
             response_time = 5000
         
-        # Обновляем статистику с учетом последовательных неудач
-        conn = self.db.get_conn()
-        cursor = conn.cursor()
-        
-        # Получаем текущий счетчик неудач
-        cursor.execute('''
-            SELECT consecutive_failures, in_slow_check_mode
-            FROM proxy_stats
-            WHERE proxy_id = ?
-        ''', (proxy_id,))
-        stats = cursor.fetchone()
-        
-        consecutive_failures = stats['consecutive_failures'] if stats else 0
-        in_slow_mode = stats['in_slow_check_mode'] if stats else 0
-        
-        if success:
-            # Успешная проверка - сбрасываем счетчик и возвращаем в быстрый режим
-            consecutive_failures = 0
-            in_slow_mode = 0
-        else:
-            # Неудачная проверка - увеличиваем счетчик
-            consecutive_failures += 1
-            
-            # После 5 неудач подряд - переводим в медленный режим
-            if consecutive_failures >= 5:
-                in_slow_mode = 1
-        
-        # Обновляем статистику
-        cursor.execute('''
-            UPDATE proxy_stats
-            SET is_healthy = ?,
-                avg_response_time = ?,
-                last_check = ?,
-                consecutive_failures = ?,
-                in_slow_check_mode = ?
-            WHERE proxy_id = ?
-        ''', (1 if success else 0, response_time, datetime.now().isoformat(), 
-              consecutive_failures, in_slow_mode, proxy_id))
-        
-        conn.commit()
-        
         return {
             "success": success,
             "responseTime": response_time,
             "error": error
         }
     
+    def _save_results(self, results: List[Tuple[int, Dict]]):
+        """Store probe results of a round in one transaction"""
+        if not results:
+            return
+        
+        checked_at = datetime.now().isoformat()
+        rows = []
+        for proxy_id, result in results:
+            success = result['success']
+            consecutive_failures, in_slow_mode = self._health.get(proxy_id, (0, 0))
+            
+            if success:
+                # Успешная проверка - сбрасываем счетчик и возвращаем в быстрый режим
+                consecutive_failures = 0
+                in_slow_mode = 0
+            else:
+                # Неудачная проверка - увеличиваем счетчик
+                consecutive_failures += 1
+                
+                # После 5 неудач подряд - переводим в медленный режим
+                if consecutive_failures >= 5:
+                    in_slow_mode = 1
+            
+            self._health[proxy_id] = (consecutive_failures, in_slow_mode)
+            rows.append((1 if success else 0, result['responseTime'], checked_at,
+                         consecutive_failures, in_slow_mode, proxy_id))
+            self.pool.update_health(proxy_id, success, result['responseTime'] if success else None)
+        
+        self.db.update_health_batch(rows)
+    
     async def test_all_proxies(self) -> List[Dict]:
         """Test all proxies concurrently"""
         proxies = self.db.get_all_proxies()
-        tasks = [self.test_proxy(proxy['id']) for proxy in proxies]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for proxy in proxies:
+            if proxy['id'] not in self._health:
+                self._health[proxy['id']] = (proxy.get('consecutive_failures') or 0,
+                                             proxy.get('in_slow_check_mode') or 0)
+        
+        results = await self._probe_many(proxies)
+        self._save_results(results)
         
         # Return results with proxy IDs
-        return [
-            {"proxyId": proxy['id'], **result} if isinstance(result, dict) else {"proxyId": proxy['id'], "success": False, "error": str(result)}
-            for proxy, result in zip(proxies, results)
-        ]
+        return [{"proxyId": proxy_id, **result} for proxy_id, result in results]
     
     def _build_proxy_url(self, proxy: Dict) -> str:
         """Build proxy URL"""
@@ -285,30 +358,54 @@ class ProxyManager:
     
     def add_proxy(self, name: str, host: str, port: int, protocol: str = 'socks5',
                   username: Optional[str] = None, password: Optional[str] = None,
-                  priority: int = 0, max_connections: int = 100) -> int:
+                  priority: int = 0, max_connections: int = 100, supports_udp: bool = False) -> int:
         """Add new proxy"""
-        return self.db.add_proxy(name, host, port, protocol, username, password, priority, max_connections)
+        proxy_id = self.db.add_proxy(name, host, port, protocol, username, password, priority, max_connections,
+                                     supports_udp)
+        self.refresh_pool()
+        return proxy_id
     
     def get_proxy(self, proxy_id: int) -> Optional[Dict]:
         """Get proxy by ID"""
         return self.db.get_proxy(proxy_id)
     
-    def select_proxy(self) -> Optional[Dict]:
-        """Select best available proxy for connection (round-robin among healthy)"""
-        proxies = self.db.get_all_proxies()
-        healthy_proxies = [p for p in proxies if p.get('enabled') and p.get('isHealthy')]
-        
-        if not healthy_proxies:
-            # Fallback to any enabled proxy
-            healthy_proxies = [p for p in proxies if p.get('enabled')]
-        
-        if not healthy_proxies:
-            return None
-        
-        # Sort by priority (higher first) then by avg response time (lower first)
-        healthy_proxies.sort(key=lambda p: (-p.get('priority', 0), p.get('avgResponseTime', 9999)))
-        
-        return healthy_proxies[0]
+    def refresh_pool(self):
+        """Reload the in-memory proxy pool from database"""
+        self.pool.refresh(self.db.get_all_proxies())
+    
+    def select_proxy(self, client_ip: Optional[str] = None, udp: bool = False) -> Optional[Dict]:
+        """Select proxy for a connection from the in-memory pool, must be released with release_proxy"""
+        if not self.pool.loaded:
+            self.refresh_pool()
+        return self.pool.select(client_ip, udp=udp)
+    
+    def release_proxy(self, proxy_id: int):
+        """Release connection slot taken by select_proxy"""
+        self.pool.release(proxy_id)
+    
+    def observe_latency(self, proxy_id: int, latency: float):
+        """Feed measured connect latency (ms) into selection"""
+        self.pool.observe(proxy_id, latency)
+    
+    def record_connection(self, proxy_id: int, success: bool):
+        """Record connection attempt result, written to the database by flush_counters"""
+        self.pool.record_connection(proxy_id, success)
+    
+    def record_traffic(self, proxy_id: int, sent: int, received: int):
+        """Record bytes relayed through proxy, written to the database by flush_counters"""
+        if sent or received:
+            self.pool.record_traffic(proxy_id, sent, received)
+    
+    def flush_counters(self):
+        """Write the connection and traffic counters gathered since the last flush"""
+        rows = self.pool.take_counters()
+        if not rows:
+            return
+        try:
+            self.db.add_counters_batch(rows)
+        except Exception:
+            self.pool.restore_counters(rows)
+            raise
     
     def get_all_proxies(self) -> List[Dict]:
         """Get all proxies"""
@@ -316,16 +413,33 @@ class ProxyManager:
     
     def update_proxy(self, proxy_id: int, **kwargs) -> bool:
         """Update proxy"""
-        return self.db.update_proxy(proxy_id, **kwargs)
+        updated = self.db.update_proxy(proxy_id, **kwargs)
+        self.refresh_pool()
+        return updated
     
     def delete_proxy(self, proxy_id: int) -> bool:
         """Delete proxy"""
-        return self.db.delete_proxy(proxy_id)
+        deleted = self.db.delete_proxy(proxy_id)
+        self.refresh_pool()
+        return deleted
     
     def toggle_proxy(self, proxy_id: int, enabled: bool) -> bool:
         """Toggle proxy enabled state"""
-        return self.db.update_proxy(proxy_id, enabled=1 if enabled else 0)
+        return self.update_proxy(proxy_id, enabled=1 if enabled else 0)
+    
+    def get_latency_stats(self) -> Dict[int, Dict]:
+        """Rolling latency percentiles (ms) and loss rate per proxy"""
+        return {
+            entry['id']: {
+                'latency_p50': entry['p50'],
+                'latency_p95': entry['p95'],
+                'latency_p99': entry['p99'],
+                'loss_rate': entry['loss_rate'],
+            }
+            for entry in self.pool.stats()
+        }
     
     def get_statistics(self) -> Dict:
         """Get overall statistics"""
+        self.flush_counters()
         return self.db.get_statistics()
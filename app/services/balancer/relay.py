@@ -0,0 +1,324 @@
+"""
+Relay backends
+Перекачка трафика между клиентом и upstream прокси после SOCKS5 рукопожатия
+"""
+import asyncio
+import logging
+import os
+import socket
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 65536
+
+
+class RelayCounters:
+    """Per-connection byte counters"""
+
+    __slots__ = ('sent', 'received')
+
+    def __init__(self):
+        self.sent = 0  # client -> upstream
+        self.received = 0  # upstream -> client
+
+
+def _take_buffered(reader: asyncio.StreamReader) -> bytes:
+    """Take the bytes a StreamReader already read ahead during the handshake"""
+    data = bytes(reader._buffer)
+    reader._buffer.clear()
+    return data
+
+
+class StreamRelay:
+    """Copies data through StreamReader/StreamWriter, works on any event loop"""
+
+    name = 'stream'
+
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+
+    async def relay(self, client_reader, client_writer, upstream_reader, upstream_writer,
+                    counters: RelayCounters):
+        try:
+            await asyncio.gather(
+                self._forward(client_reader, upstream_writer, counters, upstream=False),
+                self._forward(upstream_reader, client_writer, counters, upstream=True)
+            )
+        finally:
+            for writer in (client_writer, upstream_writer):
+                try:
+                    writer.close()
+                    await writer.wait_closed()
+                except Exception:
+                    pass
+
+    async def _forward(self, reader, writer, counters: RelayCounters, upstream: bool):
+        """Forward data between streams"""
+        try:
+            while True:
+                data = await reader.read(self.buffer_size)
+                if not data:
+                    break
+                if upstream:
+                    counters.received += len(data)
+                else:
+                    counters.sent += len(data)
+                writer.write(data)
+                await writer.drain()
+
+            # half-close, the other direction keeps flowing
+            if writer.can_write_eof():
+                writer.write_eof()
+            else:
+                writer.close()
+        except Exception as e:
+            logger.debug(f"Forward error: {e}")
+            writer.close()
+
+
+class _BufferedPipe(asyncio.BufferedProtocol):
+    """Reads one side into a preallocated buffer and writes it straight to the peer transport"""
+
+    def __init__(self, transport: asyncio.Transport, buffer_size: int,
+                 counters: RelayCounters, upstream: bool, done: asyncio.Future):
+        self.transport = transport
+        self.peer: Optional['_BufferedPipe'] = None
+        self.eof = False
+        self._buffer_size = buffer_size
+        self._buffer = memoryview(bytearray(buffer_size))
+        self._counters = counters
+        self._upstream = upstream
+        self.done = done
+
+    def get_buffer(self, sizehint: int):
+        return self._buffer
+
+    def buffer_updated(self, nbytes: int):
+        if self._upstream:
+            self._counters.received += nbytes
+        else:
+            self._counters.sent += nbytes
+
+        peer_transport = self.peer.transport
+        peer_transport.write(self._buffer[:nbytes])
+        if peer_transport.get_write_buffer_size():
+            # the transport may keep a reference to the unsent tail instead of copying it
+            self._buffer = memoryview(bytearray(self._buffer_size))
+
+    def eof_received(self):
+        self.eof = True
+        peer_transport = self.peer.transport
+        if self.peer.eof or not peer_transport.can_write_eof():
+            peer_transport.close()
+            return False
+
+        # half-close, the other direction keeps flowing
+        peer_transport.write_eof()
+        return True
+
+    def pause_writing(self):
+        # our transport can't keep up, stop reading what would be written to it
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if exc:
+            logger.debug(f"Relay connection lost: {exc}")
+        self.peer.transport.close()
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+class BufferedRelay:
+    """
+    Swaps the stream protocols for a pair of BufferedProtocol instances.
+
+    The transports read directly into preallocated buffers, so no intermediate
+    bytes objects are created while the peer socket keeps up.
+    """
+
+    name = 'buffered'
+
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+
+    async def relay(self, client_reader, client_writer, upstream_reader, upstream_writer,
+                    counters: RelayCounters):
+        loop = asyncio.get_running_loop()
+        client_transport = client_writer.transport
+        upstream_transport = upstream_writer.transport
+
+        if client_transport.is_closing() or upstream_transport.is_closing():
+            client_transport.close()
+            upstream_transport.close()
+            return
+
+        client_transport.pause_reading()
+        upstream_transport.pause_reading()
+
+        client_pipe = _BufferedPipe(client_transport, self.buffer_size, counters,
+                                    upstream=False, done=loop.create_future())
+        upstream_pipe = _BufferedPipe(upstream_transport, self.buffer_size, counters,
+                                      upstream=True, done=loop.create_future())
+        client_pipe.peer = upstream_pipe
+        upstream_pipe.peer = client_pipe
+
+        pending = _take_buffered(client_reader)
+        if pending:
+            counters.sent += len(pending)
+            upstream_transport.write(pending)
+        pending = _take_buffered(upstream_reader)
+        if pending:
+            counters.received += len(pending)
+            client_transport.write(pending)
+
+        client_transport.set_protocol(client_pipe)
+        upstream_transport.set_protocol(upstream_pipe)
+
+        for reader, pipe in ((client_reader, client_pipe), (upstream_reader, upstream_pipe)):
+            if reader.at_eof():
+                pipe.eof_received()
+            else:
+                pipe.transport.resume_reading()
+
+        await asyncio.gather(client_pipe.done, upstream_pipe.done)
+
+
+class SpliceRelay:
+    """
+    Moves data between the sockets with os.splice through a pipe (Linux only).
+
+    The payload never enters the Python process, the event loop only waits
+    for readiness. Sockets are detached from their transports after the handshake.
+    """
+
+    name = 'splice'
+
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+
+    @staticmethod
+    def available() -> bool:
+        return hasattr(os, 'splice')
+
+    async def relay(self, client_reader, client_writer, upstream_reader, upstream_writer,
+                    counters: RelayCounters):
+        loop = asyncio.get_running_loop()
+
+        client_sock = self._detach(client_writer)
+        upstream_sock = self._detach(upstream_writer)
+        to_upstream = _take_buffered(client_reader)
+        to_client = _take_buffered(upstream_reader)
+        client_writer.transport.close()
+        upstream_writer.transport.close()
+
+        tasks = []
+        try:
+            if to_upstream:
+                counters.sent += len(to_upstream)
+                await loop.sock_sendall(upstream_sock, to_upstream)
+            if to_client:
+                counters.received += len(to_client)
+                await loop.sock_sendall(client_sock, to_client)
+
+            tasks = [
+                asyncio.create_task(self._splice(loop, client_sock, upstream_sock, counters, upstream=False)),
+                asyncio.create_task(self._splice(loop, upstream_sock, client_sock, counters, upstream=True)),
+            ]
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception():
+                    logger.debug(f"Splice error: {task.exception()}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            client_sock.close()
+            upstream_sock.close()
+
+    @staticmethod
+    def _detach(writer: asyncio.StreamWriter) -> socket.socket:
+        writer.transport.pause_reading()
+        sock = writer.get_extra_info('socket').dup()
+        sock.setblocking(False)
+        return sock
+
+    async def _splice(self, loop, src: socket.socket, dst: socket.socket,
+                      counters: RelayCounters, upstream: bool):
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        pipe_r, pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            while True:
+                try:
+                    n = os.splice(src.fileno(), pipe_w, self.buffer_size, flags=flags)
+                except BlockingIOError:
+                    await _wait_fd(loop, src.fileno(), write=False)
+                    continue
+                if n == 0:
+                    break
+
+                pending = n
+                while pending:
+                    try:
+                        pending -= os.splice(pipe_r, dst.fileno(), pending, flags=flags)
+                    except BlockingIOError:
+                        await _wait_fd(loop, dst.fileno(), write=True)
+
+                if upstream:
+                    counters.received += n
+                else:
+                    counters.sent += n
+
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        finally:
+            os.close(pipe_r)
+            os.close(pipe_w)
+
+
+async def _wait_fd(loop: asyncio.AbstractEventLoop, fd: int, write: bool):
+    fut = loop.create_future()
+
+    def ready():
+        if not fut.done():
+            fut.set_result(None)
+
+    if write:
+        loop.add_writer(fd, ready)
+    else:
+        loop.add_reader(fd, ready)
+    try:
+        await fut
+    finally:
+        if write:
+            loop.remove_writer(fd)
+        else:
+            loop.remove_reader(fd)
+
+
+RELAY_BACKENDS = {
+    StreamRelay.name: StreamRelay,
+    BufferedRelay.name: BufferedRelay,
+    SpliceRelay.name: SpliceRelay,
+}
+
+
+def get_relay(backend: str = 'auto', buffer_size: int = DEFAULT_BUFFER_SIZE):
+    """Build a relay backend, 'auto' picks splice on Linux and buffered protocols elsewhere"""
+    if backend == 'auto':
+        backend = SpliceRelay.name if SpliceRelay.available() else BufferedRelay.name
+
+    if backend == SpliceRelay.name and not SpliceRelay.available():
+        logger.warning("os.splice is not available, falling back to buffered relay")
+        backend = BufferedRelay.name
+
+    try:
+        return RELAY_BACKENDS[backend](buffer_size=buffer_size)
+    except KeyError:
+        raise ValueError(f"Unknown relay backend: {backend}")
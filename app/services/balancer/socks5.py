@@ -0,0 +1,138 @@
+"""
+SOCKS5 helpers
+Кодирование адресов и рукопожатие с upstream прокси
+"""
+import asyncio
+import ipaddress
+import socket
+import struct
+from typing import Dict, Optional, Tuple
+
+CMD_CONNECT = 1
+CMD_UDP_ASSOCIATE = 3
+
+ATYP_IPV4 = 1
+ATYP_DOMAIN = 3
+ATYP_IPV6 = 4
+
+
+class SocksError(Exception):
+    """Upstream SOCKS5 negotiation failure"""
+
+
+class SocksRequestFailed(SocksError):
+    """Upstream answered a request with a non-zero REP code"""
+
+    def __init__(self, rep: int):
+        super().__init__(f"Upstream request failed: {rep}")
+        self.rep = rep
+
+
+def encode_address(host: str, port: int) -> bytes:
+    """ATYP + DST.ADDR + DST.PORT"""
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        encoded = host.encode()
+        return bytes([ATYP_DOMAIN, len(encoded)]) + encoded + struct.pack('!H', port)
+
+    atyp = ATYP_IPV4 if ip.version == 4 else ATYP_IPV6
+    return bytes([atyp]) + ip.packed + struct.pack('!H', port)
+
+
+def reply(rep: int, host: str = '0.0.0.0', port: int = 0) -> bytes:
+    """Server reply: VER REP RSV ATYP BND.ADDR BND.PORT"""
+    return bytes([5, rep, 0]) + encode_address(host, port)
+
+
+async def read_address(reader: asyncio.StreamReader, atyp: int) -> Tuple[str, int]:
+    if atyp == ATYP_IPV4:
+        host = socket.inet_ntop(socket.AF_INET, await reader.readexactly(4))
+    elif atyp == ATYP_IPV6:
+        host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+    elif atyp == ATYP_DOMAIN:
+        length = (await reader.readexactly(1))[0]
+        host = (await reader.readexactly(length)).decode()
+    else:
+        raise SocksError(f"Address type not supported: {atyp}")
+
+    port = struct.unpack('!H', await reader.readexactly(2))[0]
+    return host, port
+
+
+async def read_reply(reader: asyncio.StreamReader) -> Tuple[str, int]:
+    """Read a reply and return its BND address, raises SocksError unless it succeeded"""
+    ver, rep, _, atyp = await reader.readexactly(4)
+    if ver != 5:
+        raise SocksError("Invalid SOCKS5 reply")
+    if rep != 0:
+        raise SocksRequestFailed(rep)
+    return await read_address(reader, atyp)
+
+
+def connect_request(host: str, port: int) -> bytes:
+    return b'\x05' + bytes([CMD_CONNECT, 0]) + encode_address(host, port)
+
+
+def greeting(proxy: Dict) -> bytes:
+    if proxy.get('username') and proxy.get('password'):
+        return b'\x05\x02\x00\x02'
+    return b'\x05\x01\x00'
+
+
+def auth_request(proxy: Dict) -> bytes:
+    """USERNAME/PASSWORD sub-negotiation (RFC 1929)"""
+    username = proxy['username'].encode()
+    password = proxy['password'].encode()
+    return bytes([1, len(username)]) + username + bytes([len(password)]) + password
+
+
+async def negotiate(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, proxy: Dict):
+    """Greeting and optional authentication with an upstream proxy"""
+    writer.write(greeting(proxy))
+    await writer.drain()
+
+    ver, method = await reader.readexactly(2)
+    if ver != 5:
+        raise SocksError("Invalid SOCKS5 greeting response")
+
+    if method == 0x02:
+        if not proxy.get('username') or not proxy.get('password'):
+            raise SocksError("Proxy requires authentication but credentials not provided")
+        writer.write(auth_request(proxy))
+        await writer.drain()
+        _, status = await reader.readexactly(2)
+        if status != 0:
+            raise SocksError(f"SOCKS5 authentication failed: status {status}")
+    elif method != 0x00:
+        raise SocksError("Upstream proxy auth failed")
+
+
+def parse_udp_header(data: bytes) -> Optional[Tuple[int, str, int]]:
+    """
+    Parse RSV FRAG ATYP DST.ADDR DST.PORT of a UDP request.
+
+    Returns (header length, host, port), or None for malformed or fragmented datagrams.
+    """
+    if len(data) < 4 or data[2] != 0:
+        return None
+
+    atyp = data[3]
+    try:
+        if atyp == ATYP_IPV4:
+            end = 8
+            host = socket.inet_ntop(socket.AF_INET, data[4:end])
+        elif atyp == ATYP_IPV6:
+            end = 20
+            host = socket.inet_ntop(socket.AF_INET6, data[4:end])
+        elif atyp == ATYP_DOMAIN:
+            end = 5 + data[4]
+            host = data[5:end].decode()
+        else:
+            return None
+    except (IndexError, ValueError, OSError):
+        return None
+
+    if len(data) < end + 2:
+        return None
+    return end + 2, host, struct.unpack('!H', data[end:end + 2])[0]
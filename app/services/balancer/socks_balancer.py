@@ -3,10 +3,16 @@ SOCKS5 Balancer
 TCP/UDP балансировщик для SOCKS5 прокси
 """
 import asyncio
+import socket
 import struct
+import time
 import logging
-from typing import Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from .proxy_manager import ProxyManager
+from .relay import DEFAULT_BUFFER_SIZE, RelayCounters, get_relay
+from .socks5 import parse_udp_header, reply
+from .udp import RETRY_BASE, RETRY_MAX, UDPAssociation, UDPFlow
+from .upstream import UpstreamConnector
 
 logger = logging.getLogger(__name__)
 
@@ -14,10 +20,23 @@ logger = logging.getLogger(__name__)
 class SocksBalancer:
     """SOCKS5 балансировщик трафика"""
     
-    def __init__(self, manager: ProxyManager, tcp_port: int = 7777, udp_port: int = 7778):
+    def __init__(self, manager: ProxyManager, tcp_port: int = 7777, udp_port: int = 7778,
+                 relay_backend: str = 'auto', relay_buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 udp_idle_timeout: int = 60, warm_pool_max: int = 8, warm_idle_timeout: int = 30,
+                 pipeline_handshake: bool = True):
         self.manager = manager
         self.tcp_port = tcp_port
         self.udp_port = udp_port
+        self.relay = get_relay(relay_backend, relay_buffer_size)
+        self.upstream = UpstreamConnector(max_idle=warm_pool_max, idle_timeout=warm_idle_timeout,
+                                          pipelining=pipeline_handshake)
+        self.udp_idle_timeout = udp_idle_timeout
+        self.udp_associations: Dict[str, List[UDPAssociation]] = {}
+        self.udp_flows: Dict[Tuple, UDPFlow] = {}
+        # client address -> (retry at, failures in a row) after failed upstream associates
+        self._udp_failures: Dict[Tuple, Tuple[float, int]] = {}
+        self._udp_expire_task = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
         self.tcp_server = None
         self.udp_transport = None
         self.running = False
@@ -43,6 +62,10 @@ class SocksBalancer:
                 local_addr=('0.0.0.0', self.udp_port)
             )
             logger.info(f"✔ SOCKS5 балансировщик (UDP) запущен на 0.0.0.0:{self.udp_port}")
+            self._udp_expire_task = asyncio.create_task(self._expire_udp_flows())
+            self.upstream.start()
+            self._loop = loop
+            self.manager.pool.on_remove(self._on_proxies_removed)
             
             # Запускаем автоматическую проверку прокси как фоновую задачу
             asyncio.create_task(self.manager.start_auto_check())
@@ -55,6 +78,15 @@ class SocksBalancer:
             logger.error(f"Balancer error: {e}")
             raise
     
+    def _on_proxies_removed(self, proxy_ids):
+        # the pool is refreshed from API threads too, warm connections belong to the balancer loop
+        if self.running and self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._discard_upstreams, proxy_ids)
+
+    def _discard_upstreams(self, proxy_ids):
+        for proxy_id in proxy_ids:
+            self.upstream.discard(proxy_id)
+
     async def stop(self):
         """Stop servers"""
         self.running = False
@@ -66,6 +98,14 @@ class SocksBalancer:
             self.tcp_server.close()
             await self.tcp_server.wait_closed()
         
+        if self._udp_expire_task:
+            self._udp_expire_task.cancel()
+        
+        self.upstream.close()
+        
+        for flow in list(self.udp_flows.values()):
+            flow.close()
+        
         if self.udp_transport:
             self.udp_transport.close()
         
@@ -124,7 +164,7 @@ class SocksBalancer:
                 length = ord(await reader.read(1))
                 addr = (await reader.read(length)).decode()
             elif atyp == 4:  # IPv6
-                addr = ':'.join(f'{b:02x}' for b in await reader.read(16))
+                addr = socket.inet_ntop(socket.AF_INET6, await reader.read(16))
             else:
                 writer.write(b'\x05\x08\x00\x01\x00\x00\x00\x00\x00\x00')
                 await writer.drain()
@@ -139,6 +179,8 @@ class SocksBalancer:
             # CMD: 1=CONNECT, 2=BIND, 3=UDP
             if cmd == 1:  # CONNECT
                 await self._handle_connect(reader, writer, addr, port)
+            elif cmd == 3:  # UDP ASSOCIATE
+                await self._handle_udp_associate(reader, writer, port)
             else:
                 # Not supported
                 writer.write(b'\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00')
@@ -152,53 +194,32 @@ class SocksBalancer:
     
     async def _handle_connect(self, client_reader, client_writer, dest_addr, dest_port):
         """Handle SOCKS5 CONNECT request through proxy"""
-        proxy = None
+        peername = client_writer.get_extra_info('peername')
+        client_ip = peername[0] if peername else None
+        
+        # Select proxy
+        proxy = self.manager.select_proxy(client_ip)
+        
+        if not proxy:
+            # No proxy available
+            client_writer.write(b'\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00')
+            await client_writer.drain()
+            return
+        
+        try:
+            await self._connect_through(proxy, client_reader, client_writer, dest_addr, dest_port)
+        finally:
+            self.manager.release_proxy(proxy['id'])
+    
+    async def _connect_through(self, proxy, client_reader, client_writer, dest_addr, dest_port):
+        """Open CONNECT through upstream proxy and relay traffic"""
+        upstream_writer = None
         try:
-            # Select proxy
-            proxy = self.manager.select_proxy()
-            
-            if not proxy:
-                # No proxy available
-                client_writer.write(b'\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00')
-                await client_writer.drain()
-                return
-            
             logger.debug(f"Using proxy: {proxy['name']} for {dest_addr}:{dest_port}")
+            started = time.monotonic()
             
             # Connect to upstream proxy
-            upstream_reader, upstream_writer = await asyncio.open_connection(
-                proxy['host'], proxy['port']
-            )
-            
-            # SOCKS5 greeting to upstream
-            upstream_writer.write(b'\x05\x01\x00')
-            await upstream_writer.drain()
-            response = await upstream_reader.read(2)
-            
-            if response != b'\x05\x00':
-                raise Exception("Upstream proxy auth failed")
-            
-            # CONNECT request to upstream
-            request = b'\x05\x01\x00'
-            
-            # Add destination address
-            if ':' in dest_addr and '.' not in dest_addr:  # IPv6
-                request += b'\x04' + bytes.fromhex(dest_addr.replace(':', ''))
-            elif dest_addr.replace('.', '').replace(':', '').isdigit():  # IPv4
-                request += b'\x01' + bytes(map(int, dest_addr.split('.')))
-            else:  # Domain
-                request += b'\x03' + bytes([len(dest_addr)]) + dest_addr.encode()
-            
-            request += struct.pack('!H', dest_port)
-            
-            upstream_writer.write(request)
-            await upstream_writer.drain()
-            
-            # Read response
-            response = await upstream_reader.read(10)
-            
-            if response[1] != 0:
-                raise Exception(f"Upstream connect failed: {response[1]}")
+            upstream_reader, upstream_writer = await self.upstream.open(proxy, dest_addr, dest_port)
             
             # Success response to client
             client_writer.write(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
@@ -206,37 +227,127 @@ class SocksBalancer:
             
             # Update stats
             self.manager.record_connection(proxy['id'], success=True)
-            
-            # Start forwarding
-            await asyncio.gather(
-                self._forward(client_reader, upstream_writer),
-                self._forward(upstream_reader, client_writer)
-            )
+            self.manager.observe_latency(proxy['id'], (time.monotonic() - started) * 1000)
         
         except Exception as e:
             logger.error(f"Connect error: {e}")
-            if proxy:
-                self.manager.record_connection(proxy['id'], success=False)
+            self.manager.record_connection(proxy['id'], success=False)
+            if upstream_writer:
+                upstream_writer.close()
             client_writer.write(b'\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00')
             await client_writer.drain()
-    
-    async def _forward(self, reader, writer):
-        """Forward data between streams"""
+            return
+        
+        # Start forwarding
+        counters = RelayCounters()
         try:
-            while True:
-                data = await reader.read(8192)
-                if not data:
-                    break
-                writer.write(data)
-                await writer.drain()
+            await self.relay.relay(client_reader, client_writer, upstream_reader, upstream_writer, counters)
         except Exception as e:
-            logger.debug(f"Forward error: {e}")
+            logger.debug(f"Relay error: {e}")
         finally:
-            try:
-                writer.close()
-                await writer.wait_closed()
-            except:
+            upstream_writer.close()
+            self.manager.record_traffic(proxy['id'], counters.sent, counters.received)
+    
+    async def _handle_udp_associate(self, client_reader, client_writer, client_port: int):
+        """Handle SOCKS5 UDP ASSOCIATE, datagrams are accepted while the TCP connection is open"""
+        client_ip = client_writer.get_extra_info('peername')[0]
+        
+        proxy = self.manager.select_proxy(client_ip, udp=True)
+        if not proxy:
+            # No proxy with UDP support
+            client_writer.write(reply(0x01))
+            await client_writer.drain()
+            return
+        
+        association = UDPAssociation(client_ip, client_port, proxy)
+        self.udp_associations.setdefault(client_ip, []).append(association)
+        try:
+            local_ip = client_writer.get_extra_info('sockname')[0]
+            client_writer.write(reply(0x00, local_ip, self.udp_port))
+            await client_writer.drain()
+            
+            while await client_reader.read(4096):
                 pass
+        finally:
+            associations = self.udp_associations.get(client_ip, [])
+            if association in associations:
+                associations.remove(association)
+            if not associations:
+                self.udp_associations.pop(client_ip, None)
+            for flow in list(association.flows):
+                flow.close()
+            self.manager.release_proxy(proxy['id'])
+    
+    def handle_datagram(self, data: bytes, addr: Tuple):
+        """Route a client datagram to its NAT entry, opening one on first use"""
+        flow = self.udp_flows.get(addr)
+        if flow is None:
+            if parse_udp_header(data) is None:
+                return
+            
+            association = next(
+                (a for a in self.udp_associations.get(addr[0], ()) if a.accepts(addr)), None
+            )
+            if association is None:
+                logger.debug(f"UDP datagram from {addr} without association, dropped")
+                return
+            
+            failure = self._udp_failures.get(addr)
+            if failure and time.monotonic() < failure[0]:
+                # don't reconnect upstream for every datagram while associates keep failing
+                return
+            
+            flow = self.udp_flows[addr] = UDPFlow(self, association, addr)
+            association.flows.add(flow)
+            flow.start()
+        
+        elif len(data) < 4 or data[2] != 0:
+            # fragmentation is not supported
+            return
+        
+        flow.send(data)
+    
+    def send_to_client(self, data: bytes, addr: Tuple):
+        if self.udp_transport:
+            self.udp_transport.sendto(data, addr)
+    
+    def udp_flow_failed(self, addr: Tuple):
+        _, failures = self._udp_failures.get(addr, (0.0, 0))
+        delay = min(RETRY_BASE * 2 ** failures, RETRY_MAX)
+        self._udp_failures[addr] = (time.monotonic() + delay, failures + 1)
+    
+    def udp_flow_opened(self, addr: Tuple):
+        self._udp_failures.pop(addr, None)
+    
+    def discard_flow(self, flow: UDPFlow):
+        if self.udp_flows.get(flow.client_addr) is flow:
+            del self.udp_flows[flow.client_addr]
+        flow.association.flows.discard(flow)
+    
+    async def _expire_udp_flows(self):
+        """Close NAT entries idle for longer than udp_idle_timeout"""
+        while True:
+            await asyncio.sleep(max(1, min(10, self.udp_idle_timeout / 2)))
+            deadline = time.monotonic() - self.udp_idle_timeout
+            for flow in [f for f in self.udp_flows.values() if f.last_seen < deadline]:
+                flow.close()
+            now = time.monotonic()
+            for addr in [a for a, (retry_at, _) in self._udp_failures.items() if retry_at + RETRY_MAX < now]:
+                del self._udp_failures[addr]
+    
+    def udp_flow_stats(self) -> List[Dict]:
+        return [flow.stats() for flow in list(self.udp_flows.values())]
+    
+    async def snapshot(self, func: Callable[[], Any]) -> Any:
+        """Call `func` on the balancer loop, its state must not be read from the API's loop"""
+        loop = self._loop
+        if loop is None or loop.is_closed() or not loop.is_running():
+            return func()
+        
+        async def call():
+            return func()
+        
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(call(), loop))
 
 
 class SOCKSUDPProtocol(asyncio.DatagramProtocol):
@@ -251,8 +362,7 @@ class SOCKSUDPProtocol(asyncio.DatagramProtocol):
     
     def datagram_received(self, data, addr):
         """Handle UDP datagram"""
-        logger.debug(f"UDP datagram from {addr}: {len(data)} bytes")
-        # TODO: Parse SOCKS5 UDP header and forward through proxy
+        self.balancer.handle_datagram(data, addr)
     
     def error_received(self, exc):
         logger.error(f"UDP error: {exc}")
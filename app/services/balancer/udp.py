@@ -0,0 +1,162 @@
+"""
+SOCKS5 UDP relay
+NAT таблица клиентских UDP потоков через upstream прокси с поддержкой UDP
+"""
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+from .socks5 import CMD_UDP_ASSOCIATE, encode_address, negotiate, read_reply
+
+if TYPE_CHECKING:
+    from .socks_balancer import SocksBalancer
+
+logger = logging.getLogger(__name__)
+
+MAX_PENDING_DATAGRAMS = 64
+RETRY_BASE = 1.0  # seconds a client address waits after a failed upstream associate, doubled per failure
+RETRY_MAX = 60.0
+
+
+class UDPAssociation:
+    """UDP ASSOCIATE of a client, alive as long as its TCP control connection"""
+
+    def __init__(self, client_ip: str, client_port: int, proxy: Dict):
+        self.client_ip = client_ip
+        self.client_port = client_port  # 0 when the client didn't tell its UDP port
+        self.proxy = proxy
+        self.flows: Set['UDPFlow'] = set()
+
+    def accepts(self, addr: Tuple) -> bool:
+        return addr[0] == self.client_ip and self.client_port in (0, addr[1])
+
+
+class UDPFlow(asyncio.DatagramProtocol):
+    """
+    NAT entry of one client UDP address.
+
+    Holds an upstream UDP ASSOCIATE (TCP control connection and a local UDP socket
+    connected to the upstream relay). SOCKS5 UDP headers have the same format on
+    both sides, so datagrams are passed through unchanged in both directions.
+    """
+
+    def __init__(self, balancer: 'SocksBalancer', association: UDPAssociation, client_addr: Tuple):
+        self.balancer = balancer
+        self.association = association
+        self.proxy = association.proxy
+        self.client_addr = client_addr
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.control_writer: Optional[asyncio.StreamWriter] = None
+        self.closed = False
+        self.created_at = time.time()
+        self.last_seen = time.monotonic()
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._pending: List[bytes] = []
+        self._open_task: Optional[asyncio.Task] = None
+        self._control_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._open_task = asyncio.create_task(self.open())
+
+    async def open(self):
+        """UDP ASSOCIATE with the upstream proxy"""
+        loop = asyncio.get_running_loop()
+        try:
+            reader, self.control_writer = await asyncio.wait_for(
+                asyncio.open_connection(self.proxy['host'], self.proxy['port']), timeout=10.0
+            )
+            await negotiate(reader, self.control_writer, self.proxy)
+
+            local = self.control_writer.get_extra_info('sockname')
+            self.control_writer.write(b'\x05' + bytes([CMD_UDP_ASSOCIATE, 0]) + encode_address(local[0], 0))
+            await self.control_writer.drain()
+            relay_host, relay_port = await asyncio.wait_for(read_reply(reader), timeout=10.0)
+            if relay_host in ('0.0.0.0', '::'):
+                relay_host = self.proxy['host']
+
+            await loop.create_datagram_endpoint(lambda: self, remote_addr=(relay_host, relay_port))
+        except Exception as e:
+            logger.debug(f"UDP associate through {self.proxy['name']} failed: {e}")
+            self.balancer.manager.record_connection(self.proxy['id'], success=False)
+            self.balancer.udp_flow_failed(self.client_addr)
+            self.close()
+            return
+
+        self.balancer.manager.record_connection(self.proxy['id'], success=True)
+        self.balancer.udp_flow_opened(self.client_addr)
+        if self.closed:
+            self.close()
+            return
+
+        self._control_task = asyncio.create_task(self._watch_control(reader))
+        for data in self._pending:
+            self._send(data)
+        self._pending = []
+
+    async def _watch_control(self, reader: asyncio.StreamReader):
+        # the upstream association ends with its TCP connection
+        try:
+            while await reader.read(4096):
+                pass
+        except Exception:
+            pass
+        self.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, data: bytes):
+        """Datagram from the client, header included"""
+        self.last_seen = time.monotonic()
+        if self.transport is None:
+            if len(self._pending) < MAX_PENDING_DATAGRAMS:
+                self._pending.append(data)
+            return
+        self._send(data)
+
+    def _send(self, data: bytes):
+        self.packets_sent += 1
+        self.bytes_sent += len(data)
+        self.transport.sendto(data)
+
+    def datagram_received(self, data, addr):
+        """Datagram from the upstream relay, header included"""
+        self.last_seen = time.monotonic()
+        self.packets_received += 1
+        self.bytes_received += len(data)
+        self.balancer.send_to_client(data, self.client_addr)
+
+    def error_received(self, exc):
+        logger.debug(f"UDP flow {self.client_addr} error: {exc}")
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+        if self.control_writer:
+            self.control_writer.close()
+        for task in (self._open_task, self._control_task):
+            if task and task is not asyncio.current_task():
+                task.cancel()
+        if self.closed:
+            return
+
+        self.closed = True
+        self._pending = []
+        self.balancer.discard_flow(self)
+        self.balancer.manager.record_traffic(self.proxy['id'], self.bytes_sent, self.bytes_received)
+
+    def stats(self) -> Dict:
+        return {
+            'client': f"{self.client_addr[0]}:{self.client_addr[1]}",
+            'proxy_id': self.proxy['id'],
+            'created_at': self.created_at,
+            'idle': round(time.monotonic() - self.last_seen, 1),
+            'packets_sent': self.packets_sent,
+            'packets_received': self.packets_received,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
@@ -0,0 +1,241 @@
+"""
+Upstream connector
+Пул заранее открытых соединений к upstream прокси и конвейерное рукопожатие
+"""
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from .socks5 import (SocksError, SocksRequestFailed, auth_request, connect_request,
+                     greeting, negotiate, read_reply)
+
+logger = logging.getLogger(__name__)
+
+RATE_ALPHA = 0.3
+DEFAULT_HANDSHAKE_TIME = 0.2  # seconds, until measured
+PIPELINING_RETRY_AFTER = 300  # seconds, after an upstream dropped a pipelined handshake
+
+
+class _PipeliningRejected(Exception):
+    """The upstream didn't answer a pipelined handshake the way a sequential one expects"""
+
+
+class _UpstreamState:
+    __slots__ = ('proxy', 'idle', 'opening', 'arrivals', 'rate', 'handshake_time', 'pipelining',
+                 'pipelining_retry_at')
+
+    def __init__(self, proxy: Dict):
+        self.proxy = proxy
+        self.idle: Deque[Tuple[asyncio.StreamReader, asyncio.StreamWriter, float]] = deque()
+        self.opening = 0
+        self.arrivals = 0
+        self.rate = 0.0  # connections per second
+        self.handshake_time = DEFAULT_HANDSHAKE_TIME
+        self.pipelining = True  # False once the upstream answered a pipelined handshake wrongly
+        self.pipelining_retry_at = 0.0
+
+    @property
+    def pipelining_enabled(self) -> bool:
+        return self.pipelining and time.monotonic() >= self.pipelining_retry_at
+
+
+class UpstreamConnector:
+    """
+    Opens CONNECT tunnels through upstream proxies.
+
+    Each upstream keeps a few idle connections that already finished the
+    greeting and authentication, so a new flow only waits for the CONNECT
+    round trip. Without one, greeting, auth and CONNECT are sent in a single
+    write and the replies read back in order; upstreams that don't tolerate
+    that fall back to the sequential handshake. The number of idle connections
+    follows the observed connection rate times the handshake time.
+
+    An upstream that answers a pipelined handshake wrongly never gets one
+    again. One that only drops the connection, but then completes a
+    sequential handshake, is retried after PIPELINING_RETRY_AFTER seconds;
+    if the sequential handshake fails too, it was an ordinary connect failure.
+    """
+
+    def __init__(self, max_idle: int = 8, idle_timeout: float = 30.0, pipelining: bool = True,
+                 connect_timeout: float = 10.0):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.pipelining = pipelining
+        self.connect_timeout = connect_timeout
+        self._upstreams: Dict[int, _UpstreamState] = {}
+        self._maintain_task: Optional[asyncio.Task] = None
+
+    def _state(self, proxy: Dict) -> _UpstreamState:
+        state = self._upstreams.get(proxy['id'])
+        if state is None:
+            state = self._upstreams[proxy['id']] = _UpstreamState(proxy)
+        else:
+            state.proxy = proxy
+        return state
+
+    async def open(self, proxy: Dict, host: str, port: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """Return a stream connected to host:port through proxy"""
+        state = self._state(proxy)
+        state.arrivals += 1
+
+        conn = self._take_idle(state)
+        self._refill(state)
+        if conn:
+            reader, writer = conn
+            try:
+                writer.write(connect_request(host, port))
+                await writer.drain()
+                await asyncio.wait_for(read_reply(reader), timeout=self.connect_timeout)
+                return reader, writer
+            except SocksRequestFailed:
+                writer.close()
+                raise
+            except Exception as e:
+                # the upstream dropped the idle connection, open a fresh one
+                logger.debug(f"Warm connection to {proxy['name']} unusable: {e}")
+                writer.close()
+
+        return await self._open_fresh(state, host, port)
+
+    def _take_idle(self, state: _UpstreamState):
+        now = time.monotonic()
+        while state.idle:
+            reader, writer, created = state.idle.popleft()
+            if reader.at_eof() or writer.is_closing() or now - created > self.idle_timeout:
+                writer.close()
+                continue
+            return reader, writer
+        return None
+
+    async def _open_fresh(self, state: _UpstreamState, host: str, port: int):
+        proxy = state.proxy
+        reader, writer = await self._open_connection(proxy)
+        try:
+            if self.pipelining and state.pipelining_enabled:
+                try:
+                    await self._pipelined_handshake(reader, writer, proxy, host, port)
+                    return reader, writer
+                except _PipeliningRejected as e:
+                    logger.debug(f"Pipelined handshake rejected by {proxy['name']}, using sequential: {e}")
+                    state.pipelining = False
+                    dropped = False
+                except (asyncio.IncompleteReadError, ConnectionError) as e:
+                    logger.debug(f"Pipelined handshake with {proxy['name']} dropped, trying sequential: {e}")
+                    dropped = True
+                writer.close()
+                reader, writer = await self._open_connection(proxy)
+                await negotiate(reader, writer, proxy)
+                if dropped:
+                    # the upstream is fine with a sequential handshake, so pipelining was the problem
+                    state.pipelining_retry_at = time.monotonic() + PIPELINING_RETRY_AFTER
+            else:
+                await negotiate(reader, writer, proxy)
+
+            writer.write(connect_request(host, port))
+            await writer.drain()
+            await asyncio.wait_for(read_reply(reader), timeout=self.connect_timeout)
+            return reader, writer
+        except BaseException:
+            writer.close()
+            raise
+
+    async def _open_connection(self, proxy: Dict):
+        return await asyncio.wait_for(
+            asyncio.open_connection(proxy['host'], proxy['port']), timeout=self.connect_timeout
+        )
+
+    async def _pipelined_handshake(self, reader, writer, proxy: Dict, host: str, port: int):
+        with_auth = bool(proxy.get('username') and proxy.get('password'))
+        data = greeting(proxy)
+        if with_auth:
+            data += auth_request(proxy)
+        writer.write(data + connect_request(host, port))
+        await writer.drain()
+
+        ver, method = await asyncio.wait_for(reader.readexactly(2), timeout=self.connect_timeout)
+        if ver != 5 or method != (0x02 if with_auth else 0x00):
+            # the rest of what we sent would be misread
+            raise _PipeliningRejected(f"method {method}")
+
+        if with_auth:
+            _, status = await asyncio.wait_for(reader.readexactly(2), timeout=self.connect_timeout)
+            if status != 0:
+                raise SocksError(f"SOCKS5 authentication failed: status {status}")
+
+        await asyncio.wait_for(read_reply(reader), timeout=self.connect_timeout)
+
+    def _target(self, state: _UpstreamState) -> int:
+        # connections expected to arrive while one is being prepared, doubled
+        if not self.max_idle or state.rate < 0.01:
+            return 0
+        return min(self.max_idle, max(1, math.ceil(state.rate * state.handshake_time * 2)))
+
+    def _refill(self, state: _UpstreamState):
+        missing = self._target(state) - len(state.idle) - state.opening
+        for _ in range(max(missing, 0)):
+            state.opening += 1
+            asyncio.create_task(self._warm(state))
+
+    async def _warm(self, state: _UpstreamState):
+        proxy = state.proxy
+        started = time.monotonic()
+        writer = None
+        try:
+            reader, writer = await self._open_connection(proxy)
+            await asyncio.wait_for(negotiate(reader, writer, proxy), timeout=self.connect_timeout)
+            state.handshake_time += RATE_ALPHA * (time.monotonic() - started - state.handshake_time)
+            state.idle.append((reader, writer, time.monotonic()))
+        except Exception as e:
+            logger.debug(f"Failed to pre-warm connection to {proxy['name']}: {e}")
+            if writer:
+                writer.close()
+        finally:
+            state.opening -= 1
+
+    def start(self, interval: float = 1.0):
+        self._maintain_task = asyncio.create_task(self._maintain(interval))
+
+    async def _maintain(self, interval: float):
+        """Update arrival rates, drop stale idle connections and top pools up"""
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for proxy_id, state in list(self._upstreams.items()):
+                state.rate += RATE_ALPHA * (state.arrivals / interval - state.rate)
+                state.arrivals = 0
+
+                target = self._target(state)
+                while state.idle and (len(state.idle) > target or now - state.idle[0][2] > self.idle_timeout
+                                      or state.idle[0][0].at_eof()):
+                    state.idle.popleft()[1].close()
+
+                if not target and not state.idle and not state.opening:
+                    del self._upstreams[proxy_id]
+                    continue
+                self._refill(state)
+
+    def discard(self, proxy_id: int):
+        state = self._upstreams.pop(proxy_id, None)
+        if state:
+            for _, writer, _ in state.idle:
+                writer.close()
+
+    def close(self):
+        if self._maintain_task:
+            self._maintain_task.cancel()
+        for proxy_id in list(self._upstreams):
+            self.discard(proxy_id)
+
+    def stats(self) -> Dict[int, Dict]:
+        return {
+            proxy_id: {
+                'idle': len(state.idle),
+                'target': self._target(state),
+                'rate': round(state.rate, 2),
+                'pipelining': state.pipelining_enabled,
+            }
+            for proxy_id, state in self._upstreams.items()
+        }
@@ -0,0 +1,305 @@
+import hashlib
+import hmac
+import json
+import time
+from collections import OrderedDict
+from string import Formatter
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Optional, Set, Tuple
+
+from app.subscription.compression import COMPRESSORS
+from config import (
+    CLASH_SETTINGS_TEMPLATE,
+    CLASH_SUBSCRIPTION_TEMPLATE,
+    GRPC_USER_AGENT_TEMPLATE,
+    MUX_TEMPLATE,
+    SINGBOX_SETTINGS_TEMPLATE,
+    SINGBOX_SUBSCRIPTION_TEMPLATE,
+    SUB_CACHE_SIZE,
+    SUB_CACHE_TTL,
+    SUB_CACHE_USAGE_BUCKET,
+    USER_AGENT_TEMPLATE,
+    V2RAY_SETTINGS_TEMPLATE,
+    V2RAY_SUBSCRIPTION_TEMPLATE,
+)
+
+SUBSCRIPTION_TEMPLATES = (
+    CLASH_SUBSCRIPTION_TEMPLATE,
+    CLASH_SETTINGS_TEMPLATE,
+    SINGBOX_SUBSCRIPTION_TEMPLATE,
+    SINGBOX_SETTINGS_TEMPLATE,
+    V2RAY_SUBSCRIPTION_TEMPLATE,
+    V2RAY_SETTINGS_TEMPLATE,
+    MUX_TEMPLATE,
+    USER_AGENT_TEMPLATE,
+    GRPC_USER_AGENT_TEMPLATE,
+)
+
+# host variables whose value changes with the clock or the user's traffic usage
+VOLATILE_VARIABLES = ("DAYS_LEFT", "TIME_LEFT", "DATA_USAGE", "DATA_LEFT")
+
+if TYPE_CHECKING:
+    from app.db.models import User
+
+
+def user_state_key(dbuser: "User") -> str:
+    """
+    Builds a digest of everything in a user's state that can change a rendered subscription.
+
+    Traffic usage is bucketed by SUB_CACHE_USAGE_BUCKET so that regular usage
+    recording does not invalidate every entry on each tick.
+    """
+    usage_bucket = (dbuser.used_traffic or 0) // SUB_CACHE_USAGE_BUCKET if SUB_CACHE_USAGE_BUCKET > 0 \
+        else dbuser.used_traffic
+    return _state_digest(dbuser, usage_bucket)
+
+
+def _state_digest(dbuser: "User", usage) -> str:
+    proxies = sorted(
+        (
+            str(proxy.type),
+            json.dumps(proxy.settings, sort_keys=True, default=str),
+            sorted(i.tag for i in proxy.excluded_inbounds),
+        )
+        for proxy in dbuser.proxies
+    )
+    state = [
+        dbuser.username,
+        proxies,
+        str(dbuser.status),
+        dbuser.expire,
+        dbuser.data_limit,
+        usage,
+        dbuser.on_hold_expire_duration,
+    ]
+    return hashlib.sha1(json.dumps(state, default=str).encode()).hexdigest()
+
+
+def used_variables(texts: Iterable[Optional[str]]) -> Set[str]:
+    """Names of the format variables in host remarks, addresses and paths."""
+    names = set()
+    for text in texts:
+        if not text or not isinstance(text, str):
+            continue
+        try:
+            names.update(name for _, name, _, _ in Formatter().parse(text) if name)
+        except ValueError:  # fails the same way when rendered
+            pass
+    return names
+
+
+def volatile_values(dbuser: "User", variables: Tuple[str, ...]) -> Tuple[str, ...]:
+    """Current values of the given VOLATILE_VARIABLES for `dbuser`, as a subscription would show them."""
+    if not variables:
+        return ()
+
+    from app.subscription.share import setup_format_variables
+
+    values = setup_format_variables({
+        "username": dbuser.username,
+        "status": dbuser.status,
+        "expire": dbuser.expire,
+        "on_hold_expire_duration": dbuser.on_hold_expire_duration,
+        "data_limit": dbuser.data_limit,
+        "used_traffic": dbuser.used_traffic,
+    })
+    return tuple(str(values[name]) for name in variables)
+
+
+class RenderedSubscription:
+    """
+    A rendered subscription body and the compressed variants of it.
+
+    Variants are made on first request and kept with the body, so a cached
+    subscription is compressed once per coding rather than once per poll.
+    """
+
+    __slots__ = ("body", "_encoded")
+
+    def __init__(self, body: str):
+        self.body = body.encode()
+        self._encoded: Dict[str, bytes] = {}
+
+    def encode(self, encoding: Optional[str] = None) -> bytes:
+        if encoding is None:
+            return self.body
+
+        data = self._encoded.get(encoding)
+        if data is None:
+            data = self._encoded[encoding] = COMPRESSORS[encoding](self.body)
+        return data
+
+
+class SubscriptionCache:
+    """
+    Bounded LRU cache of rendered subscription bodies.
+
+    Keys are built from the username, the user's state digest, the current
+    hosts/config generation and the format flags, so a changed user or a
+    reloaded host list never serves a stale body. Entries also expire after
+    `ttl` seconds because remarks can hold time-dependent variables.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._by_user: Dict[str, Set[Tuple]] = {}
+        self._lock = Lock()
+        self._etag_key: Optional[bytes] = None
+        self._fingerprint: Optional[Tuple[int, str, Tuple[str, ...]]] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    def make_key(self, dbuser: "User", config_format: str, as_base64: bool, reverse: bool) -> Tuple:
+        return (
+            dbuser.username.lower(),
+            self.generation,
+            user_state_key(dbuser),
+            config_format,
+            as_base64,
+            reverse,
+        )
+
+    def etag(self, dbuser: "User", key: Tuple) -> str:
+        """
+        Entity tag of the body rendered for `dbuser` under `key`.
+
+        Generations are local to a process, so instead of the key's generation
+        the tag covers a digest of the hosts, inbounds and templates, which is the
+        same in every worker and after restarts. Signed with a key derived from
+        the JWT secret.
+
+        Traffic usage and the clock only reach a body through host variables,
+        so the tag leaves out the usage bucket of the cache key and covers the
+        current values of the VOLATILE_VARIABLES the hosts actually use. It
+        changes as often as they do, e.g. once a day for {DAYS_LEFT}, and stays
+        the same across polls for hosts that use none of them.
+        """
+        if self._etag_key is None:
+            from app.utils.jwt import get_secret_key
+            self._etag_key = hashlib.sha256(f"subscription-etag:{get_secret_key()}".encode()).digest()
+
+        fingerprint, variables = self._content_fingerprint()
+        username, _, _, *flags = key
+        message = repr((
+            fingerprint,
+            username,
+            _state_digest(dbuser, usage=None),
+            volatile_values(dbuser, variables),
+            *flags,
+        )).encode()
+        return f'"{hmac.new(self._etag_key, message, hashlib.sha1).hexdigest()}"'
+
+    def _content_fingerprint(self) -> Tuple[str, Tuple[str, ...]]:
+        """
+        Digest of everything besides the user that shapes a subscription, and the
+        VOLATILE_VARIABLES used by hosts or inbound paths, kept per generation.
+        """
+        from app import xray
+        from app.templates import env
+
+        # loading the hosts starts a new generation, it has to happen before reading it
+        iter(xray.hosts)
+        generation = self.generation
+        fingerprint = self._fingerprint
+        if fingerprint is not None and fingerprint[0] == generation:
+            return fingerprint[1:]
+
+        hosts = {tag: xray.hosts[tag] for tag in xray.hosts}
+        inbounds = xray.config.inbounds_by_tag
+        digest = hashlib.sha1(json.dumps([hosts, inbounds], sort_keys=True, default=str).encode())
+        for template in SUBSCRIPTION_TEMPLATES:
+            try:
+                digest.update(env.loader.get_source(env, template)[0].encode())
+            except Exception:  # optional settings templates
+                pass
+
+        names = used_variables(
+            [host["remark"] for tag_hosts in hosts.values() for host in tag_hosts]
+            + [address for tag_hosts in hosts.values() for host in tag_hosts for address in host["address"]]
+            + [host["path"] for tag_hosts in hosts.values() for host in tag_hosts]
+            + [inbound.get("path") for inbound in inbounds.values()]
+        )
+        variables = tuple(name for name in VOLATILE_VARIABLES if name in names)
+
+        self._fingerprint = (generation, digest.hexdigest(), variables)
+        return self._fingerprint[1:]
+
+    def get(self, key: Tuple):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._pop(key)
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Tuple, value) -> None:
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._by_user.setdefault(key[0], set()).add(key)
+
+            while len(self._data) > self.maxsize:
+                oldest, _ = self._data.popitem(last=False)
+                self._discard_user_key(oldest)
+
+    def get_or_render(self, key: Tuple, render: Callable[[], str]) -> RenderedSubscription:
+        if not self.enabled:
+            return RenderedSubscription(render())
+
+        conf = self.get(key)
+        if conf is None:
+            conf = RenderedSubscription(render())
+            self.set(key, conf)
+        return conf
+
+    def invalidate_user(self, username: str) -> None:
+        with self._lock:
+            for key in self._by_user.pop(username.lower(), set()):
+                self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Drops every entry and starts a new hosts/config generation."""
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self._by_user.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "generation": self.generation,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _pop(self, key: Tuple) -> None:
+        self._data.pop(key, None)
+        self._discard_user_key(key)
+
+    def _discard_user_key(self, key: Tuple) -> None:
+        keys = self._by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[key[0]]
+
+
+subscription_cache = SubscriptionCache(maxsize=SUB_CACHE_SIZE, ttl=SUB_CACHE_TTL)
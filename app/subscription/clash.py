@@ -1,5 +1,5 @@
 import copy
-import json
+import os
 from random import choice
 from uuid import UUID
 
@@ -7,16 +7,64 @@ import yaml
 from jinja2.exceptions import TemplateNotFound
 
 from app.subscription.funcs import get_grpc_gun
-from app.templates import render_template
+from app.templates import clone, env, render_template, template_artifacts
 from app.utils.helpers import yml_uuid_representer
 from config import (
     CLASH_SETTINGS_TEMPLATE,
     CLASH_SUBSCRIPTION_TEMPLATE,
+    CLASH_YAML_LIBYAML,
     MUX_TEMPLATE,
     USER_AGENT_TEMPLATE,
 )
 
 
+if CLASH_YAML_LIBYAML:
+    _SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    _SafeDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+else:
+    _SafeLoader, _SafeDumper = yaml.SafeLoader, yaml.SafeDumper
+
+
+def _load_yaml(text: str):
+    return yaml.load(text, Loader=_SafeLoader)
+
+
+# used by the `yaml` filter when custom templates are rendered
+yaml.add_representer(UUID, yml_uuid_representer)
+
+
+class _ClashDumper(_SafeDumper):
+    """Safe dumper, backed by libyaml if enabled and PyYAML was built with it"""
+
+    def ignore_aliases(self, data):
+        # ids are shared between proxies, they were never written as anchors
+        return isinstance(data, UUID) or super().ignore_aliases(data)
+
+
+_ClashDumper.add_representer(UUID, yml_uuid_representer)
+
+BUILTIN_SUBSCRIPTION_TEMPLATE = os.path.abspath("app/templates/clash/default.yml")
+AUTOMATIC_PROXY_GROUP = {
+    'name': '♻️ Automatic',
+    'type': 'url-test',
+    'url': 'http://www.gstatic.com/generate_204',
+    'interval': 300,
+}
+
+
+def _sort_keys(value):
+    """Orders mappings the way the `yaml` template filter did"""
+    if isinstance(value, dict):
+        return {key: _sort_keys(value[key]) for key in sorted(value)}
+    if isinstance(value, list):
+        return [_sort_keys(v) for v in value]
+    return value
+
+
+def dump_yaml(data) -> str:
+    return yaml.dump(data, Dumper=_ClashDumper, sort_keys=False, allow_unicode=True)
+
+
 class ClashConfiguration(object):
     def __init__(self):
         self.data = {
@@ -26,8 +74,8 @@ class ClashConfiguration(object):
             'rules': []
         }
         self.proxy_remarks = []
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
+        self.mux_template = template_artifacts.get(MUX_TEMPLATE)
+        user_agent_data = template_artifacts.get(USER_AGENT_TEMPLATE)
 
         if 'list' in user_agent_data and isinstance(user_agent_data['list'], list):
             self.user_agent_list = user_agent_data['list']
@@ -35,7 +83,7 @@ class ClashConfiguration(object):
             self.user_agent_list = []
 
         try:
-            self.settings = yaml.load(render_template(CLASH_SETTINGS_TEMPLATE), Loader=yaml.SafeLoader)
+            self.settings = template_artifacts.get(CLASH_SETTINGS_TEMPLATE, _load_yaml)
         except TemplateNotFound:
             self.settings = {}
 
@@ -45,19 +93,26 @@ class ClashConfiguration(object):
         if reverse:
             self.data['proxies'].reverse()
 
-        yaml.add_representer(UUID, yml_uuid_representer)
-        return yaml.dump(
-            yaml.load(
-                render_template(
-                    CLASH_SUBSCRIPTION_TEMPLATE,
-                    {"conf": self.data, "proxy_remarks": self.proxy_remarks}
-                ),
-                Loader=yaml.SafeLoader
-
-            ),
-            sort_keys=False,
-            allow_unicode=True,
-        )
+        if os.path.abspath(env.get_template(CLASH_SUBSCRIPTION_TEMPLATE).filename) != BUILTIN_SUBSCRIPTION_TEMPLATE:
+            return self.render_template()
+
+        # builds the document the default template describes, without the text round trip
+        document = {'mode': 'Global', 'port': 7890}
+        document.update(_sort_keys(
+            {key: value for key, value in self.data.items() if key not in ('proxy-groups', 'port', 'mode')}
+        ))
+        document['proxy-groups'] = [
+            {**AUTOMATIC_PROXY_GROUP, 'proxies': self.proxy_remarks or None},
+            *_sort_keys(self.data.get('proxy-groups', [])),
+        ]
+        return dump_yaml(document)
+
+    def render_template(self) -> str:
+        """Renders the configured template to text and normalizes it, needed for custom templates"""
+        return dump_yaml(_load_yaml(render_template(
+            CLASH_SUBSCRIPTION_TEMPLATE,
+            {"conf": self.data, "proxy_remarks": self.proxy_remarks}
+        )))
 
     def __str__(self) -> str:
         return self.render()
@@ -245,8 +300,7 @@ class ClashConfiguration(object):
 
         node[f'{network}-opts'] = net_opts
 
-        mux_json = json.loads(self.mux_template)
-        mux_config = mux_json["clash"]
+        mux_config = clone(self.mux_template["clash"])
 
         if mux_enable:
             node['smux'] = mux_config
@@ -0,0 +1,59 @@
+import gzip
+from typing import Callable, Dict, Optional
+
+from config import SUB_COMPRESSION, SUB_COMPRESSION_MIN_SIZE
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is used for every client then
+    brotli = None
+
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {
+    "gzip": lambda data: gzip.compress(data, compresslevel=6, mtime=0),
+}
+if brotli is not None:
+    COMPRESSORS["br"] = lambda data: brotli.compress(data, quality=5)
+
+# most preferred first
+PREFERENCE = ("br", "gzip")
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """Maps the codings of an Accept-Encoding header to their q values."""
+    codings = {}
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Picks the content coding of a response from the client's Accept-Encoding,
+    `None` sends it as is. Only depends on the request, so it's known before
+    the body is rendered and the ETag can be made weak or strong from it.
+    """
+    if not SUB_COMPRESSION or not accept_encoding:
+        return None
+
+    codings = parse_accept_encoding(accept_encoding)
+    for coding in PREFERENCE:
+        if coding in COMPRESSORS and codings.get(coding, codings.get("*", 0)) > 0:
+            return coding
+    return None
+
+
+def worth_compressing(size: int) -> bool:
+    """Whether a body of `size` bytes is large enough to be sent in the negotiated coding."""
+    return size >= SUB_COMPRESSION_MIN_SIZE
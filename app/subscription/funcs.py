@@ -1,3 +1,9 @@
+from config import SUB_COMPACT_JSON
+
+# json.dumps arguments of JSON subscriptions
+JSON_FORMAT = {"separators": (",", ":")} if SUB_COMPACT_JSON else {"indent": 4}
+
+
 def get_grpc_gun(path: str) -> str:
     if not path.startswith("/"):
         return path
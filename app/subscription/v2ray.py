@@ -9,8 +9,8 @@ from uuid import UUID
 
 from jinja2.exceptions import TemplateNotFound
 
-from app.subscription.funcs import get_grpc_gun, get_grpc_multi
-from app.templates import render_template
+from app.subscription.funcs import JSON_FORMAT, get_grpc_gun, get_grpc_multi
+from app.templates import clone, template_artifacts
 from app.utils.helpers import UUIDEncoder
 from config import (
     EXTERNAL_CONFIG,
@@ -489,16 +489,16 @@ class V2rayJsonConfig(str):
 
     def __init__(self):
         self.config = []
-        self.template = render_template(V2RAY_SUBSCRIPTION_TEMPLATE)
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
+        self.template = template_artifacts.get(V2RAY_SUBSCRIPTION_TEMPLATE)
+        self.mux_template = template_artifacts.get(MUX_TEMPLATE)
+        user_agent_data = template_artifacts.get(USER_AGENT_TEMPLATE)
 
         if 'list' in user_agent_data and isinstance(user_agent_data['list'], list):
             self.user_agent_list = user_agent_data['list']
         else:
             self.user_agent_list = []
 
-        grpc_user_agent_data = json.loads(render_template(GRPC_USER_AGENT_TEMPLATE))
+        grpc_user_agent_data = template_artifacts.get(GRPC_USER_AGENT_TEMPLATE)
 
         if 'list' in grpc_user_agent_data and isinstance(grpc_user_agent_data['list'], list):
             self.grpc_user_agent_data = grpc_user_agent_data['list']
@@ -506,22 +506,23 @@ class V2rayJsonConfig(str):
             self.grpc_user_agent_data = []
 
         try:
-            self.settings = json.loads(render_template(V2RAY_SETTINGS_TEMPLATE))
+            self.settings = template_artifacts.get(V2RAY_SETTINGS_TEMPLATE)
         except TemplateNotFound:
             self.settings = {}
 
         del user_agent_data, grpc_user_agent_data
 
     def add_config(self, remarks, outbounds):
-        json_template = json.loads(self.template)
+        # only the top level differs between hosts, the rest of the template is shared
+        json_template = dict(self.template)
         json_template["remarks"] = remarks
-        json_template["outbounds"] = outbounds + json_template["outbounds"]
+        json_template["outbounds"] = outbounds + self.template["outbounds"]
         self.config.append(json_template)
 
     def render(self, reverse=False):
         if reverse:
             self.config.reverse()
-        return json.dumps(self.config, indent=4, cls=UUIDEncoder)
+        return json.dumps(self.config, cls=UUIDEncoder, **JSON_FORMAT)
 
     @staticmethod
     def tls_config(sni=None, fp=None, alpn=None, ais: bool = False) -> dict:
@@ -708,9 +709,9 @@ class V2rayJsonConfig(str):
                 "header": {}
             }))
         else:
-            config = self.settings.get("httpSettings", {
+            config = copy.deepcopy(self.settings.get("httpSettings", {
                 "header": {}
-            })
+            }))
         if "header" not in config:
             config["header"] = {}
 
@@ -1072,8 +1073,7 @@ class V2rayJsonConfig(str):
             keepAlivePeriod=inbound.get("keepAlivePeriod", 0),
         )
 
-        mux_json = json.loads(self.mux_template)
-        mux_config = mux_json["v2ray"]
+        mux_config = clone(self.mux_template["v2ray"])
 
         if inbound.get('mux_enable', False):
             outbound["mux"] = mux_config
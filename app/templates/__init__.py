@@ -1,5 +1,7 @@
+import json
 from datetime import datetime
-from typing import Union
+from threading import Lock
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 
 import jinja2
 
@@ -19,3 +21,63 @@ env.globals['now'] = datetime.utcnow
 
 def render_template(template: str, context: Union[dict, None] = None) -> str:
     return env.get_template(template).render(context or {})
+
+
+def clone(value: Any) -> Any:
+    """Copies the dicts and lists of a parsed template, for callers that modify it"""
+    if isinstance(value, dict):
+        return {k: clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [clone(v) for v in value]
+    return value
+
+
+class TemplateArtifacts:
+    """
+    Templates rendered without a context and parsed once, shared by every request.
+
+    Jinja hands out a new Template object once a template's file mtime
+    changes, which is what invalidates the parsed artifact. Artifacts are
+    shared, callers must `clone` whatever they modify.
+    """
+
+    def __init__(self):
+        self._entries: Dict[Tuple[str, Callable], Tuple[jinja2.Template, Any]] = {}
+        self._lock = Lock()
+
+    def get(self, template: str, parse: Callable[[str], Any] = json.loads) -> Any:
+        source = env.get_template(template)
+        key = (template, parse)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is source:
+            return entry[1]
+
+        value = parse(source.render())
+        with self._lock:
+            self._entries[key] = (source, value)
+
+        if entry is not None:
+            # subscriptions rendered from the old template are stale as well
+            from app.subscription.cache import subscription_cache
+            subscription_cache.clear()
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+template_artifacts = TemplateArtifacts()
+
+
+def reload_templates(custom_directory: Optional[str] = CUSTOM_TEMPLATES_DIRECTORY):
+    """Loads templates from another custom directory and drops everything parsed before"""
+    template_directories[:] = ["app/templates"]
+    if custom_directory:
+        template_directories.insert(0, custom_directory)
+    env.loader = jinja2.FileSystemLoader(template_directories)
+    env.cache.clear()
+    template_artifacts.clear()
+
+    from app.subscription.cache import subscription_cache
+    subscription_cache.clear()
@@ -5,6 +5,7 @@ from app.models.proxy import ProxyHostSecurity
 from app.utils.store import DictStorage
 from app.utils.system import check_port
 from app.xray import operations
+from app.xray.aio import async_api
 from app.xray.config import XRayConfig
 from app.xray.core import XRayCore
 from app.xray.node import XRayNode
@@ -36,8 +37,10 @@ if TYPE_CHECKING:
 @DictStorage
 def hosts(storage: dict):
     from app.db import GetDB, crud
+    from app.subscription.cache import subscription_cache
 
     storage.clear()
+    subscription_cache.clear()
     with GetDB() as db:
         for inbound_tag in config.inbounds_by_tag:
             inbound_hosts: Sequence[ProxyHost] = crud.get_hosts(db, inbound_tag)
@@ -72,6 +75,7 @@ __all__ = [
     "hosts",
     "core",
     "api",
+    "async_api",
     "nodes",
     "operations",
     "exceptions",
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple, TypeVar
+
+from config import XRAY_API_MAX_CONCURRENCY
+from xray_api import XRay as XRayAPI
+from xray_api.aio import XRay as AsyncXRayAPI
+
+T = TypeVar("T")
+
+
+class AsyncAPIRunner:
+    """
+    Runs xray API calls of the main core and all nodes on one event loop thread.
+
+    Synchronous code (jobs, routers) submits coroutines with `run`. Each core gets
+    one `xray_api.aio.XRay` client, derived from its synchronous client, so the
+    gRPC channel is reused across calls and in-flight calls are capped per core.
+    Clients of removed or reconnected nodes are dropped with `discard`.
+    """
+
+    def __init__(self, max_concurrency: int = 32):
+        self.max_concurrency = max_concurrency
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._clients: Dict[Tuple, AsyncXRayAPI] = {}
+        self._closing: Set[Future] = set()
+        self._lock = threading.Lock()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="xray-api-aio", daemon=True).start()
+            return self._loop
+
+    def run(self, coro: Awaitable[T], timeout: float = None) -> T:
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result(timeout)
+
+    @staticmethod
+    def _key(api: XRayAPI) -> Tuple:
+        return api.address, api.port, api.ssl_cert, api.ssl_target_name
+
+    def client(self, api: XRayAPI) -> AsyncXRayAPI:
+        key = self._key(api)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = AsyncXRayAPI(*key, max_concurrency=self.max_concurrency)
+            return client
+
+    def discard(self, api: XRayAPI):
+        """Drops the client of a core and closes its channel, without waiting for it."""
+        with self._lock:
+            client = self._clients.pop(self._key(api), None)
+            loop = self._loop
+        if client is None or loop is None or loop.is_closed():
+            return
+
+        future = asyncio.run_coroutine_threadsafe(client.close(), loop)
+        self._closing.add(future)
+        future.add_done_callback(self._closing.discard)
+
+    async def gather(self,
+                     apis: Dict[Optional[int], XRayAPI],
+                     call: Callable[[AsyncXRayAPI, Optional[int]], Awaitable[T]]) -> Dict[Optional[int], T]:
+        """`call` every core concurrently, exceptions are returned in place of results."""
+        results = await asyncio.gather(
+            *(call(self.client(api), node_id) for node_id, api in apis.items()),
+            return_exceptions=True
+        )
+        return dict(zip(apis, results))
+
+
+async_api = AsyncAPIRunner(max_concurrency=XRAY_API_MAX_CONCURRENCY)
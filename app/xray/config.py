@@ -1,20 +1,27 @@
 from __future__ import annotations
 
 import json
-from collections import defaultdict
+import threading
+import time
 from copy import deepcopy
 from pathlib import PosixPath
-from typing import Union
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Union
 
 import commentjson
 from sqlalchemy import func
 
 from app.db import GetDB
 from app.db import models as db_models
+from app.db.changes import user_changes
 from app.models.proxy import ProxyTypes
 from app.models.user import UserStatus
 from app.utils.crypto import get_cert_SANs
-from config import DEBUG, XRAY_EXCLUDE_INBOUND_TAGS, XRAY_FALLBACKS_INBOUND_TAG
+from config import (
+    DEBUG,
+    XRAY_CLIENTS_RESYNC_INTERVAL,
+    XRAY_EXCLUDE_INBOUND_TAGS,
+    XRAY_FALLBACKS_INBOUND_TAG,
+)
 
 
 def merge_dicts(a, b):  # B will override A dictionary key and values
@@ -56,11 +63,27 @@ class XRayConfig(dict):
         self.inbounds = []
         self.inbounds_by_protocol = {}
         self.inbounds_by_tag = {}
+        self._index_inbounds()
         self._fallbacks_inbound = self.get_inbound(XRAY_FALLBACKS_INBOUND_TAG)
         self._resolve_inbounds()
 
         self._apply_api()
 
+        # clients of active and on_hold users, kept up to date by `include_db_users`
+        self._clients: Dict[str, Dict[int, dict]] = {}  # inbound tag -> user id -> client
+        self._user_tags: Dict[int, Set[str]] = {}
+        self._clients_version: Optional[int] = None
+        self._clients_synced_at: Optional[float] = None
+        self._users_config: Optional[XRayConfig] = None
+        self._users_lock = threading.Lock()
+        self._builds = 0
+        self.version: Optional[int] = None
+        self._encoded = {}
+        self._encode_lock = threading.Lock()
+
+    def _index_inbounds(self):
+        self._inbounds_by_tag_raw = {inbound['tag']: inbound for inbound in self.get('inbounds', [])}
+
     def _apply_api(self):
         api_inbound = self.get_inbound("API_INBOUND")
         if api_inbound:
@@ -110,6 +133,7 @@ class XRayConfig(dict):
         except KeyError:
             self["inbounds"] = []
             self["inbounds"].insert(0, inbound)
+        self._index_inbounds()
 
         rule = {
             "inboundTag": [
@@ -343,9 +367,7 @@ class XRayConfig(dict):
                 self.inbounds_by_protocol[inbound['protocol']] = [settings]
 
     def get_inbound(self, tag) -> dict:
-        for inbound in self['inbounds']:
-            if inbound['tag'] == tag:
-                return inbound
+        return self._inbounds_by_tag_raw.get(tag)
 
     def get_outbound(self, tag) -> dict:
         for outbound in self['outbounds']:
@@ -355,82 +377,199 @@ class XRayConfig(dict):
     def to_json(self, **json_kwargs):
         return json.dumps(self, **json_kwargs)
 
+    def iter_json(self, clients_per_chunk: int = 1000) -> Iterator[str]:
+        """
+        Yields the same text as `to_json()` in pieces.
+
+        The config without clients is serialized in one go, the clients of each
+        inbound in batches of `clients_per_chunk`.
+        """
+        skeleton = dict(self)
+        skeleton['inbounds'] = []
+        clients_by_marker = {}
+        for i, inbound in enumerate(self.get('inbounds', [])):
+            clients = (inbound.get('settings') or {}).get('clients')
+            if clients:
+                marker = f"\x00clients:{i}\x00"
+                clients_by_marker[json.dumps(marker)] = clients
+                inbound = {**inbound, 'settings': {**inbound['settings'], 'clients': marker}}
+            skeleton['inbounds'].append(inbound)
+
+        text = json.dumps(skeleton)
+        position = 0
+        for marker, clients in clients_by_marker.items():
+            index = text.index(marker, position)
+            yield text[position:index] + '['
+            for start in range(0, len(clients), clients_per_chunk):
+                batch = json.dumps(clients[start:start + clients_per_chunk])[1:-1]
+                yield batch if start == 0 else ', ' + batch
+            yield ']'
+            position = index + len(marker)
+        yield text[position:]
+
+    def shared_json(self) -> str:
+        """`to_json()` serialized once per config object, for sending it to several nodes."""
+        with self._encode_lock:
+            if 'text' not in self._encoded:
+                self._encoded['text'] = ''.join(self.iter_json())
+            return self._encoded['text']
+
+    def shared_json_field(self, chunk_size: int = 65536) -> List[bytes]:
+        """
+        The config JSON encoded as a JSON string literal, in chunks of about `chunk_size` bytes.
+
+        Serialized once per config object and without building the whole text first,
+        for request bodies that carry the config as a string field.
+        """
+        with self._encode_lock:
+            if 'field' not in self._encoded:
+                chunks, pending, size = [b'"'], [], 0
+                for piece in self.iter_json():
+                    # escaping is per character, so pieces can be escaped on their own
+                    piece = json.encoder.encode_basestring_ascii(piece)[1:-1].encode()
+                    pending.append(piece)
+                    size += len(piece)
+                    if size >= chunk_size:
+                        chunks.append(b''.join(pending))
+                        pending, size = [], 0
+                chunks.append(b''.join(pending) + b'"')
+                self._encoded['field'] = chunks
+            return self._encoded['field']
+
     def copy(self):
-        return deepcopy(self)
+        config = self.__class__.__new__(self.__class__)
+        dict.update(config, deepcopy(dict(self)))
+        config.api_host = self.api_host
+        config.api_port = self.api_port
+        config.inbounds = self.inbounds
+        config.inbounds_by_protocol = self.inbounds_by_protocol
+        config.inbounds_by_tag = self.inbounds_by_tag
+        config._index_inbounds()
+        config._fallbacks_inbound = config.get_inbound(XRAY_FALLBACKS_INBOUND_TAG)
+        config._clients = {}
+        config._user_tags = {}
+        config._clients_version = None
+        config._clients_synced_at = None
+        config._users_config = None
+        config._users_lock = threading.Lock()
+        config._builds = 0
+        config.version = self.version
+        config._encoded = {}
+        config._encode_lock = threading.Lock()
+        return config
 
-    def include_db_users(self) -> XRayConfig:
-        config = self.copy()
+    @staticmethod
+    def _user_clients_query(db, user_ids: Optional[Iterable[int]] = None):
+        query = db.query(
+            db_models.User.id,
+            db_models.User.username,
+            func.lower(db_models.Proxy.type).label('type'),
+            db_models.Proxy.settings,
+            func.group_concat(db_models.excluded_inbounds_association.c.inbound_tag).label('excluded_inbound_tags')
+        ).join(
+            db_models.Proxy, db_models.User.id == db_models.Proxy.user_id
+        ).outerjoin(
+            db_models.excluded_inbounds_association,
+            db_models.Proxy.id == db_models.excluded_inbounds_association.c.proxy_id
+        ).filter(
+            db_models.User.status.in_([UserStatus.active, UserStatus.on_hold])
+        )
+        if user_ids is not None:
+            query = query.filter(db_models.User.id.in_(user_ids))
+        return query.group_by(
+            func.lower(db_models.Proxy.type),
+            db_models.User.id,
+            db_models.User.username,
+            db_models.Proxy.settings,
+        )
+
+    @staticmethod
+    def _inbound_client(inbound: dict, client: dict) -> dict:
+        # XTLS currently only supports transmission methods of TCP and mKCP
+        if client.get('flow') and (
+                inbound.get('network', 'tcp') not in ('tcp', 'raw', 'kcp')
+                or
+                (
+                    inbound.get('network', 'tcp') in ('tcp', 'raw', 'kcp')
+                    and
+                    inbound.get('tls') not in ('tls', 'reality')
+                )
+                or
+                inbound.get('header_type') == 'http'
+        ):
+            client = {k: v for k, v in client.items() if k != 'flow'}
+        return client
+
+    def _add_client_rows(self, rows):
+        for row in rows:
+            inbounds = self.inbounds_by_protocol.get(row.type)
+            if not inbounds:
+                continue
 
-        with GetDB() as db:
-            query = db.query(
-                db_models.User.id,
-                db_models.User.username,
-                func.lower(db_models.Proxy.type).label('type'),
-                db_models.Proxy.settings,
-                func.group_concat(db_models.excluded_inbounds_association.c.inbound_tag).label('excluded_inbound_tags')
-            ).join(
-                db_models.Proxy, db_models.User.id == db_models.Proxy.user_id
-            ).outerjoin(
-                db_models.excluded_inbounds_association,
-                db_models.Proxy.id == db_models.excluded_inbounds_association.c.proxy_id
-            ).filter(
-                db_models.User.status.in_([UserStatus.active, UserStatus.on_hold])
-            ).group_by(
-                func.lower(db_models.Proxy.type),
-                db_models.User.id,
-                db_models.User.username,
-                db_models.Proxy.settings,
-            )
-            result = query.all()
-
-            grouped_data = defaultdict(list)
-
-            for row in result:
-                grouped_data[row.type].append((
-                    row.id,
-                    row.username,
-                    row.settings,
-                    [i for i in row.excluded_inbound_tags.split(',') if i] if row.excluded_inbound_tags else None
-                ))
-
-            for proxy_type, rows in grouped_data.items():
-
-                inbounds = self.inbounds_by_protocol.get(proxy_type)
-                if not inbounds:
+            excluded_inbound_tags = row.excluded_inbound_tags.split(',') if row.excluded_inbound_tags else ()
+            client = {
+                "email": f"{row.id}.{row.username}",
+                **row.settings
+            }
+            for inbound in inbounds:
+                if inbound['tag'] in excluded_inbound_tags:
                     continue
+                self._clients.setdefault(inbound['tag'], {})[row.id] = self._inbound_client(inbound, client)
+                self._user_tags.setdefault(row.id, set()).add(inbound['tag'])
 
-                for inbound in inbounds:
-                    clients = config.get_inbound(inbound['tag'])['settings']['clients']
+    def _sync_clients(self) -> bool:
+        """Bring the client index up to date, returns whether anything changed."""
+        version, changed = user_changes.changed_since(self._clients_version)
+        resync = changed is None or self._clients_synced_at is None \
+            or time.monotonic() - self._clients_synced_at >= XRAY_CLIENTS_RESYNC_INTERVAL
+        if not resync and not changed:
+            return False
 
-                    for row in rows:
-                        user_id, username, settings, excluded_inbound_tags = row
-
-                        if excluded_inbound_tags and inbound['tag'] in excluded_inbound_tags:
-                            continue
-
-                        client = {
-                            "email": f"{user_id}.{username}",
-                            **settings
-                        }
-
-                        # XTLS currently only supports transmission methods of TCP and mKCP
-                        if client.get('flow') and (
-                                inbound.get('network', 'tcp') not in ('tcp', 'raw', 'kcp')
-                                or
-                                (
-                                    inbound.get('network', 'tcp') in ('tcp', 'raw', 'kcp')
-                                    and
-                                    inbound.get('tls') not in ('tls', 'reality')
-                                )
-                                or
-                                inbound.get('header_type') == 'http'
-                        ):
-                            del client['flow']
-
-                        clients.append(client)
-
-        if DEBUG:
-            with open('generated_config-debug.json', 'w') as f:
-                f.write(config.to_json(indent=4))
+        with GetDB() as db:
+            if resync:
+                previous = self._clients
+                self._clients = {}
+                self._user_tags = {}
+                self._add_client_rows(self._user_clients_query(db))
+                self._clients_synced_at = time.monotonic()
+                # a periodic reload usually finds what the index already had
+                updated = changed is None or self._clients != previous
+            else:
+                for user_id in changed:
+                    for tag in self._user_tags.pop(user_id, ()):
+                        self._clients[tag].pop(user_id, None)
+                changed = list(changed)
+                for i in range(0, len(changed), 500):
+                    self._add_client_rows(self._user_clients_query(db, changed[i:i + 500]))
+                updated = True
+
+        self._clients_version = version
+        return updated
 
-        return config
+    def include_db_users(self) -> XRayConfig:
+        """
+        Returns the config with the clients of active and on_hold users included.
+
+        Clients are kept in a per-inbound index that only reloads users changed
+        through crud since the last call. Users changed by other processes (CLI,
+        other workers) don't go through this process' crud, so the whole index
+        is reloaded when a call comes XRAY_CLIENTS_RESYNC_INTERVAL seconds or
+        more after the last full load, which bounds how stale their clients can be.
+        While nothing changed the previously built config is returned as is,
+        its `version` tells configs apart.
+        """
+        with self._users_lock:
+            if self._sync_clients() or self._users_config is None:
+                config = self.copy()
+                for tag, clients in self._clients.items():
+                    inbound = config.get_inbound(tag)
+                    inbound['settings']['clients'] = inbound['settings']['clients'] + list(clients.values())
+                self._builds += 1
+                config.version = self._builds
+                self._users_config = config
+
+                if DEBUG:
+                    with open('generated_config-debug.json', 'w') as f:
+                        f.write(config.to_json(indent=4))
+
+            return self._users_config
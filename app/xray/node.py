@@ -1,3 +1,4 @@
+import json
 import socket
 import re
 import ssl
@@ -6,7 +7,7 @@ import threading
 import time
 from collections import deque
 from contextlib import contextmanager
-from typing import List
+from typing import List, Optional
 
 import grpc
 import requests
@@ -16,6 +17,7 @@ from requests.packages.urllib3.poolmanager import PoolManager
 from websocket import WebSocketConnectionClosedException, WebSocketTimeoutException, create_connection
 
 from app.xray.config import XRayConfig
+from config import NODE_LIVENESS_TTL
 from xray_api import XRay as XRayAPI
 
 
@@ -26,6 +28,39 @@ def string_to_temp_file(content: str):
     return file
 
 
+class ChunksBody:
+    """
+    Request body read from a list of byte chunks without joining them.
+
+    `requests` takes the length from `__len__` and sends the body with
+    Content-Length, reading it block by block.
+    """
+
+    def __init__(self, chunks: List[bytes]):
+        self._chunks = chunks
+        self._length = sum(len(chunk) for chunk in chunks)
+        self._index = 0
+        self._offset = 0
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._length
+        parts = []
+        while size > 0 and self._index < len(self._chunks):
+            chunk = self._chunks[self._index]
+            part = chunk[self._offset:self._offset + size]
+            parts.append(part)
+            size -= len(part)
+            self._offset += len(part)
+            if self._offset >= len(chunk):
+                self._index += 1
+                self._offset = 0
+        return b''.join(parts)
+
+
 class SANIgnoringAdaptor(HTTPAdapter):
     def init_poolmanager(self, connections, maxsize, block=False):
         self.poolmanager = PoolManager(num_pools=connections,
@@ -40,7 +75,33 @@ class NodeAPIError(Exception):
         self.detail = detail
 
 
-class ReSTXRayNode:
+class NodeLiveness:
+    """
+    Connected state of a node cached for NODE_LIVENESS_TTL seconds.
+
+    The heartbeat job refreshes it, connecting and disconnecting set it and
+    failed requests expire it, so checks on hot paths don't ping the node.
+    """
+
+    liveness_ttl = NODE_LIVENESS_TTL
+    _alive = False
+    _alive_checked_at = 0.0
+
+    def _cached_alive(self) -> Optional[bool]:
+        if self._alive_checked_at and time.monotonic() - self._alive_checked_at < self.liveness_ttl:
+            return self._alive
+        return None
+
+    def _set_alive(self, alive: bool):
+        self._alive = alive
+        self._alive_checked_at = time.monotonic()
+
+    def invalidate(self):
+        """Forget the cached state, the next check pings the node."""
+        self._alive_checked_at = 0.0
+
+
+class ReSTXRayNode(NodeLiveness):
     def __init__(self,
                  address: str,
                  port: int,
@@ -88,23 +149,45 @@ class ReSTXRayNode:
                         certificate['certificate'] = [
                             line.strip() for line in file.readlines()
                         ]
-                        del certificate['certificateFile']
+                        certificate.pop('certificateFile', None)
 
                 if certificate.get("keyFile"):
                     with open(certificate['keyFile']) as file:
                         certificate['key'] = [
                             line.strip() for line in file.readlines()
                         ]
-                        del certificate['keyFile']
+                        certificate.pop('keyFile', None)
 
         return config
 
+    def heartbeat(self) -> bool:
+        """Ping the node and refresh its cached connected and started state."""
+        alive = False
+        if self._session_id:
+            try:
+                self.make_request("/ping", timeout=3)
+                self._started = self.make_request("/", timeout=3).get('started', False)
+                alive = True
+            except NodeAPIError:
+                pass
+        self._set_alive(alive)
+        return alive
+
     def make_request(self, path: str, timeout: int, **params):
+        return self._post(path, timeout, json={"session_id": self._session_id, **params})
+
+    def _send_config(self, path: str, timeout: int, config: XRayConfig):
+        # the encoded config is shared by every node it is sent to, only the session id differs
+        head = json.dumps({"session_id": self._session_id})[:-1] + ', "config": '
+        body = ChunksBody([head.encode(), *config.shared_json_field(), b'}'])
+        return self._post(path, timeout, data=body, headers={"Content-Type": "application/json"})
+
+    def _post(self, path: str, timeout: int, **kwargs):
         try:
-            res = self.session.post(self._rest_api_url + path, timeout=timeout,
-                                    json={"session_id": self._session_id, **params})
+            res = self.session.post(self._rest_api_url + path, timeout=timeout, **kwargs)
             data = res.json()
         except Exception as e:
+            self.invalidate()
             exc = NodeAPIError(0, str(e))
             raise exc
 
@@ -118,16 +201,16 @@ class ReSTXRayNode:
     def connected(self):
         if not self._session_id:
             return False
-        try:
-            self.make_request("/ping", timeout=3)
-            return True
-        except NodeAPIError:
-            return False
+        alive = self._cached_alive()
+        if alive is None:
+            alive = self.heartbeat()
+        return alive
 
     @property
     def started(self):
-        res = self.make_request("/", timeout=3)
-        return res.get('started', False)
+        if self._cached_alive() is None:
+            self.heartbeat()
+        return self._started
 
     @property
     def api(self):
@@ -154,10 +237,14 @@ class ReSTXRayNode:
 
         res = self.make_request("/connect", timeout=3)
         self._session_id = res['session_id']
+        self._set_alive(True)
 
     def disconnect(self):
-        self.make_request("/disconnect", timeout=3)
-        self._session_id = None
+        try:
+            self.make_request("/disconnect", timeout=3)
+        finally:
+            self._session_id = None
+            self._set_alive(False)
 
     def get_version(self):
         res = self.make_request("/", timeout=3)
@@ -168,10 +255,9 @@ class ReSTXRayNode:
             self.connect()
 
         config = self._prepare_config(config)
-        json_config = config.to_json()
 
         try:
-            res = self.make_request("/start", timeout=10, config=json_config)
+            res = self._send_config("/start", timeout=10, config=config)
         except NodeAPIError as exc:
             if exc.detail == 'Xray is started already':
                 return self.restart(config)
@@ -207,9 +293,8 @@ class ReSTXRayNode:
             self.connect()
 
         config = self._prepare_config(config)
-        json_config = config.to_json()
 
-        res = self.make_request("/restart", timeout=10, config=json_config)
+        res = self._send_config("/restart", timeout=10, config=config)
 
         self._started = True
 
@@ -271,7 +356,7 @@ class ReSTXRayNode:
             del buf
 
 
-class RPyCXRayNode:
+class RPyCXRayNode(NodeLiveness):
     def __init__(self,
                  address: str,
                  port: int,
@@ -323,6 +408,7 @@ class RPyCXRayNode:
         self._api = None
 
     def disconnect(self):
+        self._set_alive(False)
         try:
             self.connection.close()
             del self.connection
@@ -347,20 +433,35 @@ class RPyCXRayNode:
             try:
                 conn.ping()
                 self.connection = conn
+                self._set_alive(True)
                 break
             except EOFError as exc:
                 if tries <= 3:
                     continue
                 raise exc
 
-    @property
-    def connected(self):
+    def heartbeat(self) -> bool:
+        """Ping the node and refresh its cached connected state."""
         try:
             self.connection.ping()
-            return (not self.connection.closed)
+            alive = not self.connection.closed
         except (AttributeError, EOFError, TimeoutError):
             self.disconnect()
             return False
+        self._set_alive(alive)
+        return alive
+
+    @property
+    def connected(self):
+        try:
+            if self.connection.closed:
+                return False
+        except AttributeError:
+            return False
+        alive = self._cached_alive()
+        if alive is None:
+            alive = self.heartbeat()
+        return alive
 
     @property
     def remote(self):
@@ -392,21 +493,20 @@ class RPyCXRayNode:
                         certificate['certificate'] = [
                             line.strip() for line in file.readlines()
                         ]
-                        del certificate['certificateFile']
+                        certificate.pop('certificateFile', None)
 
                 if certificate.get("keyFile"):
                     with open(certificate['keyFile']) as file:
                         certificate['key'] = [
                             line.strip() for line in file.readlines()
                         ]
-                        del certificate['keyFile']
+                        certificate.pop('keyFile', None)
 
         return config
 
     def start(self, config: XRayConfig):
         config = self._prepare_config(config)
-        json_config = config.to_json()
-        self.remote.start(json_config)
+        self.remote.start(config.shared_json())
         self.started = True
 
         # connect to API
@@ -444,8 +544,7 @@ class RPyCXRayNode:
     def restart(self, config: XRayConfig):
         self.started = False
         config = self._prepare_config(config)
-        json_config = config.to_json()
-        self.remote.restart(json_config)
+        self.remote.restart(config.shared_json())
         self.started = True
 
     @contextmanager
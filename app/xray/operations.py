@@ -1,15 +1,16 @@
 from functools import lru_cache
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional
 
 from sqlalchemy.exc import SQLAlchemyError
 
 from app import logger, xray
 from app.db import GetDB, crud
 from app.models.node import NodeStatus
-from app.models.user import UserResponse
-from app.utils.concurrency import threaded_function
+from app.models.user import UserProxies
 from app.xray.node import XRayNode
-from xray_api import XRay as XRayAPI
+from app.xray.orchestrator import SKIPPED, NodeOrchestrator
+from app.xray.pipeline import user_operations
+from config import NODE_CONNECT_WORKERS, NODE_RECONNECT_BACKOFF_BASE, NODE_RECONNECT_BACKOFF_MAX
 from xray_api.types.account import Account, XTLSFlows
 
 if TYPE_CHECKING:
@@ -28,36 +29,20 @@ def get_tls():
         }
 
 
-@threaded_function
-def _add_user_to_inbound(api: XRayAPI, inbound_tag: str, account: Account):
-    try:
-        api.add_inbound_user(tag=inbound_tag, user=account, timeout=30)
-    except (xray.exc.EmailExistsError, xray.exc.ConnectionError):
-        pass
+def _add_user_to_inbound(node_id: Optional[int], inbound_tag: str, account: Account):
+    user_operations.add_user(node_id, inbound_tag, account)
 
 
-@threaded_function
-def _remove_user_from_inbound(api: XRayAPI, inbound_tag: str, email: str):
-    try:
-        api.remove_inbound_user(tag=inbound_tag, email=email, timeout=30)
-    except (xray.exc.EmailNotFoundError, xray.exc.ConnectionError):
-        pass
+def _remove_user_from_inbound(node_id: Optional[int], inbound_tag: str, email: str):
+    user_operations.remove_user(node_id, inbound_tag, email)
 
 
-@threaded_function
-def _alter_inbound_user(api: XRayAPI, inbound_tag: str, account: Account):
-    try:
-        api.remove_inbound_user(tag=inbound_tag, email=account.email, timeout=30)
-    except (xray.exc.EmailNotFoundError, xray.exc.ConnectionError):
-        pass
-    try:
-        api.add_inbound_user(tag=inbound_tag, user=account, timeout=30)
-    except (xray.exc.EmailExistsError, xray.exc.ConnectionError):
-        pass
+def _alter_inbound_user(node_id: Optional[int], inbound_tag: str, account: Account):
+    user_operations.alter_user(node_id, inbound_tag, account)
 
 
 def add_user(dbuser: "DBUser"):
-    user = UserResponse.model_validate(dbuser)
+    user = UserProxies.model_validate(dbuser)
     email = f"{dbuser.id}.{dbuser.username}"
 
     for proxy_type, inbound_tags in user.inbounds.items():
@@ -84,24 +69,24 @@ def add_user(dbuser: "DBUser"):
             ):
                 account.flow = XTLSFlows.NONE
 
-            _add_user_to_inbound(xray.api, inbound_tag, account)  # main core
-            for node in list(xray.nodes.values()):
+            _add_user_to_inbound(None, inbound_tag, account)  # main core
+            for node_id, node in list(xray.nodes.items()):
                 if node.connected and node.started:
-                    _add_user_to_inbound(node.api, inbound_tag, account)
+                    _add_user_to_inbound(node_id, inbound_tag, account)
 
 
 def remove_user(dbuser: "DBUser"):
     email = f"{dbuser.id}.{dbuser.username}"
 
     for inbound_tag in xray.config.inbounds_by_tag:
-        _remove_user_from_inbound(xray.api, inbound_tag, email)
-        for node in list(xray.nodes.values()):
+        _remove_user_from_inbound(None, inbound_tag, email)
+        for node_id, node in list(xray.nodes.items()):
             if node.connected and node.started:
-                _remove_user_from_inbound(node.api, inbound_tag, email)
+                _remove_user_from_inbound(node_id, inbound_tag, email)
 
 
 def update_user(dbuser: "DBUser"):
-    user = UserResponse.model_validate(dbuser)
+    user = UserProxies.model_validate(dbuser)
     email = f"{dbuser.id}.{dbuser.username}"
 
     active_inbounds = []
@@ -130,24 +115,32 @@ def update_user(dbuser: "DBUser"):
             ):
                 account.flow = XTLSFlows.NONE
 
-            _alter_inbound_user(xray.api, inbound_tag, account)  # main core
-            for node in list(xray.nodes.values()):
+            _alter_inbound_user(None, inbound_tag, account)  # main core
+            for node_id, node in list(xray.nodes.items()):
                 if node.connected and node.started:
-                    _alter_inbound_user(node.api, inbound_tag, account)
+                    _alter_inbound_user(node_id, inbound_tag, account)
 
     for inbound_tag in xray.config.inbounds_by_tag:
         if inbound_tag in active_inbounds:
             continue
         # remove disabled inbounds
-        _remove_user_from_inbound(xray.api, inbound_tag, email)
-        for node in list(xray.nodes.values()):
+        _remove_user_from_inbound(None, inbound_tag, email)
+        for node_id, node in list(xray.nodes.items()):
             if node.connected and node.started:
-                _remove_user_from_inbound(node.api, inbound_tag, email)
+                _remove_user_from_inbound(node_id, inbound_tag, email)
+
+
+def _discard_async_client(node: XRayNode):
+    # the node's address or certificate may differ next time, its channel must not linger
+    if node._api is not None:
+        xray.async_api.discard(node._api)
 
 
 def remove_node(node_id: int):
+    user_operations.discard(node_id)
     if node_id in xray.nodes:
         try:
+            _discard_async_client(xray.nodes[node_id])
             xray.nodes[node_id].disconnect()
         except Exception:
             pass
@@ -188,22 +181,12 @@ def _change_node_status(node_id: int, status: NodeStatus, message: str = None, v
             db.rollback()
 
 
-global _connecting_nodes
-_connecting_nodes = {}
-
-
-@threaded_function
-def connect_node(node_id, config=None):
-    global _connecting_nodes
-
-    if _connecting_nodes.get(node_id):
-        return
-
+def _connect_node(node_id: int, config=None):
     with GetDB() as db:
         dbnode = crud.get_node_by_id(db, node_id)
 
-    if not dbnode:
-        return
+    if not dbnode or dbnode.status == NodeStatus.disabled:
+        return SKIPPED
 
     try:
         node = xray.nodes[dbnode.id]
@@ -212,14 +195,13 @@ def connect_node(node_id, config=None):
         node = xray.operations.add_node(dbnode)
 
     try:
-        _connecting_nodes[node_id] = True
-
         _change_node_status(node_id, NodeStatus.connecting)
         logger.info(f"Connecting to \"{dbnode.name}\" node")
 
         if config is None:
             config = xray.config.include_db_users()
 
+        _discard_async_client(node)
         node.start(config)
         version = node.get_version()
         _change_node_status(node_id, NodeStatus.connected, version=version)
@@ -228,21 +210,15 @@ def connect_node(node_id, config=None):
     except Exception as e:
         _change_node_status(node_id, NodeStatus.error, message=str(e))
         logger.info(f"Unable to connect to \"{dbnode.name}\" node")
+        raise
 
-    finally:
-        try:
-            del _connecting_nodes[node_id]
-        except KeyError:
-            pass
 
-
-@threaded_function
-def restart_node(node_id, config=None):
+def _restart_node(node_id: int, config=None):
     with GetDB() as db:
         dbnode = crud.get_node_by_id(db, node_id)
 
-    if not dbnode:
-        return
+    if not dbnode or dbnode.status == NodeStatus.disabled:
+        return SKIPPED
 
     try:
         node = xray.nodes[dbnode.id]
@@ -250,7 +226,7 @@ def restart_node(node_id, config=None):
         node = xray.operations.add_node(dbnode)
 
     if not node.connected:
-        return connect_node(node_id, config)
+        return _connect_node(node_id, config)
 
     try:
         logger.info(f"Restarting Xray core of \"{dbnode.name}\" node")
@@ -267,6 +243,26 @@ def restart_node(node_id, config=None):
             node.disconnect()
         except Exception:
             pass
+        raise
+
+
+node_orchestrator = NodeOrchestrator(
+    connect=_connect_node,
+    restart=_restart_node,
+    workers=NODE_CONNECT_WORKERS,
+    backoff_base=NODE_RECONNECT_BACKOFF_BASE,
+    backoff_max=NODE_RECONNECT_BACKOFF_MAX,
+)
+
+
+def connect_node(node_id, config=None, force: bool = False):
+    """Queue a connect, skipped while a failed node backs off unless `force`."""
+    node_orchestrator.connect(node_id, config, force)
+
+
+def restart_node(node_id, config=None, force: bool = False):
+    """Queue a core restart, a node that isn't connected gets connected."""
+    node_orchestrator.restart(node_id, config, force)
 
 
 __all__ = [
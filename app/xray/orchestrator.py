@@ -0,0 +1,162 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+from app import logger
+from app.models.node import NodeConnectionState
+
+if TYPE_CHECKING:
+    from app.xray.config import XRayConfig
+
+CONNECT = "connect"
+RESTART = "restart"
+# returned by a handler that had nothing to do, e.g. the node was removed or disabled meanwhile
+SKIPPED = "skipped"
+
+
+class _NodeJob:
+    __slots__ = ("node_id", "state", "action", "config", "running_config", "rerun", "attempts", "last_error",
+                 "queued_at", "started_at", "finished_at", "duration", "next_attempt_at")
+
+    def __init__(self, node_id: int):
+        self.node_id = node_id
+        self.state: Optional[NodeConnectionState] = None
+        self.action: Optional[str] = None
+        self.config: Optional["XRayConfig"] = None
+        self.running_config: Optional["XRayConfig"] = None
+        self.rerun = False
+        self.attempts = 0
+        self.last_error: Optional[str] = None
+        self.queued_at: Optional[float] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.duration: Optional[float] = None
+        self.next_attempt_at: Optional[float] = None
+
+    @property
+    def pending(self) -> bool:
+        return self.state in (NodeConnectionState.queued, NodeConnectionState.connecting,
+                              NodeConnectionState.restarting)
+
+
+class NodeOrchestrator:
+    """
+    Connects and restarts nodes on a fixed pool of workers.
+
+    A node has at most one queued or running job. Requests for a queued node only
+    update its action and config; a request with another config for a running
+    node runs it once more afterwards. Failed nodes back off exponentially with
+    jitter, and requests that arrive before the backoff ends are dropped unless
+    forced, so health checks don't keep hammering unreachable nodes.
+    """
+
+    def __init__(self,
+                 connect: Callable[[int, Optional["XRayConfig"]], Optional[str]],
+                 restart: Callable[[int, Optional["XRayConfig"]], Optional[str]],
+                 workers: int = 8,
+                 backoff_base: float = 5.0,
+                 backoff_max: float = 300.0):
+        self._handlers = {CONNECT: connect, RESTART: restart}
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="node-connect")
+        self._jobs: Dict[int, _NodeJob] = {}
+        self._lock = Lock()
+
+    def connect(self, node_id: int, config: Optional["XRayConfig"] = None, force: bool = False):
+        self._submit(node_id, CONNECT, config, force)
+
+    def restart(self, node_id: int, config: Optional["XRayConfig"] = None, force: bool = False):
+        self._submit(node_id, RESTART, config, force)
+
+    def _submit(self, node_id: int, action: str, config: Optional["XRayConfig"], force: bool):
+        with self._lock:
+            job = self._jobs.get(node_id)
+            if job is None:
+                job = self._jobs[node_id] = _NodeJob(node_id)
+
+            if job.pending:
+                # a connect starts the core with the config as well, restart covers both
+                if job.action != RESTART:
+                    job.action = action
+                job.config = config or job.config
+                if job.state != NodeConnectionState.queued and config is not None \
+                        and config is not job.running_config:
+                    job.rerun = True
+                return
+
+            if not force and job.next_attempt_at and time.time() < job.next_attempt_at:
+                return
+
+            job.state = NodeConnectionState.queued
+            job.action = action
+            job.config = config
+            job.queued_at = time.time()
+
+        self._executor.submit(self._run, job)
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _run(self, job: _NodeJob):
+        with self._lock:
+            action, config = job.action, job.config
+            job.config = None
+            job.running_config = config
+            job.state = NodeConnectionState.connecting if action == CONNECT else NodeConnectionState.restarting
+            job.started_at = time.time()
+
+        error = result = None
+        try:
+            result = self._handlers[action](job.node_id, config)
+        except Exception as e:
+            error = e
+
+        with self._lock:
+            job.running_config = None
+            job.finished_at = time.time()
+            job.duration = job.finished_at - job.started_at
+            if error is None:
+                job.state = NodeConnectionState.skipped if result == SKIPPED else NodeConnectionState.started
+                job.attempts = 0
+                job.last_error = None
+                job.next_attempt_at = None
+            else:
+                job.state = NodeConnectionState.failed
+                job.attempts += 1
+                job.last_error = str(error)
+                job.next_attempt_at = job.finished_at + self._backoff(job.attempts)
+                logger.debug(f"Node {job.node_id} {action} failed (attempt {job.attempts}): {error}")
+
+            rerun = job.rerun and self._jobs.get(job.node_id) is job
+            job.rerun = False
+            if rerun:
+                job.state = NodeConnectionState.queued
+                job.queued_at = time.time()
+
+        if rerun:
+            self._executor.submit(self._run, job)
+
+    def forget(self, node_id: int):
+        with self._lock:
+            self._jobs.pop(node_id, None)
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [
+                {
+                    "node_id": job.node_id,
+                    "state": job.state,
+                    "attempts": job.attempts,
+                    "last_error": job.last_error,
+                    "queued_at": job.queued_at,
+                    "started_at": job.started_at,
+                    "finished_at": job.finished_at,
+                    "duration": job.duration,
+                    "next_attempt_at": job.next_attempt_at,
+                }
+                for job in self._jobs.values()
+            ]
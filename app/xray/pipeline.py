@@ -0,0 +1,245 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app import logger
+from config import XRAY_OPERATIONS_BATCH_SIZE, XRAY_OPERATIONS_QUEUE_SIZE, XRAY_OPERATIONS_WORKERS
+from xray_api import XRay as XRayAPI
+from xray_api import exceptions as exc
+from xray_api.types.account import Account
+
+ADD = "add"
+REMOVE = "remove"
+ALTER = "alter"
+
+
+def _merge(pending: str, new: str) -> str:
+    """Collapse two operations on the same (email, inbound) into the one that reaches the newer state."""
+    if new == REMOVE:
+        return REMOVE
+    if new == ADD and pending == ADD:
+        return ADD
+    # the user may or may not exist on the inbound at this point
+    return ALTER
+
+
+class _Operation:
+    __slots__ = ("kind", "account", "enqueued_at")
+
+    def __init__(self, kind: str, account: Optional[Account], enqueued_at: float):
+        self.kind = kind
+        self.account = account
+        self.enqueued_at = enqueued_at
+
+
+class NodeOperationQueue:
+    """
+    Pending user operations of a single core (the main core or one node).
+
+    Operations are coalesced per (email, inbound tag) and drained in batches by
+    at most one worker at a time, which keeps them in order for every email.
+    Submitting blocks while `max_size` distinct operations are pending.
+    """
+
+    def __init__(self,
+                 get_api: Callable[[], XRayAPI],
+                 executor: ThreadPoolExecutor,
+                 max_size: int = 10000,
+                 batch_size: int = 100,
+                 on_error: Optional[Callable[[], None]] = None):
+        self._get_api = get_api
+        self._on_error = on_error
+        self._executor = executor
+        self.max_size = max_size
+        self.batch_size = batch_size
+
+        self._pending: "OrderedDict[Tuple[str, str], _Operation]" = OrderedDict()
+        self._cond = Condition()
+        self._scheduled = False
+        self._closed = False
+
+        self.processed = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def submit(self, kind: str, inbound_tag: str, email: str, account: Account = None):
+        key = (email, inbound_tag)
+        with self._cond:
+            while True:
+                if self._closed:
+                    return
+
+                op = self._pending.get(key)
+                if op is not None:
+                    op.kind = _merge(op.kind, kind)
+                    op.account = account or op.account
+                    self.coalesced += 1
+                    break
+
+                if len(self._pending) < self.max_size:
+                    self._pending[key] = _Operation(kind, account, time.monotonic())
+                    break
+
+                self._cond.wait()
+
+            if not self._scheduled:
+                self._scheduled = True
+                self._executor.submit(self._drain)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._pending.clear()
+            self._cond.notify_all()
+
+    def _drain(self):
+        try:
+            self._drain_batch()
+        except Exception as e:
+            logger.error(f"Failed to apply queued user operations: {e}")
+        finally:
+            # whatever happened above, the queue must not be left marked as scheduled
+            with self._cond:
+                if self._pending and not self._closed:
+                    # resubmit instead of looping so that other cores get a fair share of workers
+                    try:
+                        self._executor.submit(self._drain)
+                    except RuntimeError:  # the executor was shut down
+                        self._scheduled = False
+                else:
+                    self._scheduled = False
+
+    def _drain_batch(self):
+        with self._cond:
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False))
+            self._cond.notify_all()
+
+        try:
+            api = self._get_api()
+        except Exception:
+            api = None
+
+        errors = 0
+        for (email, inbound_tag), op in batch:
+            ok = api is not None and self._apply(api, inbound_tag, email, op)
+            errors += not ok
+            latency = time.monotonic() - op.enqueued_at
+            with self._cond:
+                self.processed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                if not ok:
+                    self.failed += 1
+
+        if errors and self._on_error:
+            self._on_error()
+
+    @staticmethod
+    def _apply(api: XRayAPI, inbound_tag: str, email: str, op: _Operation) -> bool:
+        try:
+            if op.kind in (REMOVE, ALTER):
+                try:
+                    api.remove_inbound_user(tag=inbound_tag, email=email, timeout=30)
+                except exc.EmailNotFoundError:
+                    pass
+
+            if op.kind in (ADD, ALTER):
+                try:
+                    api.add_inbound_user(tag=inbound_tag, user=op.account, timeout=30)
+                except exc.EmailExistsError:
+                    pass
+
+            return True
+        except Exception as e:
+            logger.debug(f"Failed to {op.kind} user {email} on inbound {inbound_tag}: {e}")
+            return False
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "depth": len(self._pending),
+                "processed": self.processed,
+                "failed": self.failed,
+                "coalesced": self.coalesced,
+                "avg_latency": self.total_latency / self.processed if self.processed else 0.0,
+                "max_latency": self.max_latency,
+            }
+
+
+class UserOperationsDispatcher:
+    """Routes user operations to per-core queues sharing one bounded worker pool."""
+
+    def __init__(self, workers: int = 8, max_size: int = 10000, batch_size: int = 100):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="xray-operations")
+        self._queues: Dict[Optional[int], NodeOperationQueue] = {}
+        self._lock = Lock()
+
+    def queue(self, node_id: Optional[int] = None) -> NodeOperationQueue:
+        """Returns the queue of a node, or of the main core when `node_id` is None."""
+        with self._lock:
+            queue = self._queues.get(node_id)
+            if queue is None:
+                queue = self._queues[node_id] = NodeOperationQueue(
+                    get_api=lambda: self._get_api(node_id),
+                    executor=self._executor,
+                    max_size=self.max_size,
+                    batch_size=self.batch_size,
+                    on_error=lambda: self._invalidate_node(node_id),
+                )
+            return queue
+
+    @staticmethod
+    def _get_api(node_id: Optional[int]) -> XRayAPI:
+        from app import xray
+
+        if node_id is None:
+            return xray.api
+        return xray.nodes[node_id].api
+
+    @staticmethod
+    def _invalidate_node(node_id: Optional[int]):
+        from app import xray
+
+        # the node may be down, recheck it instead of trusting the cached state
+        node = xray.nodes.get(node_id) if node_id is not None else None
+        if node is not None:
+            node.invalidate()
+
+    def add_user(self, node_id: Optional[int], inbound_tag: str, account: Account):
+        self.queue(node_id).submit(ADD, inbound_tag, account.email, account)
+
+    def remove_user(self, node_id: Optional[int], inbound_tag: str, email: str):
+        self.queue(node_id).submit(REMOVE, inbound_tag, email)
+
+    def alter_user(self, node_id: Optional[int], inbound_tag: str, account: Account):
+        self.queue(node_id).submit(ALTER, inbound_tag, account.email, account)
+
+    def discard(self, node_id: Optional[int]):
+        with self._lock:
+            queue = self._queues.pop(node_id, None)
+        if queue is not None:
+            queue.close()
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            queues = list(self._queues.items())
+        return [{"node_id": node_id, **queue.stats()} for node_id, queue in queues]
+
+
+user_operations = UserOperationsDispatcher(
+    workers=XRAY_OPERATIONS_WORKERS,
+    max_size=XRAY_OPERATIONS_QUEUE_SIZE,
+    batch_size=XRAY_OPERATIONS_BATCH_SIZE,
+)
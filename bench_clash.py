@@ -0,0 +1,62 @@
+"""
+Clash subscription render microbenchmark.
+
+Compares the direct emitter used for the default template with the
+template round trip custom templates still go through.
+
+    python bench_clash.py --hosts 30 --rounds 300
+"""
+import argparse
+import time
+from uuid import uuid4
+
+from app.subscription.clash import ClashConfiguration, ClashMetaConfiguration
+
+
+def build(cls, hosts: int):
+    conf = cls()
+    settings = {"id": uuid4(), "password": "secret", "method": "chacha20-ietf-poly1305"}
+    for i in range(hosts):
+        protocol = ("vmess", "trojan", "shadowsocks")[i % 3]
+        conf.add(
+            remark=f"🚀 Node {i} [{protocol} - ws]",
+            address=f"node{i}.example.com",
+            inbound={
+                "protocol": protocol,
+                "network": "ws",
+                "port": 443,
+                "tls": "tls",
+                "sni": f"node{i}.example.com",
+                "host": f"cdn{i}.example.com",
+                "path": "/ws",
+                "header_type": "none",
+            },
+            settings=settings,
+        )
+    return conf
+
+
+def measure(render, rounds: int) -> float:
+    render()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        render()
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", type=int, default=30)
+    parser.add_argument("--rounds", type=int, default=300)
+    args = parser.parse_args()
+
+    for name, cls in (("clash", ClashConfiguration), ("clash-meta", ClashMetaConfiguration)):
+        conf = build(cls, args.hosts)
+        direct = measure(conf.render, args.rounds)
+        template = measure(conf.render_template, args.rounds)
+        print(f"{name:<11} {args.hosts} hosts  direct {direct:7.2f} ms  template {template:7.2f} ms  "
+              f"x{template / direct:.1f}")
+
+
+if __name__ == "__main__":
+    main()
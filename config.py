@@ -35,6 +35,23 @@ XRAY_EXCLUDE_INBOUND_TAGS = config("XRAY_EXCLUDE_INBOUND_TAGS", default='').spli
 XRAY_SUBSCRIPTION_URL_PREFIX = config("XRAY_SUBSCRIPTION_URL_PREFIX", default="").strip("/")
 XRAY_SUBSCRIPTION_PATH = config("XRAY_SUBSCRIPTION_PATH", default="sub").strip("/")
 
+# user add/remove operations sent to the cores through the gRPC API
+XRAY_OPERATIONS_WORKERS = config("XRAY_OPERATIONS_WORKERS", cast=int, default=8)
+XRAY_OPERATIONS_BATCH_SIZE = config("XRAY_OPERATIONS_BATCH_SIZE", cast=int, default=100)
+XRAY_OPERATIONS_QUEUE_SIZE = config("XRAY_OPERATIONS_QUEUE_SIZE", cast=int, default=10000)
+# in-flight async gRPC calls per core (usage collection, health checks)
+XRAY_API_MAX_CONCURRENCY = config("XRAY_API_MAX_CONCURRENCY", cast=int, default=32)
+# clients changed outside this process (CLI, other workers) reach generated core configs within this many seconds
+XRAY_CLIENTS_RESYNC_INTERVAL = config("XRAY_CLIENTS_RESYNC_INTERVAL", cast=int, default=300)
+
+# node connects/restarts run on a fixed pool, failed nodes are retried with exponential backoff (seconds)
+NODE_CONNECT_WORKERS = config("NODE_CONNECT_WORKERS", cast=int, default=8)
+NODE_RECONNECT_BACKOFF_BASE = config("NODE_RECONNECT_BACKOFF_BASE", cast=float, default=5)
+NODE_RECONNECT_BACKOFF_MAX = config("NODE_RECONNECT_BACKOFF_MAX", cast=float, default=300)
+# nodes' connected/started state is cached and refreshed by a heartbeat instead of pinging on every check
+NODE_LIVENESS_TTL = config("NODE_LIVENESS_TTL", cast=float, default=30)
+NODE_HEARTBEAT_INTERVAL = config("NODE_HEARTBEAT_INTERVAL", cast=int, default=10)
+
 TELEGRAM_API_TOKEN = config("TELEGRAM_API_TOKEN", default="")
 TELEGRAM_ADMIN_ID = config(
     'TELEGRAM_ADMIN_ID',
@@ -56,6 +73,8 @@ HOME_PAGE_TEMPLATE = config("HOME_PAGE_TEMPLATE", default="home/index.html")
 
 CLASH_SUBSCRIPTION_TEMPLATE = config("CLASH_SUBSCRIPTION_TEMPLATE", default="clash/default.yml")
 CLASH_SETTINGS_TEMPLATE = config("CLASH_SETTINGS_TEMPLATE", default="clash/settings.yml")
+# libyaml writes emojis as escapes in quoted strings, the pure Python dumper is ~3x slower
+CLASH_YAML_LIBYAML = config("CLASH_YAML_LIBYAML", default=True, cast=bool)
 
 SINGBOX_SUBSCRIPTION_TEMPLATE = config("SINGBOX_SUBSCRIPTION_TEMPLATE", default="singbox/default.json")
 SINGBOX_SETTINGS_TEMPLATE = config("SINGBOX_SETTINGS_TEMPLATE", default="singbox/settings.json")
@@ -139,6 +158,32 @@ SUB_UPDATE_INTERVAL = config("SUB_UPDATE_INTERVAL", default="12")
 SUB_SUPPORT_URL = config("SUB_SUPPORT_URL", default="https://t.me/")
 SUB_PROFILE_TITLE = config("SUB_PROFILE_TITLE", default="Subscription")
 
+# rendered subscription cache, set SUB_CACHE_SIZE to 0 to disable it
+SUB_CACHE_SIZE = config("SUB_CACHE_SIZE", cast=int, default=1024)
+SUB_CACHE_TTL = config("SUB_CACHE_TTL", cast=int, default=300)
+# used traffic is rounded down to this many bytes when keying cached subscriptions
+SUB_CACHE_USAGE_BUCKET = config("SUB_CACHE_USAGE_BUCKET", cast=int, default=104857600)
+# gzip or brotli (when installed) for subscription bodies of at least SUB_COMPRESSION_MIN_SIZE bytes
+SUB_COMPRESSION = config("SUB_COMPRESSION", cast=bool, default=True)
+SUB_COMPRESSION_MIN_SIZE = config("SUB_COMPRESSION_MIN_SIZE", cast=int, default=1024)
+# sing-box and v2ray-json subscriptions without indentation
+SUB_COMPACT_JSON = config("SUB_COMPACT_JSON", cast=bool, default=False)
+
+# socks balancer relay, one of: auto, splice, buffered, stream
+BALANCER_RELAY_BACKEND = config("BALANCER_RELAY_BACKEND", default="auto")
+BALANCER_RELAY_BUFFER_SIZE = config("BALANCER_RELAY_BUFFER_SIZE", cast=int, default=65536)
+# upstream selection, one of: weighted, least_connections, ewma, hash
+BALANCER_STRATEGY = config("BALANCER_STRATEGY", default="weighted")
+# seconds before an idle UDP ASSOCIATE flow is dropped from the NAT table
+BALANCER_UDP_IDLE_TIMEOUT = config("BALANCER_UDP_IDLE_TIMEOUT", cast=int, default=60)
+# upper bound of pre-connected idle sockets per upstream, 0 disables pre-warming
+BALANCER_WARM_POOL_MAX = config("BALANCER_WARM_POOL_MAX", cast=int, default=8)
+BALANCER_WARM_IDLE_TIMEOUT = config("BALANCER_WARM_IDLE_TIMEOUT", cast=int, default=30)
+# send greeting, auth and CONNECT in one write, upstreams that reject it are detected
+BALANCER_PIPELINE_HANDSHAKE = config("BALANCER_PIPELINE_HANDSHAKE", cast=bool, default=True)
+# upstream health probes running at the same time
+BALANCER_CHECK_CONCURRENCY = config("BALANCER_CHECK_CONCURRENCY", cast=int, default=50)
+
 # discord webhook log
 DISCORD_WEBHOOK_URL = config("DISCORD_WEBHOOK_URL", default="")
 
@@ -148,4 +193,18 @@ JOB_CORE_HEALTH_CHECK_INTERVAL = config("JOB_CORE_HEALTH_CHECK_INTERVAL", cast=i
 JOB_RECORD_NODE_USAGES_INTERVAL = config("JOB_RECORD_NODE_USAGES_INTERVAL", cast=int, default=30)
 JOB_RECORD_USER_USAGES_INTERVAL = config("JOB_RECORD_USER_USAGES_INTERVAL", cast=int, default=10)
 JOB_REVIEW_USERS_INTERVAL = config("JOB_REVIEW_USERS_INTERVAL", cast=int, default=10)
+# users changed outside this process (CLI, other workers) are reviewed within this many seconds
+JOB_REVIEW_USERS_RESYNC_INTERVAL = config("JOB_REVIEW_USERS_RESYNC_INTERVAL", cast=int, default=300)
 JOB_SEND_NOTIFICATIONS_INTERVAL = config("JOB_SEND_NOTIFICATIONS_INTERVAL", cast=int, default=30)
+JOB_ROLLUP_USAGES_INTERVAL = config("JOB_ROLLUP_USAGES_INTERVAL", cast=int, default=3600)
+# buffered subscription accesses (sub_updated_at), 0 writes them on every fetch
+JOB_FLUSH_SUB_ACCESS_INTERVAL = config("JOB_FLUSH_SUB_ACCESS_INTERVAL", cast=int, default=5)
+
+# hourly node user usages are summed into daily rows after this many days,
+# daily rows into monthly ones after the second value, 0 keeps a tier forever
+NODE_USER_USAGE_HOURLY_RETENTION_DAYS = config("NODE_USER_USAGE_HOURLY_RETENTION_DAYS", cast=int, default=30)
+NODE_USER_USAGE_DAILY_RETENTION_DAYS = config("NODE_USER_USAGE_DAILY_RETENTION_DAYS", cast=int, default=365)
+# seconds aggregated /users/usage and /nodes/usage results are reused, 0 disables it
+USAGE_QUERY_CACHE_TTL = config("USAGE_QUERY_CACHE_TTL", cast=int, default=60)
+# seconds the total of GET /api/users is reused while no user changes, 0 disables it
+USERS_COUNT_CACHE_TTL = config("USERS_COUNT_CACHE_TTL", cast=int, default=30)
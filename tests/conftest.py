@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+# config.py reads these on import, so they are set before anything of the app is loaded
+_workdir = tempfile.mkdtemp(prefix="marzban-tests-")
+_xray_json = os.path.join(_workdir, "xray_config.json")
+with open(_xray_json, "w") as file:
+    json.dump({
+        "inbounds": [
+            {"tag": "VLESS TCP", "port": 2061, "protocol": "vless",
+             "settings": {"clients": [], "decryption": "none"}},
+            {"tag": "VMess TCP", "port": 2063, "protocol": "vmess", "settings": {"clients": []}},
+        ],
+        "outbounds": [{"tag": "DIRECT", "protocol": "freedom"}],
+    }, file)
+
+os.environ["XRAY_JSON"] = _xray_json
+os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite:///{os.path.join(_workdir, 'db.sqlite3')}"
+
+from sqlalchemy import event  # noqa: E402
+
+from app.db import GetDB, crud  # noqa: E402
+from app.db.base import Base, engine  # noqa: E402
+from app.db.models import JWT, User  # noqa: E402
+from app.models.user import UserCreate  # noqa: E402
+
+
+@event.listens_for(engine, "connect")
+def _enforce_foreign_keys(dbapi_connection, connection_record):
+    # sqlite ignores foreign keys unless asked to, the other backends always check them
+    dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+
+Base.metadata.create_all(engine)
+with GetDB() as _db:
+    _db.add(JWT())
+    _db.commit()
+
+
+@pytest.fixture
+def db():
+    with GetDB() as db:
+        yield db
+
+
+@pytest.fixture
+def create_user(db):
+    created = []
+
+    def create(username: str, **kwargs):
+        dbuser = crud.create_user(db, UserCreate(username=username, proxies={"vless": {}}, **kwargs))
+        # subscription tokens issued in the same second as the user would be rejected
+        dbuser.created_at = datetime.utcnow() - timedelta(minutes=1)
+        db.commit()
+        created.append(dbuser.id)
+        return dbuser
+
+    yield create
+
+    db.rollback()
+    for dbuser in db.query(User).filter(User.id.in_(created)):
+        crud.remove_user(db, dbuser)
+
+
+@pytest.fixture
+def client():
+    from fastapi.testclient import TestClient
+
+    from app import app
+
+    return TestClient(app)
+
+
+@pytest.fixture
+def subscription_url():
+    from app.utils.jwt import create_subscription_token
+    from config import XRAY_SUBSCRIPTION_PATH
+
+    def url(username: str, client_type: str = "") -> str:
+        path = f"/{XRAY_SUBSCRIPTION_PATH}/{create_subscription_token(username)}"
+        return f"{path}/{client_type}" if client_type else path
+
+    return url
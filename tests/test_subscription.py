@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from app import xray
+from app.db import crud
+from app.db.models import ProxyHost
+from app.subscription import compression
+
+
+@pytest.fixture
+def host_remark(db):
+    added = []
+
+    def add(remark: str):
+        inbound = crud.get_or_create_inbound(db, "VLESS TCP")
+        host = ProxyHost(remark=remark, address="example.com", inbound=inbound)
+        db.add(host)
+        db.commit()
+        added.append(host)
+        xray.hosts.update()
+
+    yield add
+
+    for host in added:
+        db.delete(host)
+    db.commit()
+    xray.hosts.update()
+
+
+def poll(client, url, etag=None):
+    return client.get(url, headers={"if-none-match": etag} if etag else {})
+
+
+@pytest.mark.parametrize("accept_encoding", ["gzip", "identity"])
+def test_not_modified_has_the_etag_of_the_full_response(client, create_user, subscription_url,
+                                                         monkeypatch, accept_encoding):
+    monkeypatch.setattr(compression, "SUB_COMPRESSION_MIN_SIZE", 0)
+    create_user(f"etag_{accept_encoding}")
+    url = subscription_url(f"etag_{accept_encoding}", "v2ray")
+    headers = {"accept-encoding": accept_encoding}
+
+    full = client.get(url, headers=headers)
+    assert full.status_code == 200
+    assert full.headers.get("content-encoding") == (None if accept_encoding == "identity" else "gzip")
+
+    not_modified = client.get(url, headers={**headers, "if-none-match": full.headers["etag"]})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["etag"] == full.headers["etag"]
+
+
+def test_unchanged_user_is_not_modified_on_the_next_poll(client, db, create_user, subscription_url,
+                                                         host_remark, monkeypatch):
+    host_remark("{USERNAME} [{PROTOCOL} - {TRANSPORT}]")
+    dbuser = create_user("etag_next_poll", data_limit=10 * 1024 ** 3)
+    url = subscription_url("etag_next_poll")
+    first = poll(client, url)
+    assert first.status_code == 200
+
+    # the next poll comes after the profile update interval, traffic used meanwhile isn't shown
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 12 * 3600)
+    dbuser.used_traffic += 3 * 1024 ** 3
+    db.commit()
+
+    assert poll(client, url, first.headers["etag"]).status_code == 304
+
+
+def test_usage_shown_by_hosts_changes_the_etag(client, db, create_user, subscription_url, host_remark):
+    host_remark("{DATA_LEFT} left")
+    dbuser = create_user("etag_data_left", data_limit=10 * 1024 ** 3)
+    url = subscription_url("etag_data_left")
+    first = poll(client, url)
+
+    dbuser.used_traffic += 3 * 1024 ** 3
+    db.commit()
+
+    second = poll(client, url, first.headers["etag"])
+    assert second.status_code == 200
+    assert second.headers["etag"] != first.headers["etag"]
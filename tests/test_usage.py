@@ -0,0 +1,34 @@
+from sqlalchemy import select
+
+from app.db import GetDB
+from app.db.models import Node, NodeUserUsage, User
+from app.db.usage import usage_aggregator
+
+
+def test_flush_skips_users_removed_since_collect(db, create_user):
+    node = Node(name="usage-node", address="127.0.0.1", port=62050, api_port=62051)
+    db.add(node)
+    db.commit()
+    kept, removed = create_user("usage_kept"), create_user("usage_removed")
+    kept_id, removed_id = kept.id, removed.id
+
+    # loads both users into the aggregator's owner map
+    usage_aggregator.flush({node.id: usage_aggregator.collect([(kept_id, 1), (removed_id, 1)])}, {})
+    stats = usage_aggregator.collect([(kept_id, 100), (removed_id, 200)])
+
+    # removed by another process, this one's owner map still has the user
+    with GetDB() as other:
+        other.delete(other.get(User, removed_id))
+        other.commit()
+
+    usage_aggregator.flush({node.id: stats}, {})
+
+    db.expire_all()
+    assert db.get(User, kept_id).used_traffic == 101
+    usages = dict(db.execute(
+        select(NodeUserUsage.user_id, NodeUserUsage.used_traffic).where(NodeUserUsage.node_id == node.id)
+    ).all())
+    assert usages == {kept_id: 101}
+
+    db.delete(node)
+    db.commit()
@@ -0,0 +1,15 @@
+from .base import close_channel, close_channels
+from .logger import Logger
+from .proxyman import Proxyman
+from .stats import Stats
+
+
+class XRay(Logger, Proxyman, Stats):
+    pass
+
+
+__all__ = [
+    "XRay",
+    "close_channel",
+    "close_channels",
+]
@@ -0,0 +1,85 @@
+import asyncio
+from typing import Dict, Optional, Tuple
+
+import grpc
+
+KEEPALIVE_OPTIONS = (
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+)
+
+_channels: Dict[Tuple, grpc.aio.Channel] = {}
+
+
+def _get_channel(address: str, port: int, ssl_cert: bytes = None, ssl_target_name: str = None) -> grpc.aio.Channel:
+    # aio channels belong to the event loop they were created on
+    key = (address, port, ssl_cert, ssl_target_name, asyncio.get_running_loop())
+    channel = _channels.get(key)
+    if channel is None:
+        if ssl_cert is None:
+            channel = grpc.aio.insecure_channel(f"{address}:{port}", options=KEEPALIVE_OPTIONS)
+        else:
+            creds = grpc.ssl_channel_credentials(root_certificates=ssl_cert)
+            opts = KEEPALIVE_OPTIONS
+            if ssl_target_name is not None:
+                opts += (('grpc.ssl_target_name_override', ssl_target_name,),)
+            channel = grpc.aio.secure_channel(f"{address}:{port}", credentials=creds, options=opts)
+        _channels[key] = channel
+    return channel
+
+
+async def close_channel(address: str, port: int, ssl_cert: bytes = None, ssl_target_name: str = None):
+    """Close the channel of one core created on the running loop"""
+    channel = _channels.pop((address, port, ssl_cert, ssl_target_name, asyncio.get_running_loop()), None)
+    if channel is not None:
+        await channel.close()
+
+
+async def close_channels():
+    """Close the channels created on the running loop"""
+    loop = asyncio.get_running_loop()
+    for key in [key for key in _channels if key[-1] is loop]:
+        await _channels.pop(key).close()
+
+
+class XRayBase(object):
+    """
+    asyncio counterpart of `xray_api.base.XRayBase`.
+
+    Instances pointing to the same core share one channel per event loop, and
+    at most `max_concurrency` calls of an instance are in flight at a time.
+    """
+
+    def __init__(self, address: str, port: int, ssl_cert: bytes = None, ssl_target_name: str = None,
+                 max_concurrency: int = 32):
+        self.address = address
+        self.port = port
+        self.ssl_cert = ssl_cert
+        self.ssl_target_name = ssl_target_name
+        self.max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._stubs = {}
+
+    @property
+    def _channel(self) -> grpc.aio.Channel:
+        return _get_channel(self.address, self.port, self.ssl_cert, self.ssl_target_name)
+
+    def _stub(self, stub_class):
+        channel = self._channel
+        stub = self._stubs.get(stub_class)
+        if stub is None or stub[0] is not channel:
+            stub = self._stubs[stub_class] = (channel, stub_class(channel))
+        return stub[1]
+
+    async def close(self):
+        """Close the channel of this core, it is opened again on the next call"""
+        self._stubs.clear()
+        await close_channel(self.address, self.port, self.ssl_cert, self.ssl_target_name)
+
+    @property
+    def _limit(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
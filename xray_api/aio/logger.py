@@ -0,0 +1,17 @@
+import grpc
+
+from ..exceptions import RelatedError
+from ..proto.app.log.command import config_pb2, config_pb2_grpc
+from .base import XRayBase
+
+
+class Logger(XRayBase):
+    async def restart_logger(self, timeout: int = None) -> bool:
+        try:
+            async with self._limit:
+                await self._stub(config_pb2_grpc.LoggerServiceStub).RestartLogger(
+                    config_pb2.RestartLoggerRequest(), timeout=timeout)
+            return True
+
+        except grpc.RpcError as e:
+            raise RelatedError(e)
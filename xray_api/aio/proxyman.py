@@ -0,0 +1,74 @@
+import grpc
+
+from ..exceptions import RelatedError
+from ..proto.app.proxyman.command import command_pb2, command_pb2_grpc
+from ..proto.common.protocol import user_pb2
+from ..types.account import Account
+from ..types.message import Message, TypedMessage
+from .base import XRayBase
+
+
+class Proxyman(XRayBase):
+    async def alter_inbound(self, tag: str, operation: TypedMessage, timeout: int = None) -> bool:
+        try:
+            async with self._limit:
+                await self._stub(command_pb2_grpc.HandlerServiceStub).AlterInbound(
+                    command_pb2.AlterInboundRequest(tag=tag, operation=operation), timeout=timeout)
+            return True
+
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+
+    async def alter_outbound(self, tag: str, operation: TypedMessage, timeout: int = None) -> bool:
+        try:
+            async with self._limit:
+                await self._stub(command_pb2_grpc.HandlerServiceStub).AlterOutbound(
+                    command_pb2.AlterOutboundRequest(tag=tag, operation=operation), timeout=timeout)
+            return True
+
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+
+    async def add_inbound_user(self, tag: str, user: Account, timeout: int = None) -> bool:
+        return await self.alter_inbound(
+            tag=tag,
+            operation=Message(
+                command_pb2.AddUserOperation(
+                    user=user_pb2.User(
+                        level=user.level,
+                        email=user.email,
+                        account=user.message
+                    )
+                )
+            ), timeout=timeout)
+
+    async def remove_inbound_user(self, tag: str, email: str, timeout: int = None) -> bool:
+        return await self.alter_inbound(
+            tag=tag,
+            operation=Message(
+                command_pb2.RemoveUserOperation(
+                    email=email
+                )
+            ), timeout=timeout)
+
+    async def add_outbound_user(self, tag: str, user: Account, timeout: int = None) -> bool:
+        return await self.alter_outbound(
+            tag=tag,
+            operation=Message(
+                command_pb2.AddUserOperation(
+                    user=user_pb2.User(
+                        level=user.level,
+                        email=user.email,
+                        account=user.message
+                    )
+                )
+            ), timeout=timeout)
+
+    async def remove_outbound_user(self, tag: str, email: str, timeout: int = None) -> bool:
+        return await self.alter_outbound(
+            tag=tag,
+            operation=Message(
+                command_pb2.RemoveUserOperation(
+                    email=email
+                )
+            ), timeout=timeout)
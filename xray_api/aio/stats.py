@@ -0,0 +1,89 @@
+import typing
+
+import grpc
+
+from ..exceptions import RelatedError
+from ..proto.app.stats.command import command_pb2, command_pb2_grpc
+from ..stats import (InboundStatsResponse, OutboundStatsResponse, StatResponse, SysStatsResponse,
+                     UsersUsageResponse, UserStatsResponse, parse_users_usage)
+from .base import XRayBase
+
+
+class Stats(XRayBase):
+    async def get_sys_stats(self, timeout: int = None) -> SysStatsResponse:
+        try:
+            async with self._limit:
+                r = await self._stub(command_pb2_grpc.StatsServiceStub).GetSysStats(
+                    command_pb2.SysStatsRequest(), timeout=timeout)
+
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+
+        return SysStatsResponse(
+            num_goroutine=r.NumGoroutine,
+            num_gc=r.NumGC,
+            alloc=r.Alloc,
+            total_alloc=r.TotalAlloc,
+            sys=r.Sys,
+            mallocs=r.Mallocs,
+            frees=r.Frees,
+            live_objects=r.LiveObjects,
+            pause_total_ns=r.PauseTotalNs,
+            uptime=r.Uptime
+        )
+
+    async def query_stats(self, pattern: str, reset: bool = False, timeout: int = None) -> typing.List[StatResponse]:
+        try:
+            async with self._limit:
+                r = await self._stub(command_pb2_grpc.StatsServiceStub).QueryStats(
+                    command_pb2.QueryStatsRequest(pattern=pattern, reset=reset), timeout=timeout)
+
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+
+        stats = []
+        for stat in r.stat:
+            type, name, _, link = stat.name.split('>>>')
+            stats.append(StatResponse(name, type, link, stat.value))
+        return stats
+
+    async def get_users_stats(self, reset: bool = False, timeout: int = None) -> typing.List[StatResponse]:
+        return await self.query_stats("user>>>", reset=reset, timeout=timeout)
+
+    async def get_users_usage(self, reset: bool = False, timeout: int = None) -> UsersUsageResponse:
+        try:
+            async with self._limit:
+                r = await self._stub(command_pb2_grpc.StatsServiceStub).QueryStats(
+                    command_pb2.QueryStatsRequest(pattern="user>>>", reset=reset), timeout=timeout)
+
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+
+        return parse_users_usage(r.stat)
+
+    async def get_inbounds_stats(self, reset: bool = False, timeout: int = None) -> typing.List[StatResponse]:
+        return await self.query_stats("inbound>>>", reset=reset, timeout=timeout)
+
+    async def get_outbounds_stats(self, reset: bool = False, timeout: int = None) -> typing.List[StatResponse]:
+        return await self.query_stats("outbound>>>", reset=reset, timeout=timeout)
+
+    async def _get_links(self, pattern: str, reset: bool, timeout: int) -> typing.Tuple[int, int]:
+        uplink, downlink = 0, 0
+        for stat in await self.query_stats(pattern, reset=reset, timeout=timeout):
+            if stat.link == 'uplink':
+                uplink = stat.value
+            if stat.link == 'downlink':
+                downlink = stat.value
+        return uplink, downlink
+
+    async def get_user_stats(self, email: str, reset: bool = False, timeout: int = None) -> UserStatsResponse:
+        uplink, downlink = await self._get_links(f"user>>>{email}>>>", reset, timeout)
+        return UserStatsResponse(email=email, uplink=uplink, downlink=downlink)
+
+    async def get_inbound_stats(self, tag: str, reset: bool = False, timeout: int = None) -> InboundStatsResponse:
+        uplink, downlink = await self._get_links(f"inbound>>>{tag}>>>", reset, timeout)
+        return InboundStatsResponse(tag=tag, uplink=uplink, downlink=downlink)
+
+    async def get_outbound_stats(self, tag: str, reset: bool = False, timeout: int = None) -> OutboundStatsResponse:
+        uplink, downlink = await self._get_links(f"outbound>>>{tag}>>>", reset, timeout)
+        return OutboundStatsResponse(tag=tag, uplink=uplink, downlink=downlink)
@@ -3,6 +3,8 @@ import grpc
 
 class XRayBase(object):
     def __init__(self, address: str, port: int, ssl_cert: str = None, ssl_target_name: str = None):
+        self.ssl_cert = ssl_cert
+        self.ssl_target_name = ssl_target_name
         if ssl_cert is None:
             self.address = address
             self.port = port
@@ -1,4 +1,5 @@
 import typing
+from array import array
 from dataclasses import dataclass
 
 import grpc
@@ -37,6 +38,57 @@ class UserStatsResponse:
     downlink: int
 
 
+@dataclass
+class UsersUsageResponse:
+    """Traffic of users in parallel arrays, one entry per user id."""
+    uids: array
+    uplink: array
+    downlink: array
+
+    def totals(self) -> array:
+        return array('q', map(int.__add__, self.uplink, self.downlink))
+
+    def as_dict(self) -> typing.Dict[int, typing.Tuple[int, int]]:
+        return dict(zip(self.uids, zip(self.uplink, self.downlink)))
+
+    def to_numpy(self):
+        """(uids, uplink, downlink) as int64 NumPy arrays sharing memory with the response, needs numpy."""
+        import numpy
+        return tuple(numpy.frombuffer(a, dtype=numpy.int64) for a in (self.uids, self.uplink, self.downlink))
+
+
+def parse_users_usage(stats) -> UsersUsageResponse:
+    """
+    Reads `user>>>{id}.{username}>>>traffic>>>{link}` stats straight from the protobuf.
+
+    Zero values and emails that don't start with a numeric id are skipped.
+    """
+    index = {}
+    uids, uplink, downlink = array('q'), array('q'), array('q')
+    for stat in stats:
+        value = stat.value
+        if not value:
+            continue
+        name = stat.name
+        try:
+            uid = int(name[7:name.index('.', 7)])
+        except ValueError:
+            continue
+
+        i = index.get(uid)
+        if i is None:
+            i = index[uid] = len(uids)
+            uids.append(uid)
+            uplink.append(0)
+            downlink.append(0)
+        if name.endswith('>>>uplink'):
+            uplink[i] += value
+        else:
+            downlink[i] += value
+
+    return UsersUsageResponse(uids, uplink, downlink)
+
+
 @dataclass
 class InboundStatsResponse:
     tag: str
@@ -88,6 +140,16 @@ class Stats(XRayBase):
     def get_users_stats(self, reset: bool = False, timeout: int = None) -> typing.Iterable[StatResponse]:
         return self.query_stats("user>>>", reset=reset, timeout=timeout)
 
+    def get_users_usage(self, reset: bool = False, timeout: int = None) -> UsersUsageResponse:
+        try:
+            stub = command_pb2_grpc.StatsServiceStub(self._channel)
+            r = stub.QueryStats(command_pb2.QueryStatsRequest(pattern="user>>>", reset=reset), timeout=timeout)
+
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+
+        return parse_users_usage(r.stat)
+
     def get_inbounds_stats(self, reset: bool = False, timeout: int = None) -> typing.Iterable[StatResponse]:
         return self.query_stats("inbound>>>", reset=reset, timeout=timeout)
 